@@ -1,79 +1,120 @@
-from booru.models import Post, RatingThreshold, NSFWAutomationRecord
+from booru.models import Post, Rating, RatingThreshold, NSFWAutomationRecord, SearchCache
 
 import os
+import threading
+import logging
 import numpy as np
 from PIL import Image
+import booru.boorutils as boorutils
 import homebooru.settings as settings
 
+logger = logging.getLogger(__name__)
+
 n2 = None # The NSFW model (if it is loaded)
 model = None
+model_lock = threading.Lock()
 
 # Check if the worker environment variable is set
 if settings.IS_WORKER and settings.BOORU_AUTOMATIC_RATING_ENABLED:
     # If so, import the NSFW model
     import opennsfw2 as n2
 
-def __predict_image(image_path : str):
+def __prepare_model():
     global model
 
-    images = np.array([
-        n2.preprocess_image(Image.open(image_path), n2.Preprocessing.YAHOO)
-    ])
+    # Only one thread should load the model
+    with model_lock:
+        if model is None:
+            print("NSFW model not loaded, loading...", flush=True)
+            model = n2.make_open_nsfw_model()
+
+    return model
+
+def __prepare_image(image_path : str):
+    with Image.open(image_path) as image:
+        return n2.preprocess_image(image, n2.Preprocessing.YAHOO)
+
+def __predict_images(image_paths : list) -> list:
+    """Gets the NSFW probability of each image, preparing them in parallel and running them through the model in batches"""
+
+    nsfw_probabilities = [0.0] * len(image_paths)
+
+    if len(image_paths) == 0:
+        return nsfw_probabilities
 
-    if model is None:
-        print("NSFW model not loaded, loading...", flush=True)
-        model = n2.make_open_nsfw_model()
-    else:
-        # print("NSFW model already loaded!", flush=True)
-        pass
+    model = __prepare_model()
 
-    predictions = model.predict(images, batch_size=8, verbose=0)
-    nsfw_probabilities = predictions[:, 1].tolist()
+    for batch in boorutils.batched(list(enumerate(image_paths)), settings.BOORU_NSFW_BATCH_SIZE):
+        # Decode and preprocess the images in parallel, images that can't be read are left as 0
+        images = {}
+
+        for (i, image_path), image, error in boorutils.parallel_map(
+            lambda item: __prepare_image(item[1]),
+            batch,
+            workers=settings.BOORU_NSFW_WORKERS
+        ):
+            if error is None:
+                images[i] = image
+
+        if len(images) == 0:
+            continue
+
+        try:
+            # Run the whole batch through the model at once
+            predictions = model.predict(np.array(list(images.values())), batch_size=len(images), verbose=0)
+        except Exception:
+            # The media in the batch are left as 0
+            logger.exception('Failed to predict the NSFW probabilities of %d images', len(images))
+            continue
+
+        for i, nsfw_probability in zip(images.keys(), predictions[:, 1].tolist()):
+            nsfw_probabilities[i] = nsfw_probability
 
     return nsfw_probabilities
 
-def get_nsfw_probability(media_path : str):
-    """Tag media as sfw"""
+def get_nsfw_probabilities(media_paths : list) -> list:
+    """Gets the NSFW probability of each piece of media"""
 
     if n2 is None:
         raise Exception("NSFW model not loaded")
 
+    nsfw_probabilities = [0.0] * len(media_paths)
+
     # Check if the type is a video
     # TODO make this more effective
+    # TODO implement video nsfw detection (videos are left as 0)
+    images = [(i, media_path) for i, media_path in enumerate(media_paths) if media_path.split(".")[-1] != "mp4"]
 
-    file_type = media_path.split(".")[-1]
+    # Handle images
+    predicted = __predict_images([media_path for i, media_path in images])
 
-    if file_type == "mp4":
-        """
-        video_path = media_path
-        
-        # Return two lists giving the elapsed time in seconds and the NSFW probability of each frame
-        elapsed_seconds, nsfw_probabilities = n2.predict_video_frames(video_path)
+    for (i, media_path), nsfw_probability in zip(images, predicted):
+        nsfw_probabilities[i] = nsfw_probability
+
+    return nsfw_probabilities
 
-        # Get the average of the nsfw probabilities
-        average_nsfw_probability = sum(nsfw_probabilities) / len(nsfw_probabilities)
+def get_nsfw_probability(media_path : str):
+    """Tag media as sfw"""
 
-        # Return the average nsfw probability
-        return average_nsfw_probability
-        """
+    return get_nsfw_probabilities([media_path])[0]
 
-        # TODO implement video nsfw detection
-        return 0.0
+def get_predicted_rating(post : Post, nsfw_probability : float, thresholds : list, default : Rating = None):
+    """Gets the rating that the post should be changed to, or None if it should be kept, using the given thresholds."""
 
-    # Handle images
-    image_path = media_path
+    # Get the rating threshold (for the current rating)
+    # If it doesn't exist, just use the automatic rating
+    current_rating_score = next(
+        (threshold.threshold for threshold in thresholds if threshold.rating_id == post.rating_id),
+        0.0
+    )
 
-    # Get the nsfw probability
-    nsfw_probability = [0.0]
-    
-    try:
-        nsfw_probability = __predict_image(image_path)
-    except Exception as e:
-        # print("Error predicting image:", e, flush=True)
-        pass
+    # Check if the NSFW probability is greater than the current rating threshold
+    if nsfw_probability <= current_rating_score:
+        # If so, keep the current rating
+        return None
 
-    # Return the nsfw probability
-    return nsfw_probability[0]
+    # Get the predicted rating
+    return RatingThreshold.get_rating(nsfw_probability, thresholds=thresholds, default=default)
 
 def perform_automation(post : Post):
     """Gets the automated rating for the given post."""
@@ -85,7 +126,7 @@ def perform_automation(post : Post):
     if NSFWAutomationRecord.objects.filter(post=post).exists():
         # If so, return
         return None
-    
+
     # Get the media path
     media_path = str(post.get_media_path()) # PosIX path
 
@@ -96,23 +137,49 @@ def perform_automation(post : Post):
     record = NSFWAutomationRecord(post=post, nsfw_probability=predicted_rating_score)
     record.save()
 
-    # Get the current rating
-    current_rating = post.rating
+    # Return the predicted rating
+    return get_predicted_rating(post, predicted_rating_score, RatingThreshold.get_all())
 
-    # Get the rating threshold (for the current rating)
-    # If it doesn't exist, just use the automatic rating
-    current_rating_threshold = RatingThreshold.objects.filter(rating=current_rating)
+def perform_automation_many(posts : list) -> dict:
+    """Rates a batch of posts together, saving the records and ratings in bulk, and returns the new rating of each post (by id) that was changed."""
 
-    # Get the current rating threshold
-    current_rating_score = current_rating_threshold.first().threshold if current_rating_threshold.exists() else 0.0
+    if n2 is None:
+        raise Exception("NSFW model not loaded")
 
-    # Check if the NSFW probability is greater than the current rating threshold
-    if predicted_rating_score <= current_rating_score:
-        # If so, return the current rating
-        return None
+    # Skip the posts that have already been scanned
+    scanned = set(NSFWAutomationRecord.objects.filter(post__in=posts).values_list('post_id', flat=True))
+    posts = [post for post in posts if post.id not in scanned]
 
-    # Get the predicted rating
-    predicted_rating = RatingThreshold.get_rating(predicted_rating_score)
+    if len(posts) == 0:
+        return {}
 
-    # Return the predicted rating
-    return predicted_rating
\ No newline at end of file
+    # Get the NSFW probabilities
+    nsfw_probabilities = get_nsfw_probabilities([str(post.get_media_path()) for post in posts])
+
+    # Create the NSFW automation records (ignoring any that were created by another task in the meantime)
+    NSFWAutomationRecord.objects.bulk_create(
+        [NSFWAutomationRecord(post=post, nsfw_probability=p) for post, p in zip(posts, nsfw_probabilities)],
+        ignore_conflicts=True
+    )
+
+    # The thresholds are only fetched once for the whole batch
+    thresholds = RatingThreshold.get_all()
+    default = Rating.get_default()
+
+    changed = []
+
+    for post, nsfw_probability in zip(posts, nsfw_probabilities):
+        predicted_rating = get_predicted_rating(post, nsfw_probability, thresholds, default)
+
+        if predicted_rating is None:
+            continue
+
+        post.rating = predicted_rating
+        changed.append(post)
+
+    if len(changed) > 0:
+        # Update the post ratings together, this skips the save signals so the cached searches are invalidated here
+        Post.objects.bulk_update(changed, ['rating'])
+        SearchCache.invalidate()
+
+    return {post.id: post.rating for post in changed}
@@ -11,10 +11,18 @@ from pathlib import Path
 import torch
 import torchvision.transforms.functional as TVF
 
+import threading
+import logging
+
 from .tag_automation import TagAutomation
 from booru.models.tags import Tag
 from booru.models.posts import Post
 
+import booru.boorutils as boorutils
+import homebooru.settings
+
+logger = logging.getLogger(__name__)
+
 class JoytagAutomation(TagAutomation):
     """
     An automation for tagging images with Joytag.
@@ -23,31 +31,39 @@ class JoytagAutomation(TagAutomation):
     model_path = Path(os.path.expanduser('~/.joytag/model'))
     threshold = 0.7
 
+    # The model is loaded once per process and shared by every instance
+    __model = None
+    __top_tags = None
+    __lock = threading.Lock()
+
     def __init__(self):
         super().__init__()
 
-    def __prepare_model(self):
+    @staticmethod
+    def __prepare_model():
         """
-        Creates a VisionModel object from the model at the given path.
+        Creates a VisionModel object from the model at the given path, unless it has already been loaded.
         """
 
-        self.__model = None
-        self.__top_tags = None
+        with JoytagAutomation.__lock:
+            if JoytagAutomation.__model is not None and JoytagAutomation.__top_tags is not None:
+                return
+
+            # Limit the threads used by each operation (0 leaves it to torch)
+            if homebooru.settings.BOORU_JOYTAG_THREADS > 0:
+                torch.set_num_threads(homebooru.settings.BOORU_JOYTAG_THREADS)
+
+            model = VisionModel.load_model(JoytagAutomation.model_path, device='cpu')
+            model.eval()
+            model = model.to('cpu')
 
-        if self.__model is not None and self.__top_tags is not None:
-            return
-        
-        model = VisionModel.load_model(self.model_path, device='cpu')
-        model.eval()
-        model = model.to('cpu')
+            # Get the top tags
+            # Load the tags from the file
+            with open(JoytagAutomation.model_path / 'top_tags.txt', 'r') as f:
+                top_tags = [line.strip() for line in f.readlines() if line.strip()]
 
-        # Get the top tags
-        # Load the tags from the file
-        with open(self.model_path / 'top_tags.txt', 'r') as f:
-            top_tags = [line.strip() for line in f.readlines() if line.strip()]
-            
-        self.__model = model
-        self.__top_tags = top_tags
+            JoytagAutomation.__model = model
+            JoytagAutomation.__top_tags = top_tags
 
     # Wrappers
     def __prepare_image(self, image: Image.Image, target_size: int) -> torch.Tensor:
@@ -72,42 +88,63 @@ class JoytagAutomation(TagAutomation):
 
         return image_tensor
 
-    @torch.no_grad()
-    def __predict(self, image: Image.Image):
-        self.__prepare_model() # Ensure the model is loaded
+    def __load_image(self, post : Post) -> torch.Tensor:
+        """Opens and prepares the image of a post."""
 
-        image_tensor = self.__prepare_image(image, self.__model.image_size)
-        batch = {
-            'image': image_tensor.unsqueeze(0).to('cpu'),
-        }
+        with Image.open(post.get_media_path()) as image:
+            return self.__prepare_image(image, JoytagAutomation.__model.image_size)
+
+    @torch.no_grad()
+    def __predict_many(self, images : list) -> list:
+        """Predicts the scores of the tags for each of the prepared images, in one batch."""
 
         with torch.amp.autocast_mode.autocast('cpu', enabled=True):
-            preds = self.__model(batch)
+            preds = JoytagAutomation.__model({'image': torch.stack(images).to('cpu')})
             tag_preds = preds['tags'].sigmoid().cpu()
 
-        scores = {self.__top_tags[i]: tag_preds[0][i] for i in range(len(self.__top_tags))}
-        predicted_tags = [tag for tag, score in scores.items() if score > self.threshold]
-        tag_string = ', '.join(predicted_tags)
-
-        return tag_string, scores
+        return [
+            {JoytagAutomation.__top_tags[i]: float(scores[i]) for i in range(len(JoytagAutomation.__top_tags))}
+            for scores in tag_preds
+        ]
 
     # Override
     def get_tags(self, post : Post) -> list[Tag]:
-        # Check if the post is a video or gif
-        if post.is_video:
-            return []
+        return self.get_tags_many([post])[post.id]
 
-        image = Image.open(post.get_media_path())
+    # Override
+    def get_tags_many(self, posts : list) -> dict:
+        selected = {post.id: [] for post in posts}
+
+        # Videos and gifs are not tagged
+        images = [post for post in posts if not post.is_video]
+
+        if len(images) == 0:
+            return selected
+
+        self.__prepare_model() # Ensure the model is loaded
+
+        for batch in boorutils.batched(images, homebooru.settings.BOORU_JOYTAG_BATCH_SIZE):
+            # Decode and resize the images in parallel, while the model is only run once for the whole batch
+            prepared = {}
 
-        tag_string, scores = self.__predict(image)
+            for post, image_tensor, error in boorutils.parallel_map(self.__load_image, batch, workers=homebooru.settings.BOORU_JOYTAG_WORKERS):
+                if error is not None:
+                    logger.warning('Failed to read the image for post %s: %s', post.id, error)
+                    continue
 
-        # Select the tags over the threshold
-        selected_tags = []
-        predicted_tags = scores.items()
-        for tag, score in predicted_tags:
-            if score <= self.threshold:
+                prepared[post.id] = image_tensor
+
+            if len(prepared) == 0:
                 continue
-        
-            selected_tags.append(Tag.create_or_get(tag))
-        
-        return selected_tags
\ No newline at end of file
+
+            scores = self.__predict_many(list(prepared.values()))
+
+            # Select the tags over the threshold
+            for post_id, post_scores in zip(prepared.keys(), scores):
+                selected[post_id] = [tag for tag, score in post_scores.items() if score > self.threshold]
+
+        # Create or get all of the tags together
+        tags = Tag.create_or_get_many(sorted(set(tag for names in selected.values() for tag in names)))
+        tags = {tag.tag: tag for tag in tags}
+
+        return {post_id: [tags[name] for name in names] for post_id, names in selected.items()}
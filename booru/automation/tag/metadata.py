@@ -1,16 +1,27 @@
 from .tag_automation import TagAutomation
 from booru.models import Post, Tag
 
+import booru.boorutils as boorutils
+
 class AnimatedContentTagAutomation(TagAutomation):
     """Metadata detection for animated content (webm, gif)"""
 
+    def get_frames(self, post : Post) -> int:
+        """Returns the number of frames in the post's media, or None if they can't be counted."""
+
+        # Only the packets are counted, none of the frames are decoded
+        try:
+            return boorutils.probe_content(post.get_media_path(), count_frames=True)['frames']
+        except Exception:
+            return None
+
     def get_tags(self, post : Post) -> list[Tag]:
         """Returns a list of tags to be added to the post, or an empty list if no tags are to be added."""
 
         # Check the metadata flags
         is_gif = post.filename.endswith(".gif")
         is_webm = post.is_video
-        is_animated = is_gif or is_webm
+        is_animated = is_webm or (is_gif and self.get_frames(post) != 1)
 
         # Create a list of tags
         tags = []
@@ -23,30 +23,29 @@ class TagAutomation:
         """Returns a list of tags to be added to the post, or an empty list if no tags are to be added."""
         return []
     
-    def update_post(self, post : Post) -> bool:
-        """Returns True if the post was updated, False otherwise, please note that this function automatically saves the post."""
+    def get_tags_many(self, posts : list[Post]) -> dict:
+        """Returns the tags to be added to each of the posts (by id), this can be overridden to handle the posts together."""
+        return {post.id: self.get_tags(post) for post in posts}
 
-        # Get the tags
-        tags = self.get_tags(post)
+    def update_post(self, post : Post, tags : list[Tag] = None) -> bool:
+        """Returns True if the post was updated, False otherwise, please note that this function automatically saves the post."""
 
-        # Have a counter for the number of tags added
-        appendices = 0
+        # Get the tags, unless they were already found with the other posts
+        if tags is None:
+            tags = self.get_tags(post)
 
-        # Loop through the tags
-        for tag in tags:
-            # Check if the tag is already on the post
-            if post.tags.all().contains(tag):
-                # If it is, skip it
-                continue
+        # Get the tags that are already on the post in one query
+        existing = set(post.tags.values_list('pk', flat=True))
 
-            # Add the tag to the post
-            post.tags.add(tag)
+        # Skip the tags that are already on the post
+        new_tags = [tag for tag in tags if tag.pk not in existing]
 
-            # Increment the counter
-            appendices += 1
+        # Add the tags to the post in one insert
+        if len(new_tags) > 0:
+            post.tags.add(*new_tags)
 
         # Check if any tags were added
-        if appendices == 0:
+        if len(new_tags) == 0:
             # If not, return False
             return False
         
@@ -142,22 +141,12 @@ class TagAutomationRegistry:
         # Create a new record (this shall be used as a lock.)
         record = TagAutomationRecord(post=post, state_hash=current_state_hash)
 
-        # Try to save it but return false if it already exists
-        try:
-            # Check if the record already exists
-            if TagAutomationRecord.objects.filter(post=post).exists():
-                raise Exception("Record already exists.")
-            
-        except Exception as e:
-            # Check if we should force perform
-            if not force_perform:
-                return False
-            
-            # Delete the already existing record
-            existing_record = TagAutomationRecord.objects.get(post=post)
+        # Skip the post if it has already been done with the current automations
+        if not force_perform and TagAutomationRecord.objects.filter(post=post, state_hash=current_state_hash).exists():
+            return False
 
-            # Delete the record
-            existing_record.delete()
+        # Delete any records from before (including ones for older automations)
+        TagAutomationRecord.objects.filter(post=post).delete()
 
         # Get the automations
         automations = self.get_automations_sorted()
@@ -183,6 +172,44 @@ class TagAutomationRegistry:
         # Return whether or not the post was updated
         return updated
 
+    def perform_automation_many(self, posts : list[Post], force_perform = False) -> list[Post]:
+        """Performs all automation on a batch of posts, with each automation handling the posts together, returning the posts that were updated."""
+
+        # Get the current state hash
+        current_state_hash = self.get_state_hash()
+
+        # Skip the posts that have already been done with the current automations
+        if not force_perform:
+            done = set(
+                TagAutomationRecord.objects.filter(post__in=posts, state_hash=current_state_hash).values_list('post_id', flat=True)
+            )
+
+            posts = [post for post in posts if post.id not in done]
+
+        if len(posts) == 0:
+            return []
+
+        # Delete any records from before (including ones for older automations)
+        TagAutomationRecord.objects.filter(post__in=posts).delete()
+
+        updated = set()
+
+        # Each automation is done on every post before the next one, like it is for a single post
+        for automation in self.get_automations_sorted():
+            tags = automation.get_tags_many(posts)
+
+            for post in posts:
+                if automation.update_post(post, tags.get(post.id, [])):
+                    updated.add(post.id)
+
+        # Save the records together
+        TagAutomationRecord.objects.bulk_create(
+            [TagAutomationRecord(post=post, state_hash=current_state_hash) for post in posts],
+            ignore_conflicts=True
+        )
+
+        return [post for post in posts if post.id in updated]
+
     def print_state(self):
         """Prints the state of the registry."""
 
@@ -1,8 +1,18 @@
 import hashlib
 import pathlib
+import os
+import shutil
 import ffmpegio
 import re
 import html
+import magic
+import threading
+import itertools
+import json
+import time
+import ffmpegio.probe
+import ffmpegio.path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import homebooru.settings
 
@@ -13,7 +23,7 @@ def hash_str(s):
     """Hashes a string using the md5 algorithm"""
     return hashlib.md5(str(s).encode('utf-8')).hexdigest()
 
-def get_file_checksum(path : str) -> str:
+def get_file_checksum(path : str, chunk_size : int = 1024 * 1024) -> str:
     """Gets the checksum of a file"""
 
     # Make sure that the file exists
@@ -25,10 +35,262 @@ def get_file_checksum(path : str) -> str:
     # Make the file path absolute
     file_path = file_path.resolve()
 
-    # Get the file md5 checksum
-    md5 = hashlib.md5(file_path.read_bytes()).hexdigest()
+    # Get the file md5 checksum, reading a chunk at a time so that large videos are not loaded into memory
+    md5 = hashlib.md5()
 
-    return md5
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+# libmagic handles cannot be shared between threads
+__magic = threading.local()
+
+def get_mimetype(path : str) -> str:
+    """Gets the mimetype of a file from its contents"""
+
+    # Reuse the same handle for each thread rather than creating one per file
+    if not hasattr(__magic, 'mime'):
+        __magic.mime = magic.Magic(mime=True)
+
+    return __magic.mime.from_file(str(path))
+
+def get_buffer_mimetype(buffer : bytes) -> str:
+    """Gets the mimetype of the start of a file"""
+
+    if not hasattr(__magic, 'mime'):
+        __magic.mime = magic.Magic(mime=True)
+
+    return __magic.mime.from_buffer(buffer)
+
+# How files are brought into the storage
+IMPORT_COPY = 'copy'
+IMPORT_HARDLINK = 'hardlink'
+IMPORT_REFLINK = 'reflink'
+IMPORT_MOVE = 'move'
+
+IMPORT_STRATEGIES = [IMPORT_COPY, IMPORT_HARDLINK, IMPORT_REFLINK, IMPORT_MOVE]
+
+# The ioctl that clones a file's extents into another (btrfs, xfs etc.), from linux/fs.h
+FICLONE = 0x40049409
+
+def reflink_file(source : str, destination : str):
+    """Makes the destination share the source's data (copy-on-write), raising an OSError if the filesystem can't"""
+
+    import fcntl
+
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            # Don't leave an empty file behind
+            dst.close()
+            os.unlink(destination)
+            raise
+
+def import_file(source : str, destination : str, strategy : str = IMPORT_COPY) -> str:
+    """Brings a file into the storage using the given strategy, falling back to copying it if the filesystem doesn't support it, returning the strategy that was used"""
+
+    if strategy not in IMPORT_STRATEGIES:
+        raise ValueError('Unknown import strategy: ' + str(strategy))
+
+    if strategy == IMPORT_MOVE:
+        # This is a rename on the same filesystem and a copy (then delete) across them
+        shutil.move(str(source), str(destination))
+        return strategy
+
+    if strategy == IMPORT_HARDLINK:
+        try:
+            os.link(source, destination)
+            return strategy
+        except OSError:
+            # e.g. across filesystems, or the filesystem doesn't support them
+            pass
+
+    if strategy == IMPORT_REFLINK:
+        try:
+            reflink_file(source, destination)
+            return strategy
+        except (OSError, ImportError):
+            # e.g. ext4 or across filesystems (or not on linux)
+            pass
+
+    shutil.copyfile(str(source), str(destination))
+    return IMPORT_COPY
+
+def batched(iterable, size : int):
+    """Splits an iterable into lists of at most the given size"""
+
+    iterator = iter(iterable)
+
+    while True:
+        batch = list(itertools.islice(iterator, size))
+
+        if len(batch) == 0:
+            return
+
+        yield batch
+
+def batched_ids(queryset, size : int, limit : int = None):
+    """Streams the ids of a queryset in order, as lists of at most the given size"""
+
+    ids = queryset.order_by('id').values_list('id', flat=True)
+
+    if limit is not None:
+        ids = ids[:limit]
+
+    # Only a chunk of the ids is ever in memory
+    return batched(ids.iterator(chunk_size=size), size)
+
+def parallel_map(function, items, workers : int = 1, max_pending : int = None):
+    """Runs the function on each item using a pool of threads, yielding (item, result, error) as they finish
+
+    Only a bounded number of items are taken from the iterable at a time, so it can be a generator of any size."""
+
+    # Don't bother with threads if there is only one worker
+    if workers <= 1:
+        for item in items:
+            try:
+                yield item, function(item), None
+            except Exception as e:
+                yield item, None, e
+
+        return
+
+    # Keep a few items queued up for each worker
+    max_pending = max_pending or workers * 4
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        def finished(futures):
+            for future in futures:
+                item = pending.pop(future)
+
+                error = future.exception()
+                yield item, None if error else future.result(), error
+
+        for item in items:
+            pending[executor.submit(function, item)] = item
+
+            # Wait for some of the items to finish before taking any more
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from finished(done)
+
+        # Wait for the rest
+        while len(pending) > 0:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            yield from finished(done)
+
+class ContentTooLarge(Exception):
+    """Raised when content is too large to be decoded safely"""
+    pass
+
+def __probe(path : str, count_frames : bool) -> dict:
+    """Runs ffprobe on the file, only reading the headers (and the packets, if the frames are counted)"""
+
+    result = ffmpegio.probe.ffprobe(
+        [
+            '-v', 'error',
+            '-select_streams', 'v:0',
+            *(['-count_packets'] if count_frames else []),
+            '-show_entries', 'stream=width,height,codec_name,nb_frames,nb_read_packets,duration:stream_tags=rotate:stream_side_data=rotation:format=duration',
+            '-of', 'json',
+            str(path)
+        ],
+        capture_output=True,
+        text=True
+    )
+
+    info = json.loads(result.stdout or '{}') if result.returncode == 0 else {}
+    streams = info.get('streams', [])
+
+    if len(streams) == 0:
+        raise Exception("File is not a valid image or video")
+
+    stream = streams[0]
+    (width, height) = (int(stream.get('width', 0)), int(stream.get('height', 0)))
+
+    # The header can be found even if there is no image data
+    if width <= 0 or height <= 0:
+        raise Exception("File is not a valid image or video")
+
+    # Videos from phones are often stored sideways, with the rotation applied when they are decoded
+    rotation = stream.get('tags', {}).get('rotate')
+
+    for side_data in stream.get('side_data_list', []):
+        rotation = side_data.get('rotation', rotation)
+
+    if rotation is not None and abs(int(float(rotation))) % 180 == 90:
+        (width, height) = (height, width)
+
+    # Not every container stores these
+    frames = stream.get('nb_read_packets', stream.get('nb_frames'))
+    duration = stream.get('duration', info.get('format', {}).get('duration'))
+
+    return {
+        'width': width,
+        'height': height,
+        'frames': int(frames) if frames not in (None, 'N/A') else None,
+        'duration': float(duration) if duration not in (None, 'N/A') else None,
+        'codec': stream.get('codec_name'),
+        'mime': get_mimetype(path)
+    }
+
+# The probes of the most recent files, so that validation, the derivatives and the automations don't probe them again
+__probes = {}
+__probes_lock = threading.Lock()
+
+def probe_content(path : str, count_frames : bool = False) -> dict:
+    """Reads the width, height, frame count, duration, codec and mimetype of an image or video from its headers, without decoding it"""
+
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+
+    # The file may have changed since it was last probed
+    key = (path, stat.st_size, stat.st_mtime_ns, count_frames)
+
+    with __probes_lock:
+        content = __probes.get(key)
+
+    if content is None:
+        content = __probe(path, count_frames)
+
+        with __probes_lock:
+            # Forget the oldest probe
+            if len(__probes) >= homebooru.settings.BOORU_PROBE_CACHE_SIZE:
+                __probes.pop(next(iter(__probes)))
+
+            __probes[key] = content
+
+    return dict(content, size=stat.st_size)
+
+def check_content_limits(content : dict) -> None:
+    """Raises ContentTooLarge if the probed content is over the configured limits, so that it is never decoded"""
+
+    max_pixels = homebooru.settings.BOORU_MAX_PIXELS
+
+    if max_pixels > 0 and content['width'] * content['height'] > max_pixels:
+        raise ContentTooLarge(f"Content is too large ({content['width']}x{content['height']})")
+
+    max_file_size = homebooru.settings.BOORU_MAX_FILE_SIZE
+
+    if max_file_size > 0 and content['size'] > max_file_size:
+        raise ContentTooLarge(f"File is too large ({content['size']} bytes)")
+
+def check_decodable(path : str) -> None:
+    """Raises an exception if the content can't be decoded, only decoding its first frame so that it is cheap for videos too"""
+
+    result = ffmpegio.path.ffmpeg(
+        ['-v', 'error', '-xerror', '-i', str(path), '-frames:v', '1', '-f', 'null', '-'],
+        capture_output=True,
+        text=True
+    )
+
+    if result.returncode != 0:
+        raise Exception("File could not be decoded: " + result.stderr.strip()[:200])
 
 def get_content_dimensions(path : str) -> (int, int):
     """Gets the dimensions of an image or video"""
@@ -42,14 +304,19 @@ def get_content_dimensions(path : str) -> (int, int):
     # Make the file path absolute
     file_path = file_path.resolve()
 
-    # Use ffmpeg to get the dimensions
-    pixels = ffmpegio.image.read(str(file_path), show_log=__SHOW_LOG)
-
-    # get the dimensions
-    (height, width) = pixels.shape[:2]
+    # Only the header is read, rather than decoding every pixel
+    content = probe_content(file_path)
 
     # Make it the right way round!
-    return (width, height)
+    return (content['width'], content['height'])
+
+def get_thumbnail_options() -> dict:
+    """Gets the ffmpeg options of a thumbnail (i.e. a new image with the resolution of ?x150)"""
+    return {"vf": "scale=-1:150", "vframes": "1", "compression_level": homebooru.settings.BOORU_DERIVATIVE_COMPRESSION_LEVEL}
+
+def get_sample_options() -> dict:
+    """Gets the ffmpeg options of a sample"""
+    return {"vf": f"scale={homebooru.settings.BOORU_SAMPLE_WIDTH}:-1", "vframes": "1", "compression_level": homebooru.settings.BOORU_DERIVATIVE_COMPRESSION_LEVEL}
 
 def rescale_image(path : str, save_path : str, scale_arg : str) -> None:
     ffmpegio.transcode(path, save_path, overwrite=True, show_log=__SHOW_LOG, **{"vf": f"scale={scale_arg}", "vframes": "1"})
@@ -68,8 +335,8 @@ def generate_thumbnail(path : str, save_path : str) -> bool:
     file_path = file_path.resolve()
     file_save_path = file_save_path.resolve()
 
-    # Use ffmpeg to generate the thumbnail (i.e. create a new image with the resolution of ?x150)
-    rescale_image(file_path, file_save_path, "-1:150")
+    # Use ffmpeg to generate the thumbnail
+    ffmpegio.transcode(str(file_path), str(file_save_path), overwrite=True, show_log=__SHOW_LOG, **get_thumbnail_options())
     
     return True
 
@@ -90,15 +357,68 @@ def generate_sample(path : str, save_path : str) -> bool:
     # Get the dimensions of the file
     (width, height) = get_content_dimensions(file_path)
 
-    # If the width is over 850px, then generate a sample
-    if width <= 850:
+    # If the width is over the sample width, then generate a sample
+    if width <= homebooru.settings.BOORU_SAMPLE_WIDTH:
         return False
 
     # Rescale the image
-    rescale_image(file_path, file_save_path, "850:-1")
+    ffmpegio.transcode(str(file_path), str(file_save_path), overwrite=True, show_log=__SHOW_LOG, **get_sample_options())
     
     return True
 
+def generate_derivatives(path : str, thumbnail_path : str, sample_path : str = None, content : dict = None) -> dict:
+    """Probes a post (unless it already has been) and generates its thumbnail and sample (if it needs one), decoding it only once
+
+    Returns the width, height, whether a sample was made and how long each stage took (in seconds)."""
+
+    # Make sure that the file exists
+    file_path = pathlib.Path(path)
+
+    if not file_path.exists():
+        raise Exception("File does not exist")
+
+    file_path = file_path.resolve()
+
+    timings = {}
+
+    # Read the dimensions from the header
+    if content is None:
+        start = time.perf_counter()
+        content = probe_content(file_path)
+        timings['probe'] = time.perf_counter() - start
+
+    # Never decode anything too large
+    check_content_limits(content)
+
+    (width, height) = (content['width'], content['height'])
+
+    # Each output filters its own copy of the decoded frame, so a single ffmpeg process makes all of them
+    outputs = [(str(pathlib.Path(thumbnail_path).resolve()), get_thumbnail_options())]
+
+    sampled = sample_path is not None and width > homebooru.settings.BOORU_SAMPLE_WIDTH
+    if sampled:
+        outputs.append((str(pathlib.Path(sample_path).resolve()), get_sample_options()))
+
+    start = time.perf_counter()
+
+    try:
+        ffmpegio.transcode(str(file_path), outputs, overwrite=True, show_log=__SHOW_LOG)
+    except Exception:
+        # Don't leave any half written outputs behind
+        for output_path, options in outputs:
+            pathlib.Path(output_path).unlink(missing_ok=True)
+
+        raise
+
+    timings['derivatives'] = time.perf_counter() - start
+
+    return {
+        'width': width,
+        'height': height,
+        'sample': sampled,
+        'timings': timings
+    }
+
 def wildcard_to_regex(phrase : str, wildcard : str = '*') -> str:
     """Converts a wildcard to a regex"""
     r = phrase
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from booru.models.tags import Tag
+
+class Command(BaseCommand):
+    help = 'Rebuilds the post count of every tag'
+
+    def handle(self, *args, **options):
+        # Recount all of the tags in one query
+        total = Tag.recount()
+
+        # Say that we're done
+        self.stdout.write(self.style.SUCCESS('Successfully recounted %d tags' % total))
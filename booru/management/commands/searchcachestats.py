@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from booru.models.posts_search_cache import SearchCache
+
+class Command(BaseCommand):
+    help = 'Shows the hit and miss metrics of the search cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the metrics after showing them')
+
+    def handle(self, *args, **options):
+        # Get the metrics
+        stats = SearchCache.stats()
+
+        self.stdout.write('Hits: %d' % stats['hits'])
+        self.stdout.write('Misses: %d' % stats['misses'])
+        self.stdout.write('Hit rate: %.1f%%' % (stats['hit_rate'] * 100))
+
+        # Start counting again
+        if options['reset']:
+            SearchCache.reset_stats()
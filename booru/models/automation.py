@@ -12,9 +12,21 @@ class TagAutomationRecord(models.Model):
     # The date the record was created
     performed = models.DateTimeField(auto_now_add=True)
 
+    # The automations could not be performed on the post (e.g. it is corrupt), it is tried again once the automations change
+    failed = models.BooleanField(default=False)
+
     def __str__(self):
         return f"{self.post} @ State {self.state_hash}"
 
+    @staticmethod
+    def get_pending_posts(state_hash : str) -> models.QuerySet:
+        """Gets the posts that haven't had the automations with the given state performed on them"""
+
+        # A single anti-join, which uses the (post, state_hash) index
+        records = TagAutomationRecord.objects.filter(post=models.OuterRef('pk'), state_hash=state_hash)
+
+        return Post.objects.filter(~models.Exists(records))
+
     # The post must be unique
     class Meta:
         unique_together = ('post', 'state_hash')
@@ -32,8 +44,23 @@ class RatingThreshold(models.Model):
     threshold = models.FloatField()
 
     @staticmethod
-    def get_rating(nsfw_probability : float):
-        """Returns the rating for the given NSFW probability."""
+    def get_all() -> list:
+        """Returns every threshold in one query, so that they can be reused for a batch of posts."""
+
+        return list(RatingThreshold.objects.select_related('rating').order_by('pk'))
+
+    @staticmethod
+    def get_rating(nsfw_probability : float, thresholds : list = None, default : Rating = None):
+        """Returns the rating for the given NSFW probability (using the given thresholds and default rating, if there are any)."""
+
+        # Use the thresholds that were already fetched
+        if thresholds is not None:
+            matching = [threshold for threshold in thresholds if threshold.threshold <= nsfw_probability]
+
+            if len(matching) == 0:
+                return default or Rating.get_default()
+
+            return max(matching, key=lambda threshold: threshold.threshold).rating
 
         # Get all the thresholds that are less than or equal to the given probability
         rating_thresholds = RatingThreshold.objects.filter(threshold__lte=nsfw_probability)
@@ -64,6 +91,15 @@ class NSFWAutomationRecord(models.Model):
     # The date the record was created
     performed = models.DateTimeField(auto_now_add=True)
 
+    # The post could not be scanned (e.g. it is corrupt), so it is left as 0 like unreadable images are
+    failed = models.BooleanField(default=False)
+
+    @staticmethod
+    def get_pending_posts() -> models.QuerySet:
+        """Gets the posts that haven't been scanned yet"""
+
+        return Post.objects.filter(~models.Exists(NSFWAutomationRecord.objects.filter(post=models.OuterRef('pk'))))
+
     def get_rating(self):
         """Returns the rating for this record."""
 
@@ -1,11 +1,20 @@
 import django.db.models as models
+from django.db import connection, transaction
+from django.core.cache import cache
 
 from .tags import Tag
 from .posts import Post
+from .posts_search_cache import SearchCache
+
+import homebooru.settings
+
+import collections
+import threading
+import uuid
 
 class Implication(models.Model):
     """An implication between two tags."""
-    
+
     # The parent tag as a string
     parent = models.CharField(max_length=255)
 
@@ -15,8 +24,8 @@ class Implication(models.Model):
     @property
     def is_usable(self):
         """Is this implication usable - i.e., does the parent tag exist?"""
-        return Tag.objects.filter(tag=self.parent).exists() 
-    
+        return Tag.objects.filter(tag=self.parent).exists()
+
     def apply(self) -> int:
         """Applies the implication to all current posts, returning the number of posts affected."""
 
@@ -24,35 +33,435 @@ class Implication(models.Model):
         if not self.is_usable:
             return 0
 
-        # Select all posts that have the parent tag
-        posts = Post.objects.filter(tags__tag=self.parent)
-        # If there are no posts, return 0
-        if posts.count() == 0:
-            return 0
-
-        # Select the posts that do not have the child tag
-        posts = posts.exclude(tags__tag=self.child)
-        # Verify that there are posts
-        if posts.count() == 0:
+        # Only create the child tag if there is a post that needs it
+        posts = Post.objects.filter(tags__tag=self.parent).exclude(tags__tag=self.child)
+        if not posts.exists():
             return 0
 
         # Create the child tag
-        child_tag = Tag.create_or_get(tag=self.child)
+        Tag.create_or_get(tag=self.child)
+
+        # Add the child tag to all of the posts in one statement
+        return ImplicationClosure.insert_missing(
+            'SELECT %s AS parent, %s AS child',
+            [self.parent, self.child]
+        )
+
+    @staticmethod
+    def get_graph(implications = None) -> dict:
+        """Gets the children of each parent tag"""
+
+        if implications is None:
+            implications = Implication.objects.values_list('parent', 'child')
+
+        graph = collections.defaultdict(set)
+
+        for parent, child in implications:
+            # A tag always implies itself, there is nothing to do
+            if parent == child:
+                continue
+
+            graph[parent].add(child)
+
+        return graph
+
+    @staticmethod
+    def find_cycles(graph : dict) -> list:
+        """Finds the cycles in the implication graph, returning a list of the tags in each one"""
+
+        # Tarjan's strongly connected components (iterative, since the graph can be very deep)
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        cycles = []
+
+        counter = 0
+
+        for root in list(graph.keys()):
+            if root in index:
+                continue
+
+            # Each frame is a node and the iterator over its children
+            work = [(root, iter(graph.get(root, ())))]
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack.add(root)
+
+            while len(work) > 0:
+                node, children = work[-1]
+
+                for child in children:
+                    if child not in index:
+                        index[child] = low[child] = counter
+                        counter += 1
+                        stack.append(child)
+                        on_stack.add(child)
+
+                        work.append((child, iter(graph.get(child, ()))))
+                        break
+
+                    if child in on_stack:
+                        low[node] = min(low[node], index[child])
+                else:
+                    # All of the children have been visited
+                    work.pop()
+
+                    if len(work) > 0:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+
+                    # The node is the root of a component
+                    if low[node] == index[node]:
+                        component = []
+
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+
+                            if member == node:
+                                break
+
+                        if len(component) > 1:
+                            cycles.append(sorted(component))
+
+        return cycles
+
+    @staticmethod
+    def get_implied(graph : dict, tag : str) -> dict:
+        """Gets every tag that the tag implies (directly or not) and how many implications away it is"""
+
+        depths = {}
+        level = [tag]
+        depth = 0
+
+        # Breadth first, so each tag is found at its shortest depth and cycles end when there is nothing new
+        while len(level) > 0:
+            depth += 1
+            next_level = []
+
+            for current in level:
+                for child in graph.get(current, ()):
+                    if child == tag or child in depths:
+                        continue
+
+                    depths[child] = depth
+                    next_level.append(child)
 
-        # Add the child tag to all the posts
-        for post in posts:
-            # Add the child tag
-            post.tags.add(child_tag)
+            level = next_level
 
-            # Update the post
-            post.save()
+        return depths
 
-        # TODO Should we recursively apply the implication?
-        return len(posts)
+    @staticmethod
+    def get_closure(graph : dict) -> dict:
+        """Gets the implied tags of every parent in the graph"""
+
+        return {parent: Implication.get_implied(graph, parent) for parent in list(graph.keys())}
+
+    def save(self, *args, **kwargs):
+        """Saves the implication, making sure that it doesn't create a cycle."""
+
+        if self.parent == self.child:
+            raise ValueError('A tag cannot imply itself')
+
+        # Check if the parent can already be reached from the child, only reading the implications that can be reached (a level at a time)
+        others = Implication.objects.exclude(pk=self.pk)
+
+        seen = set()
+        level = {self.child}
+
+        while len(level) > 0:
+            if self.parent in level:
+                raise ValueError('The implication would create a cycle')
+
+            seen.update(level)
+            level = set(others.filter(parent__in=level).values_list('child', flat=True)) - seen
+
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.parent} -> {self.child}"
-    
+
     class Meta:
         # The plural name is "Implications"
-        verbose_name_plural = "Implications"
\ No newline at end of file
+        verbose_name_plural = "Implications"
+
+class ImplicationClosure(models.Model):
+    """Every tag that a tag implies, directly or through other implications (compiled from the implications)."""
+
+    parent = models.CharField(max_length=255)
+    child = models.CharField(max_length=255)
+
+    # How many implications away the child is
+    depth = models.IntegerField(default=1)
+
+    class Meta:
+        unique_together = ('parent', 'child')
+
+    # Changed whenever the implications change, so that each process reloads its copy of the closure
+    version_key = 'booru-implications-version'
+
+    # The highest post id that has been checked by the last sweep
+    watermark_key = 'booru-implications-watermark'
+
+    # This process's copy of the closure and the version it was loaded at
+    __map = {}
+    __version = None
+
+    def __str__(self):
+        return f"{self.parent} -> {self.child} ({self.depth})"
+
+    @staticmethod
+    def get_map() -> dict:
+        """Gets the tags implied by each parent, only reading the closure when the implications have changed"""
+
+        version = cache.get(ImplicationClosure.version_key)
+
+        if version is None:
+            # Another process may have set it first
+            cache.add(ImplicationClosure.version_key, uuid.uuid4().hex, None)
+            version = cache.get(ImplicationClosure.version_key)
+
+        if version != ImplicationClosure.__version:
+            implied = collections.defaultdict(set)
+
+            for parent, child in ImplicationClosure.objects.values_list('parent', 'child'):
+                implied[parent].add(child)
+
+            ImplicationClosure.__map = dict(implied)
+            ImplicationClosure.__version = version
+
+        return ImplicationClosure.__map
+
+    @staticmethod
+    def get_implied_tags(tags : list) -> set:
+        """Gets every tag implied by the given tags, without the tags themselves"""
+
+        implied_map = ImplicationClosure.get_map()
+
+        # Nothing to look up
+        if len(implied_map) == 0:
+            return set()
+
+        tags = set(tags)
+        implied = set()
+
+        for tag in tags:
+            implied.update(implied_map.get(tag, ()))
+
+        return implied - tags
+
+    @staticmethod
+    def invalidate():
+        """Makes every process reload the closure and the next sweep check every post"""
+
+        def bump():
+            cache.set(ImplicationClosure.version_key, uuid.uuid4().hex, None)
+            cache.delete(ImplicationClosure.watermark_key)
+
+        # Change it now and once the transaction is committed, so that a copy read before the commit is not kept
+        bump()
+        transaction.on_commit(bump)
+
+    @staticmethod
+    def compile() -> list:
+        """Rebuilds the closure from the implications if they have changed, returning any cycles that were found."""
+
+        graph = Implication.get_graph()
+
+        # Cycles are allowed in the closure (each tag implies the others), but they are reported
+        cycles = Implication.find_cycles(graph)
+
+        rows = set(
+            (parent, child, depth)
+            for parent, children in Implication.get_closure(graph).items()
+            for child, depth in children.items()
+        )
+
+        # Nothing to do if the implications haven't changed since the last time
+        if rows == set(ImplicationClosure.objects.values_list('parent', 'child', 'depth')):
+            return cycles
+
+        with transaction.atomic():
+            ImplicationClosure.objects.all().delete()
+            ImplicationClosure.objects.bulk_create(
+                [ImplicationClosure(parent=parent, child=child, depth=depth) for parent, child, depth in rows],
+                batch_size=homebooru.settings.BOORU_IMPLICATION_BATCH_SIZE
+            )
+
+        ImplicationClosure.invalidate()
+
+        return cycles
+
+    @staticmethod
+    def insert_missing(closure_sql : str, params : list, post_range : tuple = None) -> int:
+        """Adds the children of the closure rows to every post with their parent that is missing them, returning the number of posts affected."""
+
+        through = Post.tags.through
+        quote = connection.ops.quote_name
+
+        post_tags = quote(through._meta.db_table)
+        tags = quote(Tag._meta.db_table)
+
+        where = ''
+        if post_range is not None:
+            where = 'AND pt.post_id >= %s AND pt.post_id < %s'
+            params = params + list(post_range)
+
+        # The children are only added if they exist, and each row is only added once
+        sql = f'''
+            INSERT INTO {post_tags} (post_id, tag_id)
+            SELECT DISTINCT pt.post_id, c.child
+            FROM {post_tags} pt
+            JOIN ({closure_sql}) c ON c.parent = pt.tag_id
+            JOIN {tags} t ON t.tag = c.child
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {post_tags} existing
+                WHERE existing.post_id = pt.post_id AND existing.tag_id = c.child
+            ) {where}
+            ON CONFLICT DO NOTHING
+            RETURNING post_id, tag_id
+        '''
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+        if len(rows) == 0:
+            return 0
+
+        # The rows were inserted without the m2m signals, so the counts and the cache are updated here
+        counts = collections.Counter(tag for (post, tag) in rows)
+
+        by_count = collections.defaultdict(list)
+        for tag, count in counts.items():
+            by_count[count].append(tag)
+
+        for count, tag_names in by_count.items():
+            Tag.objects.filter(pk__in=tag_names).update(post_count=models.F('post_count') + count)
+
+        SearchCache.invalidate(counts.keys())
+
+        return len(set(post for (post, tag) in rows))
+
+    @staticmethod
+    def apply_all(first : int = None, last : int = None) -> int:
+        """Applies the compiled closure to the posts (between the given ids), a batch of posts at a time, returning the number of posts affected."""
+
+        # Create the child tags that don't exist yet, only if their parent is on a post
+        children = ImplicationClosure.objects \
+            .filter(parent__in=Post.tags.through.objects.values('tag_id')) \
+            .exclude(child__in=Tag.objects.values('tag')) \
+            .values_list('child', flat=True) \
+            .distinct()
+
+        Tag.create_or_get_many(list(children))
+
+        bounds = Post.objects.aggregate(first=models.Min('id'), last=models.Max('id'))
+
+        if bounds['first'] is None:
+            return 0
+
+        first = max(first or bounds['first'], bounds['first'])
+        last = min(last or bounds['last'], bounds['last'])
+
+        batch_size = homebooru.settings.BOORU_IMPLICATION_BATCH_SIZE
+        closure_table = connection.ops.quote_name(ImplicationClosure._meta.db_table)
+
+        total = 0
+
+        # Since the closure is transitive, a single pass adds every implied tag
+        for start in range(first, last + 1, batch_size):
+            with transaction.atomic():
+                total += ImplicationClosure.insert_missing(
+                    f'SELECT parent, child FROM {closure_table}',
+                    [],
+                    (start, min(start + batch_size, last + 1))
+                )
+
+        return total
+
+    @staticmethod
+    def sweep() -> int:
+        """Applies the closure to the posts created since the last sweep (or all of them if the implications changed), returning the number of posts affected."""
+
+        # Tags added to posts are expanded when they are written, so this only catches the posts that were missed
+        watermark = cache.get(ImplicationClosure.watermark_key) or 0
+        last = Post.objects.aggregate(last=models.Max('id'))['last']
+
+        if last is None or last <= watermark:
+            return 0
+
+        total = ImplicationClosure.apply_all(first=watermark + 1, last=last)
+
+        cache.set(ImplicationClosure.watermark_key, last, None)
+
+        return total
+
+# Hook into the implications and post tags to keep the closure compiled and expand the tags when they are written
+from django.db.models.signals import m2m_changed, post_save, post_delete
+
+# Set while the implied tags are being added, the closure is transitive so they never need expanding again
+_expanding = threading.local()
+
+# Counts the changes to the implications (registered) and the last change that the closure was compiled after (compiled)
+_compiling = threading.local()
+
+def compile_closure(change : int):
+    """Recompiles the closure once the implications have been committed, unless it has already been compiled since the change."""
+
+    if change <= getattr(_compiling, 'compiled', 0):
+        return
+
+    # Every change registered so far has been committed with this one
+    registered = _compiling.registered
+
+    ImplicationClosure.compile()
+
+    _compiling.compiled = registered
+
+def implication_changed(sender, instance, **kwargs):
+    """Recompiles the closure once the transaction that changed the implications is committed."""
+
+    # Fixtures are loaded a row at a time, the periodic task compiles them
+    if kwargs.get('raw', False):
+        return
+
+    # Each change registers its own callback so that a rolled back transaction (or savepoint) only drops its own changes,
+    # whichever callback runs first compiles for all of them and the rest do nothing
+    _compiling.registered = getattr(_compiling, 'registered', 0) + 1
+
+    change = _compiling.registered
+    transaction.on_commit(lambda: compile_closure(change))
+
+def post_tags_implied(sender, instance, action, reverse, pk_set, **kwargs):
+    """Adds the tags implied by the tags that were just added to posts, in the same transaction."""
+
+    if action != 'post_add' or not pk_set or getattr(_expanding, 'active', False):
+        return
+
+    # The instance is the post and the pk set contains the tags, otherwise the other way around
+    implied = ImplicationClosure.get_implied_tags(list(pk_set) if not reverse else [instance.pk])
+
+    if len(implied) == 0:
+        return
+
+    _expanding.active = True
+
+    try:
+        tags = Tag.create_or_get_many(sorted(implied))
+
+        if not reverse:
+            instance.tags.add(*tags)
+        else:
+            for tag in tags:
+                tag.posts.add(*pk_set)
+    finally:
+        _expanding.active = False
+
+# Connect the signals
+post_save.connect(implication_changed, sender=Implication)
+post_delete.connect(implication_changed, sender=Implication)
+m2m_changed.connect(post_tags_implied, sender=Post.tags.through)
@@ -1,9 +1,12 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import m2m_changed, pre_delete, post_save
 from django.contrib.auth.models import User
 from django.apps import apps
 
 from .tags import Tag, TagType
 from .posts_search_criteria import *
+from .posts_search_compiler import SearchCompiler
+from .posts_search_cache import SearchCache
 
 import homebooru.settings as settings
 import booru.boorutils as boorutils
@@ -11,8 +14,12 @@ from booru.pagination import Paginator
 
 import math
 import pathlib
-import shutil
 import re
+import shutil
+import time
+import logging
+
+logger = logging.getLogger(__name__)
 
 class Rating(models.Model):
     # Name of the rating, this will be the primary key
@@ -82,6 +89,41 @@ class Post(models.Model):
     # Post locked
     locked = models.BooleanField(default=False)
 
+    # The media is stored but the thumbnail and sample are still being generated (by a task)
+    STATUS_PROCESSING = 'processing'
+
+    # The post is ready to be viewed
+    STATUS_READY = 'ready'
+
+    # The thumbnail and sample could not be generated
+    STATUS_FAILED = 'failed'
+
+    STATUSES = [
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_READY, 'Ready'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    # Whether the post's derivatives have been generated
+    status = models.CharField(max_length=16, choices=STATUSES, default=STATUS_READY)
+
+    # The fields that can be searched for (see SearchCompiler.accepted_params), changing any other field doesn't change the search results
+    SEARCH_FIELDS = ['md5', 'rating_id', 'title', 'width', 'height', 'owner_id']
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+
+        # Remember the searched values so that saving can tell if they have changed
+        instance._search_values = instance.get_search_values()
+
+        return instance
+
+    def get_search_values(self) -> dict:
+        """Gets the values of the fields that can be searched for, deferred fields are left out"""
+
+        return {field: self.__dict__[field] for field in Post.SEARCH_FIELDS if field in self.__dict__}
+
     def __str__(self):
         tags = self.tags.all().values_list('tag', flat=True)
         tags = ' '.join(tags)
@@ -125,155 +167,73 @@ class Post(models.Model):
         super(Post, self).delete(*args, **kwargs)
 
     @staticmethod
-    def search(search_phrase, wild_card="*"):
+    def search(search_phrase, wild_card="*", use_cache=True):
         """Search for posts that match a user entered search phrase"""
 
-        search_criteria = [] 
-
-        # Split the search phrase into words
-        words = search_phrase.split()
-
-        # List of accepted parameters
-        accepted_params = {
-            'md5': str,
-            'rating': str,
-            'title': str,
-            'width': int,
-            'height': int,
-            'user': int
-        }
+        # Parse the phrase into criteria and build them into one query
+        compiler = SearchCompiler(search_phrase, wild_card=wild_card)
 
-        # For each word, check if it is a tag
-        for word in words:
-            # Strip the word of spaces
-            word = word.strip()
+        # Use the cached results if we can
+        if use_cache and settings.BOORU_SEARCH_CACHE_ENABLED:
+            return SearchCache.search(compiler, Post.objects.all())
 
-            # If the word starts with a '-', it is an exclusion
-            should_exclude = word[0] == '-'
+        return compiler.compile(Post.objects.all())
 
-            # If it is an exclusion, strip the '-'
-            if should_exclude:
-                word = word[1:]
-            
-            # Make sure that it isn't empty
-            if len(word) == 0:
-                continue
-            
-            potential_param = word.split(':')[0]
-            # Handle parameter tags
-            if potential_param in accepted_params:
-                expected_type = accepted_params[potential_param]
-
-                # Get the value of the parameter
-                val = word[len(potential_param) + 1:]
-
-                # Make sure that the value is of the correct type
-                try:
-                    val = expected_type(val)
-                except Exception:
-                    if not should_exclude:
-                        # They wouldn't find anything if the value is wrong
-                        return Post.objects.none()
-                    
-                    # If it is an exclusion, just continue as this would have had no effect
-                    continue
-
-                # Handle the user case
-                if potential_param == 'user':
-                    # Add the user to the search criteria
-                    search_criteria.append(SearchCriteriaExcludeUser(val) if should_exclude else SearchCriteriaUser(val))
-
-                    continue
-                
-                # Handle the generic cases
-                search_criteria.append(
-                    SearchCriteriaExcludeParameter(potential_param, val) if should_exclude else SearchCriteriaParameter(potential_param, val)
-                )
+    @staticmethod
+    def get_search_tags(search_result = models.QuerySet(), depth = 512, sort_by = None, reverse : bool = None):
+        """Get the tags from a search result"""
 
-                continue
+        # Only look at the first few posts of the search result
+        posts = search_result[:depth]
 
-            # Handle wild cards
-            if wild_card in word:
-                r = boorutils.wildcard_to_regex(word, wild_card)
+        # Get the ids of the posts, a query set can be used as a sub query
+        if isinstance(posts, models.QuerySet):
+            post_ids = posts.values('pk')
+        else:
+            post_ids = [post.pk for post in posts]
 
-                # Get all of the tags where their names match the regex
-                tags = Tag.objects.filter(tag__regex=r)
+        # Get every tag used by the posts in a single query (the post counts are stored on the tag)
+        tags = Tag.objects.filter(
+            tag__in=Post.tags.through.objects.filter(post_id__in=post_ids).values('tag_id')
+        ).select_related('tag_type')
 
-                # Add the search criteria
-                search_criteria.append(SearchCriteriaExcludeWildCardTags(tags) if should_exclude else SearchCriteriaWildCardTags(tags))
+        # Custom sort functions cannot be done by the database
+        if callable(sort_by):
+            # Default the reverse to the default sort
+            if reverse is None:
+                reverse = Post.get_search_tags_lambda()[1]
 
-                # TODO This is kinda bad because this could cause a lot of queries, maybe consider putting a limit on it or something
-                continue
-            
-            # Handle normal tag case
-            # Get the tag by name or if it doesn't exist, make it none
-            tag = Tag.objects.filter(tag=word).first()
+            return sorted(tags, key=sort_by, reverse=reverse)
 
-            # If the tag doesn't exist, return an empty query set
-            if tag is None:
-                return Post.objects.none()
-            
-            # Add the criteria to the list
-            search_criteria.append(SearchCriteriaExcludeTag(tag) if should_exclude else SearchCriteriaTag(tag))
-        
-        # These will be the results of the search
-        results = Post.objects.all()
-
-        # Go over each of the criteria filter the results
-        for criteria in search_criteria:
-            # If everything is gone then we can stop
-            if results.count() == 0:
-                return results
-            
-            results = criteria.search(results)
+        # Get the ordering for the sort mode
+        ordering, default_reverse = Post.get_search_tags_ordering(sort_by)
+        tags = tags.order_by(*ordering)
 
-        # Sort the results by their id in descending order
-        results = results.order_by('-id')
+        # Flip the order if asked to sort the other way
+        if reverse is not None and reverse != default_reverse:
+            tags = tags.reverse()
 
-        return results
+        # Return the tags
+        return tags
 
     @staticmethod
-    def get_search_tags(search_result = models.QuerySet(), depth = 512, sort_by = None, reverse : bool = None):
-        """Get the tags from a search result"""
-
-        # ================================
-        # Search result should be a query set of posts
-        # Get all of the tags from the posts, each post will have many tags
-        # tags = search_result.values_list('tags', flat=True)
-
-        # You see you'd like to think that the top solution would work but it doesn't
-        # ================================
-
-        default_sort_by, default_reverse = Post.get_search_tags_lambda()
+    def get_search_tags_ordering(sort_by : str = None):
+        """Get the database ordering to be used for the `get_search_tags` function"""
 
         # Check if the sort_by is a valid value
         if sort_by is None:
-            sort_by = default_sort_by
-        
-        # Check if the reverse is a valid value
-        if reverse is None:
-            reverse = default_reverse
-
-        # Create a new empty query set
-        tags = {}
-
-        for post in search_result[:depth]:
-            for tag in post.tags.all():
-                tags[tag.tag] = tag
-
-        # Generate a tuple of the tag and the value of the sort by function
-        # This way, if it is something like total posts, the value will only be calculated once per tag (i.e. it will be cached and not recalculated)
-        val_tags = [(tag, sort_by(tag)) for tag in tags.values()]
+            # Default it to the value of the setting
+            sort_by = settings.BOORU_BROWSE_TAGS_SORT
 
-        # Sort the tags by the value of the sort by function
-        val_tags.sort(key=lambda x: x[1], reverse=reverse)
+        # Create a dictionary of the sort by options (the tag name breaks any ties)
+        sort_by_options = {
+            'total': (['-post_count', 'tag'], True),
+            'name': (['tag'], False)
+        }
 
-        # Create a new list of just the tags
-        tags = [tag for tag, val in val_tags]
+        # Return the ordering and if it is reversed
+        return sort_by_options[sort_by]
 
-        # Return the tags
-        return tags
-    
     @staticmethod
     def get_search_tags_lambda(sort_by : str = None):
         """Get the lambda to be used for the `get_search_tags` function"""
@@ -332,6 +292,93 @@ class Post(models.Model):
     def media_url(self):
         return f"media/{self.folder}/{self.filename}"
 
+    @property
+    def is_ready(self):
+        return self.status == Post.STATUS_READY
+
+    def generate_derivatives(self, source_path : str = None, content : dict = None) -> dict:
+        """Generates the thumbnail and sample (videos don't get samples) from the post's media (or the given file), returning how long each stage took"""
+
+        sample_path = self.get_sample_path()
+        thumb_path = self.get_thumbnail_path()
+
+        # If these folders don't exist, create them
+        for p in [sample_path.parent, thumb_path.parent]:
+            p.mkdir(parents=True, exist_ok=True)
+
+        derivatives = boorutils.generate_derivatives(
+            str(source_path or self.get_media_path()),
+            str(thumb_path),
+            str(sample_path) if not self.is_video else None,
+            content=content
+        )
+
+        self.sample = derivatives['sample']
+
+        return derivatives['timings']
+
+    @staticmethod
+    def prepare_derivatives(file_path : str, directory : str, md5 : str) -> dict:
+        """Generates the thumbnail and sample of a file into a directory before its post exists, to be given to create_from_file
+
+        This does not touch the database, so it can be run in another thread."""
+
+        file_path = pathlib.Path(file_path)
+        directory = pathlib.Path(directory)
+
+        # Videos don't get samples
+        is_video = file_path.suffix.lstrip('.') in settings.BOORU_VIDEO_FILE_EXTENSIONS
+
+        # Named the same way as the post's own, so that they are kept apart from the others in the directory
+        thumb_path = directory / f"thumbnail_{md5}.png"
+        sample_path = directory / f"sample_{md5}.png"
+
+        derivatives = boorutils.generate_derivatives(
+            str(file_path),
+            str(thumb_path),
+            str(sample_path) if not is_video else None,
+            content=boorutils.probe_content(str(file_path))
+        )
+
+        return {
+            'thumbnail': thumb_path,
+            'sample': sample_path if derivatives['sample'] else None,
+            'timings': derivatives['timings']
+        }
+
+    def place_derivatives(self, derivatives : dict) -> dict:
+        """Moves the derivatives made by prepare_derivatives into the post's folders, returning how long it took to make them"""
+
+        for (source, destination) in [(derivatives['thumbnail'], self.get_thumbnail_path()), (derivatives['sample'], self.get_sample_path())]:
+            if source is None: continue
+
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(source), str(destination))
+
+        self.sample = derivatives['sample'] is not None
+
+        return derivatives['timings']
+
+    def process(self) -> bool:
+        """Generates the derivatives of a post that was stored without them, marking it as ready (or failed), returning whether it succeeded"""
+
+        try:
+            timings = self.generate_derivatives()
+        except Exception as e:
+            logger.warning('Could not generate the derivatives of post %s: %s', self.id, e)
+
+            self.status = Post.STATUS_FAILED
+            self.save(update_fields=['status'])
+
+            return False
+
+        logger.debug('Processed post %s in %s', self.id, ', '.join(f'{stage} {seconds:.3f}s' for stage, seconds in timings.items()))
+
+        self.status = Post.STATUS_READY
+        self.save(update_fields=['sample', 'status'])
+
+        return True
+
     @staticmethod
     def validate_file(file_path : str) -> bool:
         # Checking the file path
@@ -353,23 +400,26 @@ class Post(models.Model):
             file_extension = file_extension[1:]
 
         # Make sure that the file extension is valid
-        # TODO do deeper checks here
         if file_extension not in settings.BOORU_ALLOWED_FILE_EXTENSIONS:
             raise Exception("File extension is not valid")
+
+        # Make sure that the content can be read from its headers and isn't too large to decode (the probe is kept for creating the post)
+        boorutils.check_content_limits(boorutils.probe_content(str(file_path)))
         
         return True
 
     @staticmethod
-    def create_from_file(file_path : str, owner=None):
-        """Create a post from a file"""
+    def create_from_file(file_path : str, owner=None, process : bool = True, md5 : str = None, strategy : str = boorutils.IMPORT_COPY, derivatives : dict = None):
+        """Create a post from a file (without its thumbnail and sample if it isn't processed, which is left to Post.process)
+
+        The checksum can be given if it is already known, and the file can be linked or moved into the storage rather than copied (see boorutils.import_file).
+        Derivatives that were made ahead of time (see Post.prepare_derivatives) are moved into place rather than generated again."""
 
         # Get the file as a path
         file_path = pathlib.Path(file_path)
 
-        # Make sure that it is valid before doing anything else
+        # Make sure that it is valid before doing anything else (this also checks that it isn't too large)
         Post.validate_file(file_path)
-        
-        # TODO size check (i.e. dont kill the server with massive images - make this a setting)
 
         file_extension = file_path.suffix
         if file_extension[0] == '.':
@@ -378,52 +428,114 @@ class Post(models.Model):
         # Check if the item is a video
         is_video = file_extension in settings.BOORU_VIDEO_FILE_EXTENSIONS
 
-        # Get the file signature
-        md5 = boorutils.get_file_checksum(str(file_path))
-
-        # Get the content dimensions
-        (width, height) = boorutils.get_content_dimensions(str(file_path))
+        # Get the file signature (unless it was worked out while the file was received)
+        start = time.perf_counter()
+        md5 = md5.lower() if md5 is not None else boorutils.get_file_checksum(str(file_path))
+        timings = {'checksum': time.perf_counter() - start}
 
-        # Creating the post
-        # Get the folder to store the file in
-        folder = Post.get_next_folder()
-
-        # File paths
-        sample_path = settings.BOORU_STORAGE_PATH / f"samples/{folder}/sample_{md5}.png"
-        thumb_path  = settings.BOORU_STORAGE_PATH / f"thumbnails/{folder}/thumbnail_{md5}.png"
-        image_path  = settings.BOORU_STORAGE_PATH / f"media/{folder}/{md5}.{file_extension}"
-
-        # If these folders don't exist, create them
-        for p in [sample_path.parent, thumb_path.parent, image_path.parent]:
-            if p.exists(): continue
-            
-            p.mkdir(parents=True)
-
-        # Create the thumbnail
-        boorutils.generate_thumbnail(str(file_path), str(thumb_path))
+        # Get the content dimensions from the header (which was already read by the validation)
+        start = time.perf_counter()
+        content = boorutils.probe_content(str(file_path))
+        timings['probe'] = time.perf_counter() - start
 
-        # Create the sample
-        sampled = boorutils.generate_sample(str(file_path), str(sample_path)) if not is_video else False
+        (width, height) = (content['width'], content['height'])
 
-        # Copy the file to the image storage
-        try:
-            shutil.copy(str(file_path), str(image_path))
-        except Exception as e:
-            # Ignore if it is complaining about it already existing
-            pass
-
-        # Create the post
-        return Post(
+        # Creating the post
+        post = Post(
             md5=md5,
             owner=owner,
             width=width,
             height=height,
-            folder=folder,
-            sample=sampled,
+            folder=Post.get_next_folder(),
             filename=f"{md5}.{file_extension}",
-            is_video=is_video
+            is_video=is_video,
+            status=Post.STATUS_READY if process else Post.STATUS_PROCESSING
         )
+
+        if process and derivatives is not None:
+            # They were already made, so they only need moving
+            timings.update(post.place_derivatives(derivatives))
+        elif process:
+            # Create the thumbnail and sample from one decode
+            timings.update(post.generate_derivatives(file_path, content=content))
+        else:
+            # Make sure that it can be decoded now, rather than only finding out when it is processed
+            start = time.perf_counter()
+            boorutils.check_decodable(str(file_path))
+            timings['decode'] = time.perf_counter() - start
+
+        # Bring the file into the image storage (links and moves only cost a metadata operation on the same filesystem)
+        image_path = post.get_media_path()
+        image_path.parent.mkdir(parents=True, exist_ok=True)
+
+        start = time.perf_counter()
+
+        if strategy == boorutils.IMPORT_MOVE:
+            # Link (or copy) the file and only remove the original once the post is committed, so that it isn't lost if the post is rolled back
+            boorutils.import_file(str(file_path), str(image_path), boorutils.IMPORT_HARDLINK)
+            transaction.on_commit(lambda: file_path.unlink(missing_ok=True))
+        else:
+            strategy = boorutils.import_file(str(file_path), str(image_path), strategy)
+
+        timings['import'] = time.perf_counter() - start
+
+        logger.debug('Imported %s (%s) in %s', md5, strategy, ', '.join(f'{stage} {seconds:.3f}s' for stage, seconds in timings.items()))
+
+        # Keep how the file was imported, since it may have fallen back to a copy
+        post.import_strategy = strategy
+
+        # Keep how long each stage took, so that the callers can report it
+        post.timings = timings
+
+        return post
     
+    @staticmethod
+    def edit_tags(posts : list, add : list = [], remove : list = []) -> dict:
+        """Adds and removes tags on the posts in one transaction, only touching the rows that change"""
+
+        # Adding wins if a tag is in both
+        add = set(add)
+        remove = set(remove) - add
+
+        # Nothing to change
+        if len(add) == 0 and len(remove) == 0:
+            return {'added': [], 'removed': []}
+
+        with transaction.atomic():
+            # Tags that don't exist can't be removed, so only the added ones are created
+            add_tags = Tag.create_or_get_many(sorted(add))
+            remove_tags = list(Tag.objects.filter(tag__in=remove)) if len(remove) > 0 else []
+
+            if len(posts) == 1:
+                # Change the post's rows directly
+                post = posts[0]
+
+                if len(remove_tags) > 0:
+                    post.tags.remove(*remove_tags)
+
+                if len(add_tags) > 0:
+                    post.tags.add(*add_tags)
+            else:
+                # Change each tag's rows for all of the posts at once, so the queries depend on the number of tags rather than posts
+                for tag in remove_tags:
+                    tag.posts.remove(*posts)
+
+                for tag in add_tags:
+                    tag.posts.add(*posts)
+
+        return {
+            'added': [tag.tag for tag in add_tags],
+            'removed': [tag.tag for tag in remove_tags]
+        }
+
+    def set_tags(self, names : list) -> dict:
+        """Changes the post's tags to the given names, only adding and removing the ones that are different"""
+
+        current = set(self.tags.values_list('tag', flat=True))
+        names = set(names)
+
+        return Post.edit_tags([self], add=names - current, remove=current - names)
+
     def get_sorted_tags(self):
         """Gets the tags in a sorted manor"""
 
@@ -474,11 +586,29 @@ class Post(models.Model):
     def get_proximate_posts(self, search_results : models.QuerySet):
         """Get the posts that are proximate to this one"""
 
-        # Get the first result where the id is less than this one (i.e. it was added earlier)
-        older = search_results.filter(id__lt=self.id).first()
+        # Use the cached start of the results if the post is in it
+        cached = getattr(search_results, 'cached_results', None)
+
+        if cached is not None:
+            older_ids = cached.get_after(self.id, 1)
+            newer_ids = cached.get_before(self.id, 1)
+
+            # Both of the neighbours are in the cached ids, so they are fetched together
+            if older_ids is not None and newer_ids is not None:
+                rows = Post.objects.in_bulk(older_ids + newer_ids)
+
+                return {
+                    'older': rows.get(older_ids[0]) if len(older_ids) > 0 else None,
+                    'newer': rows.get(newer_ids[0]) if len(newer_ids) > 0 else None
+                }
+
+        # Both of these are ordered away from this post so that the database only has to read one row from the id index
+
+        # Get the closest result where the id is less than this one (i.e. it was added earlier)
+        older = search_results.filter(id__lt=self.id).order_by('-id').first()
 
-        # Get the second result where the id is greater than this one (i.e. it was added later)
-        newer = search_results.filter(id__gt=self.id).last()
+        # Get the closest result where the id is greater than this one (i.e. it was added later)
+        newer = search_results.filter(id__gt=self.id).order_by('id').first()
 
         # Return the results
         return {
@@ -533,4 +663,76 @@ class PostFlag(models.Model):
     
     class Meta:
         # Make sure that only one flag per user per post can exist
-        unique_together = ('post', 'user')
\ No newline at end of file
+        unique_together = ('post', 'user')
+
+
+# Hook into the post tags to keep the tag post counts (and cached searches) up to date
+def post_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Updates the post counts of the tags that were added to or removed from posts."""
+
+    # Removals are counted before they happen (in the same transaction) so that only the rows that actually exist are counted
+    if not reverse:
+        # The instance is the post and the pk set contains the tags
+        if action == 'post_add':
+            tags = pk_set
+            change = 1
+        elif action == 'pre_remove':
+            tags = sender.objects.filter(post_id=instance.pk, tag_id__in=pk_set).values_list('tag_id', flat=True)
+            change = -1
+        elif action == 'pre_clear':
+            tags = sender.objects.filter(post_id=instance.pk).values_list('tag_id', flat=True)
+            change = -1
+        else:
+            return
+
+        # Get the tags once, they are needed for the counts and the cache
+        tags = list(tags)
+
+        Tag.objects.filter(pk__in=tags).update(post_count=models.F('post_count') + change)
+        SearchCache.invalidate(tags)
+        return
+
+    # The instance is the tag and the pk set contains the posts
+    if action == 'post_add':
+        change = len(pk_set)
+    elif action == 'pre_remove':
+        change = -sender.objects.filter(tag_id=instance.pk, post_id__in=pk_set).count()
+    elif action == 'pre_clear':
+        change = -sender.objects.filter(tag_id=instance.pk).count()
+    else:
+        return
+
+    if change == 0:
+        return
+
+    Tag.objects.filter(pk=instance.pk).update(post_count=models.F('post_count') + change)
+    SearchCache.invalidate([instance.pk])
+
+    # Keep the instance in line with the database
+    instance.post_count += change
+
+def pre_delete_post(sender, instance, **kwargs):
+    """Removes the post from the post counts of its tags."""
+
+    tags = list(Post.tags.through.objects.filter(post_id=instance.pk).values_list('tag_id', flat=True))
+
+    Tag.objects.filter(pk__in=tags).update(post_count=models.F('post_count') - 1)
+    SearchCache.invalidate(tags)
+
+def post_save_post(sender, instance, created, **kwargs):
+    """Invalidates the cached searches that don't only depend on tags (e.g. ratings and exclusions), if the post could have changed their results."""
+
+    values = instance.get_search_values()
+    changed = created or getattr(instance, '_search_values', None) != values
+
+    # Remember the saved values for the next save
+    instance._search_values = values
+
+    # Other fields (e.g. the status or source) aren't searched for
+    if changed:
+        SearchCache.invalidate()
+
+# Connect the signals
+m2m_changed.connect(post_tags_changed, sender=Post.tags.through)
+pre_delete.connect(pre_delete_post, sender=Post)
+post_save.connect(post_save_post, sender=Post)
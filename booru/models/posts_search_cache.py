@@ -0,0 +1,224 @@
+from django.db import models, transaction
+from django.core.cache import cache
+
+from .posts_search_criteria import SearchCriteriaTags
+
+import homebooru.settings as settings
+
+import bisect
+import hashlib
+import uuid
+
+class CachedResults:
+    """The ids of the newest results of a search (up to BOORU_SEARCH_CACHE_MAX_RESULTS of them) along with the total number of results
+
+    It is attached to the results of a search (as cached_results) so that pages near the start can be served without running the search again."""
+
+    # The order of the ids
+    ordering = ['-id']
+
+    def __init__(self, qs : models.QuerySet, ids : list, total : int):
+        # Used to fetch the rows of the ids
+        self.qs = qs
+
+        self.ids = ids
+        self.total = total
+
+    @property
+    def complete(self) -> bool:
+        """Whether every result is cached"""
+
+        return len(self.ids) >= self.total
+
+    def get_slice(self, start : int, stop : int) -> list:
+        """Gets the ids from start to stop, or None if they go past the cached ids"""
+
+        if stop > len(self.ids) and not self.complete:
+            return None
+
+        return self.ids[start:stop]
+
+    def get_after(self, post_id : int, count : int) -> list:
+        """Gets the ids of (up to) count results after the given id, or None if they go past the cached ids"""
+
+        # The ids are in descending order
+        start = bisect.bisect_right(self.ids, -post_id, key=lambda id: -id)
+
+        return self.get_slice(start, start + count)
+
+    def get_before(self, post_id : int, count : int) -> list:
+        """Gets the ids of (up to) count results before the given id, or None if they go past the cached ids"""
+
+        end = bisect.bisect_left(self.ids, -post_id, key=lambda id: -id)
+
+        # There may be results between the last cached id and the given id
+        if end == len(self.ids) and not self.complete:
+            return None
+
+        return self.ids[max(0, end - count):end]
+
+    def get_rows(self, ids : list) -> list:
+        """Gets the posts with the given ids, in the same order"""
+
+        rows = self.qs.in_bulk(ids)
+
+        # Skip any that have been deleted since
+        return [rows[id] for id in ids if id in rows]
+
+class SearchCache:
+    """Caches the ordered post ids of search phrases"""
+
+    # Each tag has a version which is changed whenever a post with the tag is created, retagged or deleted
+    # The versions of a phrase's tags are part of its key, so changing one means that the old results are never looked up again
+
+    prefix = 'booru-search'
+
+    # Changed whenever any post changes, used by phrases that don't only depend on their tags
+    global_version_key = prefix + '-version'
+
+    # Metrics
+    hits_key = prefix + '-hits'
+    misses_key = prefix + '-misses'
+
+    @staticmethod
+    def normalize(search_phrase : str) -> str:
+        """Normalizes the search phrase so that phrases with the same words share the same results"""
+
+        # The order of the words does not change the results
+        return ' '.join(sorted(set(search_phrase.split())))
+
+    @staticmethod
+    def get_version_key(tag : str) -> str:
+        """Gets the key of the version for a tag"""
+
+        # Tags can contain any character, so hash them into a safe key
+        return SearchCache.prefix + '-tag-' + hashlib.md5(tag.encode()).hexdigest()
+
+    @staticmethod
+    def get_versions(keys : list) -> list:
+        """Gets the current versions for the given keys, creating any that are missing"""
+
+        versions = cache.get_many(keys)
+
+        for key in keys:
+            if key in versions:
+                continue
+
+            # A new version is never the same as one that was evicted, so old results can't be used by accident
+            cache.add(key, uuid.uuid4().hex, None)
+            versions[key] = cache.get(key)
+
+        return [versions[key] for key in keys]
+
+    @staticmethod
+    def get_key(compiler) -> str:
+        """Gets the key of the results for a compiled search phrase"""
+
+        # The phrase depends on every tag that it names
+        version_keys = [SearchCache.get_version_key(tag) for tag in sorted(compiler.required_tags)]
+
+        # Exclusions, wild cards, parameters and the empty phrase (every post) can change when any post does
+        if len(compiler.criteria) == 0 or any(type(criteria) is not SearchCriteriaTags for criteria in compiler.criteria):
+            version_keys.append(SearchCache.global_version_key)
+
+        parts = [compiler.wild_card, SearchCache.normalize(compiler.search_phrase)] + SearchCache.get_versions(version_keys)
+
+        return SearchCache.prefix + '-' + hashlib.md5('\n'.join(parts).encode()).hexdigest()
+
+    @staticmethod
+    def record(hit : bool):
+        """Counts a hit or a miss"""
+
+        key = SearchCache.hits_key if hit else SearchCache.misses_key
+
+        # Make sure that the counter exists before incrementing it
+        cache.add(key, 0, None)
+
+        try:
+            cache.incr(key)
+        except ValueError:
+            # The counter was evicted between adding and incrementing it
+            cache.set(key, 1, None)
+
+    @staticmethod
+    def stats() -> dict:
+        """Gets the hit and miss metrics of the cache"""
+
+        counters = cache.get_many([SearchCache.hits_key, SearchCache.misses_key])
+
+        hits = counters.get(SearchCache.hits_key, 0)
+        misses = counters.get(SearchCache.misses_key, 0)
+
+        total = hits + misses
+
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total > 0 else 0.0
+        }
+
+    @staticmethod
+    def reset_stats():
+        """Resets the hit and miss metrics"""
+
+        cache.delete_many([SearchCache.hits_key, SearchCache.misses_key])
+
+    @staticmethod
+    def search(compiler, qs : models.QuerySet) -> models.QuerySet:
+        """Gets the results for the compiled search phrase, with the cached start of the results attached to them (see CachedResults)"""
+
+        # The phrase can never match anything, there is nothing worth caching
+        if compiler.matches_nothing:
+            return compiler.compile(qs)
+
+        key = SearchCache.get_key(compiler)
+        cached = cache.get(key)
+
+        # Entries from before the totals were kept are run again
+        if not isinstance(cached, dict):
+            cached = None
+
+        SearchCache.record(cached is not None)
+
+        results = None
+
+        if cached is None:
+            results = compiler.compile(qs)
+
+            # Only the start of the results is kept, fetching one more to see if there are any after it
+            ids = list(results.values_list('id', flat=True)[:settings.BOORU_SEARCH_CACHE_MAX_RESULTS + 1])
+
+            # The total is only counted when there are more results than are cached
+            total = len(ids) if len(ids) <= settings.BOORU_SEARCH_CACHE_MAX_RESULTS else results.count()
+
+            cached = {'ids': ids[:settings.BOORU_SEARCH_CACHE_MAX_RESULTS], 'total': total}
+            cache.set(key, cached, settings.BOORU_SEARCH_CACHE_TIMEOUT)
+
+        cached_results = CachedResults(qs, cached['ids'], cached['total'])
+
+        if cached_results.complete:
+            # Every result is cached, so the search doesn't need to be run again
+            results = qs.filter(pk__in=cached_results.ids).order_by('-id') if len(cached_results.ids) > 0 else qs.none()
+        elif results is None:
+            # Pages past the cached ids still need the search
+            results = compiler.compile(qs)
+
+        results.cached_results = cached_results
+
+        return results
+
+    @staticmethod
+    def invalidate(tags = []):
+        """Changes the versions of the given tags (and all posts) so that searches depending on them are run again"""
+
+        def bump():
+            versions = {SearchCache.get_version_key(tag): uuid.uuid4().hex for tag in tags}
+            versions[SearchCache.global_version_key] = uuid.uuid4().hex
+
+            cache.set_many(versions, None)
+
+        # Change them now and once the transaction is committed, so that any searches run before the commit are not kept
+        tags = list(tags)
+
+        bump()
+        transaction.on_commit(bump)
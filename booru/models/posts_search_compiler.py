@@ -0,0 +1,148 @@
+from django.db import models
+
+from .tags import Tag
+from .posts_search_criteria import *
+
+import booru.boorutils as boorutils
+
+class SearchCompiler:
+    """Compiles a user entered search phrase into a single post query"""
+
+    # List of accepted parameters
+    accepted_params = {
+        'md5': str,
+        'rating': str,
+        'title': str,
+        'width': int,
+        'height': int,
+        'user': int
+    }
+
+    def __init__(self, search_phrase : str, wild_card : str = "*") -> None:
+        self.search_phrase = search_phrase
+        self.wild_card = wild_card
+
+        # Set when a word in the phrase can never match anything
+        self.matches_nothing = False
+
+        self.criteria = self.parse()
+
+    def parse(self) -> list:
+        """Parses the search phrase into a list of search criteria (without touching the database)"""
+
+        search_criteria = []
+
+        # Plain tags are collected so that they can be searched for together
+        include_tags = []
+        exclude_tags = []
+
+        # Split the search phrase into words
+        words = self.search_phrase.split()
+
+        # For each word, check if it is a tag
+        for word in words:
+            # Strip the word of spaces
+            word = word.strip()
+
+            # If the word starts with a '-', it is an exclusion
+            should_exclude = word[0] == '-'
+
+            # If it is an exclusion, strip the '-'
+            if should_exclude:
+                word = word[1:]
+
+            # Make sure that it isn't empty
+            if len(word) == 0:
+                continue
+
+            potential_param = word.split(':')[0]
+            # Handle parameter tags
+            if potential_param in self.accepted_params:
+                expected_type = self.accepted_params[potential_param]
+
+                # Get the value of the parameter
+                val = word[len(potential_param) + 1:]
+
+                # Make sure that the value is of the correct type
+                try:
+                    val = expected_type(val)
+                except Exception:
+                    if not should_exclude:
+                        # They wouldn't find anything if the value is wrong
+                        self.matches_nothing = True
+                        return []
+
+                    # If it is an exclusion, just continue as this would have had no effect
+                    continue
+
+                # Handle the user case
+                if potential_param == 'user':
+                    # Add the user to the search criteria
+                    search_criteria.append(SearchCriteriaExcludeUser(val) if should_exclude else SearchCriteriaUser(val))
+
+                    continue
+
+                # Handle the generic cases
+                search_criteria.append(
+                    SearchCriteriaExcludeParameter(potential_param, val) if should_exclude else SearchCriteriaParameter(potential_param, val)
+                )
+
+                continue
+
+            # Handle wild cards
+            if self.wild_card in word:
+                r = boorutils.wildcard_to_regex(word, self.wild_card)
+
+                # The regex is matched inside of the query, so we don't need to fetch the matching tags
+                search_criteria.append(SearchCriteriaExcludeWildCardTags(r) if should_exclude else SearchCriteriaWildCardTags(r))
+
+                continue
+
+            # Handle normal tag case
+            (exclude_tags if should_exclude else include_tags).append(word)
+
+        # Add the plain tags as two criteria rather than one per tag
+        if len(include_tags) > 0:
+            search_criteria.append(SearchCriteriaTags(include_tags))
+
+        if len(exclude_tags) > 0:
+            search_criteria.append(SearchCriteriaExcludeTags(exclude_tags))
+
+        return search_criteria
+
+    @property
+    def required_tags(self) -> set:
+        """All of the tag names that the criteria depend on"""
+
+        tags = set()
+
+        for criteria in self.criteria:
+            tags.update(criteria.required_tags)
+
+        return tags
+
+    def has_missing_tags(self) -> bool:
+        """Checks if any of the required tags do not exist, using a single query"""
+
+        required = self.required_tags
+
+        # Nothing to look up
+        if len(required) == 0:
+            return False
+
+        # Count the tags that exist in one batch
+        return Tag.objects.filter(tag__in=required).count() != len(required)
+
+    def compile(self, qs : models.QuerySet) -> models.QuerySet:
+        """Applies all of the criteria to the given query set, returning a query set that runs as a single statement"""
+
+        # Check for any words that could never match
+        if self.matches_nothing or self.has_missing_tags():
+            return qs.none()
+
+        # Each criteria only adds to the WHERE clause, so nothing is evaluated here
+        for criteria in self.criteria:
+            qs = criteria.search(qs)
+
+        # Sort the results by their id in descending order
+        return qs.order_by('-id')
@@ -1,55 +1,79 @@
 from django.db import models
-from django.contrib.auth.models import User
-
-from .tags import Tag
 
 # Search criteria for the post search
 
+def _post_tags(s, **kwargs) -> models.Exists:
+    """Creates an EXISTS subquery on the post/tag table, correlated to the outer post"""
+
+    # The through table for the post tags (booru_post_tags)
+    through = s.model.tags.through
+
+    # Tags use their name as the primary key, so we never need to join the tag table
+    return models.Exists(through.objects.filter(post_id=models.OuterRef('pk'), **kwargs))
+
 class SearchCriteria:
     """Interface for creating search criteria"""
 
     def __init__(self) -> None:
         pass
 
+    @property
+    def required_tags(self) -> list:
+        """The tag names that must exist for this criteria to match anything"""
+        return []
+
     def search(self, s) -> models.QuerySet:
         return s
 
-class SearchCriteriaTag(SearchCriteria):
-    """Used to search for posts that contain a certain tag"""
+class SearchCriteriaTags(SearchCriteria):
+    """Used to search for posts that contain all of the given tags"""
 
-    def __init__(self, tag: Tag) -> None:
-        self.tag = tag
+    def __init__(self, tags: list) -> None:
+        # Remove any duplicates, keeping the order
+        self.tags = list(dict.fromkeys(str(tag) for tag in tags))
+
+    @property
+    def required_tags(self) -> list:
+        return self.tags
 
     def search(self, s) -> models.QuerySet:
-        return s.filter(tags=self.tag)
+        if len(self.tags) == 0:
+            return s
 
-class SearchCriteriaExcludeTag(SearchCriteria):
-    """Used to exclude tags from a search"""
+        through = s.model.tags.through
+
+        # Intersect the posts of each tag, this keeps the plan flat no matter how many tags there are
+        post_ids = [through.objects.filter(tag_id=tag).values('post_id') for tag in self.tags]
+
+        if len(post_ids) == 1:
+            return s.filter(pk__in=post_ids[0])
+
+        return s.filter(pk__in=post_ids[0].intersection(*post_ids[1:]))
 
-    def __init__(self, tag: Tag) -> None:
-        self.tag = tag
+class SearchCriteriaExcludeTags(SearchCriteriaTags):
+    """Used to exclude posts that contain any of the given tags"""
 
     def search(self, s) -> models.QuerySet:
-        return s.exclude(tags=self.tag)
+        if len(self.tags) == 0:
+            return s
+
+        return s.filter(~_post_tags(s, tag_id__in=self.tags))
 
 class SearchCriteriaWildCardTags(SearchCriteria):
     """Used to search for posts that contain a certain tag"""
 
-    def __init__(self, tags: [Tag]) -> None:
-        self.tags = tags
+    def __init__(self, regex: str) -> None:
+        self.regex = regex
 
     def search(self, s) -> models.QuerySet:
-        # It must include at least one of the tags, without duplicates
-        return s.filter(tags__in=self.tags).distinct('id')
+        # It must include at least one of the matching tags
+        return s.filter(_post_tags(s, tag__tag__regex=self.regex))
 
-class SearchCriteriaExcludeWildCardTags(SearchCriteria):
+class SearchCriteriaExcludeWildCardTags(SearchCriteriaWildCardTags):
     """Used to exclude tags from a search"""
 
-    def __init__(self, tags: [Tag]) -> None:
-        self.tags = tags
-
     def search(self, s) -> models.QuerySet:
-        return s.exclude(tags__in=self.tags).distinct('id')
+        return s.filter(~_post_tags(s, tag__tag__regex=self.regex))
 
 class SearchCriteriaParameter(SearchCriteria):
     """Used to search for posts that have a certain parameter"""
@@ -77,37 +101,13 @@ class SearchCriteriaUser(SearchCriteria):
     def __init__(self, user_id: int) -> None:
         self.user_id = user_id
 
-    @property
-    def user(self) -> User:
-        # If the user doesn't exist, return None
-        if not User.objects.filter(id=self.user_id).exists():
-            return None
-        
-        # Get the user
-        return User.objects.get(id=self.user_id)
-
     def search(self, s) -> models.QuerySet:
-        user = self.user
-
-        # If the user doesn't exist, return an empty queryset
-        if not user:
-            return s.none()
-
-        # Return the posts by the user
-        return s.filter(owner=user)
+        # If the user doesn't exist, nothing will match the owner id
+        return s.filter(owner_id=self.user_id)
 
 class SearchCriteriaExcludeUser(SearchCriteriaUser):
     """Used to exclude posts by a certain user"""
 
-    def __init__(self, user_id: int) -> None:
-        self.user_id = user_id
-
     def search(self, s) -> models.QuerySet:
-        user = self.user
-
-        # If the user doesn't exist, return the query set since it's already excluded
-        if not user:
-            return s
-
-        # Return the posts by the user
-        return s.exclude(owner=user)
\ No newline at end of file
+        # If the user doesn't exist, nothing is excluded
+        return s.exclude(owner_id=self.user_id)
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.apps import apps
 from django.contrib.auth.models import User
 
@@ -39,45 +40,80 @@ class Tag(models.Model):
     # Tag type as a foreign key to the TagType model
     tag_type = models.ForeignKey(TagType, on_delete=models.CASCADE, null=True)
 
+    # The number of posts that have this tag (kept up to date by the post signals)
+    post_count = models.IntegerField(default=0, db_index=True)
+
     def save(self, *args, **kwargs):
         """Saves the tag."""
 
         # If the tag type is not set, set it to the default
         if not self.tag_type:
             self.tag_type = TagType.get_default()
-        
+
+        # Never write back the post count of an existing tag, this instance's copy may be out of date
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'post_count'
+            ]
+
         super().save(*args, **kwargs)
 
     @property
     def total_posts(self):
         """Returns the total number of posts that have this tag."""
+        return self.post_count
+
+    @staticmethod
+    def recount(tags : models.QuerySet = None) -> int:
+        """Recalculates the post count of the given tags (or all of them) from the post tags table, returning the number of tags updated."""
+
         # Get the modes model
         Post = apps.get_model('booru', 'Post')
 
-        # Get all the posts that have this tag
-        posts = Post.objects.filter(tags__tag=self.tag)
+        if tags is None:
+            tags = Tag.objects.all()
+
+        # Count the posts for each tag in the database
+        counts = Post.tags.through.objects.filter(tag_id=models.OuterRef('pk')) \
+            .values('tag_id') \
+            .annotate(total=models.Count('post_id')) \
+            .values('total')
 
-        # Return the count
-        return posts.count()
+        return tags.update(post_count=Coalesce(models.Subquery(counts), 0))
     
     @staticmethod
     def create_or_get(tag):
         """Creates a tag if it doesn't exist, or returns the existing tag."""
 
-        # Store the tag
-        t = None
-
-        # Check if the tag exists
-        if Tag.objects.filter(tag=tag).exists():
-            # Get the tag
-            t = Tag.objects.get(tag=tag)
-        else:
-            # Create the tag
-            t = Tag(tag=tag)
-            t.save()
-        
+        # Only a single query is needed if it already exists (save sets the default type for new tags)
+        t, created = Tag.objects.get_or_create(tag=tag)
+
         # Return the tag
         return t
+
+    @staticmethod
+    def create_or_get_many(names : list) -> list:
+        """Creates any of the tags that don't exist and returns all of them (in the given order), using three queries."""
+
+        # Remove duplicates, keeping the order
+        names = list(dict.fromkeys(names))
+
+        if len(names) == 0:
+            return []
+
+        # Create the missing tags with the default type like save does (bulk_create doesn't call it), leaving the existing ones alone
+        tag_type = TagType.get_default()
+
+        Tag.objects.bulk_create(
+            [Tag(tag=name, tag_type=tag_type) for name in names],
+            ignore_conflicts=True
+        )
+
+        # Fetch them all back
+        tags = Tag.objects.in_bulk(names)
+
+        return [tags[name] for name in names if name in tags]
     
     @staticmethod
     def is_name_valid(name : str) -> bool:
@@ -156,10 +192,7 @@ class Tag(models.Model):
         # Handle total_posts
         if sort_param == "total_posts":
             # We may not use total_posts since it is used on the object but not in the database!
-            # Hence, I renamed it to just "t", nobody should see this other than the searching algorithm
-            sort_param = "t"
-
-            qs = qs.annotate(**{sort_param: models.Count('posts')})
+            sort_param = "post_count"
 
         # Negate the order if it is descending
         if order == "descending":
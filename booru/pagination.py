@@ -1,8 +1,19 @@
 import math
+import json
+import base64
+import hashlib
 
 from django.db import models
+from django.db.models import Q
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+
+import homebooru.settings
 
 class Paginator:
+    # Used by the templates to pick which controls to display
+    is_cursor = False
+
     def __init__(self, page, total_count, per_page=10, width=4, page_url=''):
         self.page = page
         self.per_page = per_page
@@ -54,11 +65,261 @@ class Paginator:
         return self.page - 1
 
     @staticmethod
-    def paginate(qs : models.QuerySet, page : int, per_page : int):
-        """Creates a tuple of the selected pages and a paginator"""
+    def get_cached_results(qs : models.QuerySet, ordering : list = ['-id']):
+        """Gets the cached start of the results attached to a search (see SearchCache), if they are in the given order"""
+
+        cached = getattr(qs, 'cached_results', None)
+
+        if cached is None or list(ordering) != cached.ordering:
+            return None
+
+        return cached
+
+    @staticmethod
+    def paginate(qs : models.QuerySet, page : int, per_page : int, cached = None):
+        """Creates a tuple of the selected pages and a paginator, using the cached start of the results if the page is in it"""
 
         limit = per_page
         offset = (page - 1) * per_page
 
+        if cached is None:
+            cached = Paginator.get_cached_results(qs)
+
+        if cached is not None:
+            ids = cached.get_slice(offset, offset + limit)
+
+            if ids is not None:
+                return cached.get_rows(ids), Paginator(page, cached.total, per_page)
+
         # Thanks to https://stackoverflow.com/a/53864585/8736749
-        return qs[offset : offset + limit], Paginator(page, qs.count(), per_page)
\ No newline at end of file
+        return qs[offset : offset + limit], Paginator(page, qs.count() if cached is None else cached.total, per_page)
+
+    @staticmethod
+    def paginate_request(request, qs : models.QuerySet, per_page : int, ordering : list = ['-id']):
+        """Paginates the query set using the parameters of the request and the configured pagination mode"""
+
+        # Use the cursors if they are enabled
+        if homebooru.settings.BOORU_PAGINATION_MODE == 'cursor':
+            return CursorPaginator.paginate(
+                qs, per_page,
+                after=request.GET.get('after'),
+                before=request.GET.get('before'),
+                ordering=ordering
+            )
+
+        # Get the page number
+        page = request.GET.get('pid', 1)
+
+        # Make sure that page is an integer
+        try:
+            page = int(page)
+        except ValueError:
+            page = 1
+
+        # Make sure that page is greater than 0
+        if page < 1:
+            page = 1
+
+        return Paginator.paginate(qs.order_by(*ordering), page, per_page, cached=Paginator.get_cached_results(qs, ordering))
+
+class CursorPaginator:
+    """Paginates by remembering the last row of a page rather than skipping over the rows before it"""
+
+    # Used by the templates to pick which controls to display
+    is_cursor = True
+
+    def __init__(self, total_count, per_page=10, prev=None, next=None, page_url=''):
+        self.total_count = total_count
+        self.per_page = per_page
+        self.page_url = page_url
+
+        # The tokens for the previous and next pages
+        self.prev = prev
+        self.next = next
+
+    @property
+    def total_pages(self):
+        return math.ceil(self.total_count / float(self.per_page))
+
+    @property
+    def has_prev(self):
+        return self.prev is not None
+
+    @property
+    def has_next(self):
+        return self.next is not None
+
+    @staticmethod
+    def encode_cursor(values : list) -> str:
+        """Creates an opaque token from the values of the ordered fields"""
+
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(token : str, length : int):
+        """Gets the values of the ordered fields from a token, returns None if the token is invalid"""
+
+        if not token:
+            return None
+
+        try:
+            # Add back the padding
+            token += '=' * (-len(token) % 4)
+
+            values = json.loads(base64.urlsafe_b64decode(token.encode()))
+        except Exception:
+            return None
+
+        # Make sure that there is a value for every field
+        if not isinstance(values, list) or len(values) != length:
+            return None
+
+        return values
+
+    @staticmethod
+    def get_cursor(obj, ordering : list) -> str:
+        """Gets the token which points at the given row"""
+
+        return CursorPaginator.encode_cursor([getattr(obj, field.lstrip('-')) for field in ordering])
+
+    @staticmethod
+    def keyset_filter(ordering : list, values : list, forward : bool = True) -> Q:
+        """Creates a filter for the rows after (or before) the given values of the ordered fields, nulls come after every value"""
+
+        q = Q()
+
+        # Fields before the current one must be equal for the current one to be compared
+        equal = {}
+
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+
+            if value is None:
+                # Nothing comes after a null, but every value comes before it
+                if not forward:
+                    q |= Q(**equal, **{f'{name}__isnull': False})
+
+                equal[f'{name}__isnull'] = True
+                continue
+
+            # Descending fields get smaller as you go forward
+            lookup = 'lt' if field.startswith('-') == forward else 'gt'
+
+            q |= Q(**equal, **{f'{name}__{lookup}': value})
+
+            # The nulls come after the value
+            if forward:
+                q |= Q(**equal, **{f'{name}__isnull': True})
+
+            equal[name] = value
+
+        return q
+
+    @staticmethod
+    def get_order_by(qs : models.QuerySet, ordering : list, forward : bool = True) -> list:
+        """Gets the expressions to order the query set by, putting the nulls of nullable fields after every value (or before them going backwards)"""
+
+        order_by = []
+
+        for field in ordering:
+            name = field.lstrip('-')
+
+            try:
+                nullable = qs.model._meta.get_field(name).null
+            except FieldDoesNotExist:
+                nullable = False
+
+            # Leave the other fields alone so that their indexes can still be used
+            if not nullable:
+                order_by.append(field if forward else (name if field.startswith('-') else '-' + name))
+                continue
+
+            descending = field.startswith('-') == forward
+            expression = models.F(name).desc if descending else models.F(name).asc
+
+            order_by.append(expression(nulls_last=True) if forward else expression(nulls_first=True))
+
+        return order_by
+
+    @staticmethod
+    def cached_count(qs : models.QuerySet) -> int:
+        """Counts the rows of the query set, caching the result so the search is not re-run on every page"""
+
+        # Key the count on the query itself
+        try:
+            sql = str(qs.query)
+        except EmptyResultSet:
+            # The query can't match anything
+            return 0
+
+        key = 'booru-count-' + hashlib.md5(sql.encode()).hexdigest()
+
+        return cache.get_or_set(key, qs.count, homebooru.settings.BOORU_PAGINATION_COUNT_TIMEOUT)
+
+    @staticmethod
+    def paginate(qs : models.QuerySet, per_page : int, after : str = None, before : str = None, ordering : list = ['-id']):
+        """Creates a tuple of the selected rows and a paginator, using the tokens to find where the page starts"""
+
+        # The cached start of the results of a search is lost once the query set is changed
+        cached = Paginator.get_cached_results(qs, ordering)
+
+        qs = qs.order_by(*CursorPaginator.get_order_by(qs, ordering))
+
+        total_count = CursorPaginator.cached_count(qs) if cached is None else cached.total
+
+        after = CursorPaginator.decode_cursor(after, len(ordering))
+        before = CursorPaginator.decode_cursor(before, len(ordering))
+
+        # Use the cached ids if the page is in them (the cached ordering only has the id in it)
+        ids = None
+
+        if cached is not None:
+            if before is not None:
+                ids = cached.get_before(before[0], per_page + 1) if type(before[0]) is int else None
+            elif after is not None:
+                ids = cached.get_after(after[0], per_page + 1) if type(after[0]) is int else None
+            else:
+                ids = cached.get_slice(0, per_page + 1)
+
+        # Fetch one extra row to see if there is another page
+        if before is not None:
+            if ids is not None:
+                has_prev = len(ids) > per_page
+                rows = cached.get_rows(ids[-per_page:])
+            else:
+                # Walk backwards from the cursor
+                reverse_ordering = CursorPaginator.get_order_by(qs, ordering, forward=False)
+                rows = list(qs.filter(CursorPaginator.keyset_filter(ordering, before, forward=False)).order_by(*reverse_ordering)[:per_page + 1])
+
+                has_prev = len(rows) > per_page
+                rows = rows[:per_page][::-1]
+
+            # The row at the cursor comes after this page
+            has_next = True
+        else:
+            if ids is not None:
+                has_next = len(ids) > per_page
+                rows = cached.get_rows(ids[:per_page])
+            else:
+                if after is not None:
+                    qs = qs.filter(CursorPaginator.keyset_filter(ordering, after))
+
+                rows = list(qs[:per_page + 1])
+
+                has_next = len(rows) > per_page
+                rows = rows[:per_page]
+
+            # Only the first page has nothing before it
+            has_prev = after is not None
+
+        # There is nothing to point at on an empty page
+        if len(rows) == 0:
+            return rows, CursorPaginator(total_count, per_page)
+
+        paginator = CursorPaginator(
+            total_count, per_page,
+            prev=CursorPaginator.get_cursor(rows[0], ordering) if has_prev else None,
+            next=CursorPaginator.get_cursor(rows[-1], ordering) if has_next else None
+        )
+
+        return rows, paginator
\ No newline at end of file
@@ -1,4 +1,5 @@
-from .tag_automation import perform_all_automation, perform_automation
-from .rating_automation import perform_all_rating_automation, perform_rating_automation
+from .tag_automation import perform_all_automation, perform_automation, perform_automation_batch
+from .rating_automation import perform_all_rating_automation, perform_rating_automation, perform_rating_automation_batch
 from .pools import create_pool_posts, create_pool_posts_range
-from .impl_automation import perform_all_tag_implications
\ No newline at end of file
+from .impl_automation import perform_all_tag_implications
+from .processing import process_post, process_all_posts
\ No newline at end of file
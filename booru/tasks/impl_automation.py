@@ -1,25 +1,22 @@
 from celery import shared_task
 from .skipper import skip_if_running
 
-from booru.models.implications import Implication
+from booru.models.implications import ImplicationClosure
+
+import logging
+
+logger = logging.getLogger(__name__)
 
 @shared_task(bind=True)
 @skip_if_running
 def perform_all_tag_implications(self):
-    """Performs all tag implications."""
-    # Get all implications
-    implications = Implication.objects.all() # TODO what if there is a change in the implications?
+    """Checks that the posts have all of their implied tags."""
 
-    # Keep applying implications until there are no more changes to be made (for example, an implication adds a tag that another implication adds)
-    
-    first_run = True
-    total = 0 # The total number of posts affected
+    # The closure is compiled whenever an implication changes, but it is also compiled here in case they were changed in bulk
+    cycles = ImplicationClosure.compile()
 
-    while total > 0 or first_run:
-        total = 0 # Reset the total
-        first_run = False # We are no longer on the first run
+    for cycle in cycles:
+        logger.warning('Implication cycle between tags: %s', ', '.join(cycle))
 
-        # Apply all implications
-        for implication in implications:
-            total += implication.apply() # Apply the implication
-        
+    # Tags are expanded when they are written, so only the posts since the last check are looked at
+    return ImplicationClosure.sweep()
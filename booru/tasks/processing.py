@@ -0,0 +1,48 @@
+from celery import shared_task
+from django.utils import timezone
+from django.db import transaction
+
+from booru.models import Post
+import homebooru.settings as settings
+
+from .skipper import skip_if_running
+
+import datetime
+
+# Logger
+import logging
+logger = logging.getLogger(__name__)
+
+@shared_task
+def process_post(post_id : int):
+    """Generates the thumbnail and sample of an uploaded post, returning whether it succeeded."""
+
+    with transaction.atomic():
+        # Skip the post if it has been deleted or already processed since it was queued, or if it is being processed right now
+        post = Post.objects.select_for_update(skip_locked=True).filter(id=post_id, status=Post.STATUS_PROCESSING).first()
+
+        if post is None:
+            return False
+
+        return post.process()
+
+def queue_post(post_id : int):
+    """Queues a post to be processed, leaving it for the next periodic run if it can't be queued."""
+
+    try:
+        process_post.delay(post_id)
+    except Exception as e:
+        logger.warning('Could not queue post %s for processing: %s', post_id, e)
+
+@shared_task(bind=True)
+@skip_if_running
+def process_all_posts(self):
+    """Processes the posts that have been processing for too long (e.g. their task was lost), returning the number of posts processed."""
+
+    cutoff = timezone.now() - datetime.timedelta(seconds=settings.BOORU_PROCESSING_RETRY_AFTER)
+    posts = Post.objects.filter(status=Post.STATUS_PROCESSING, timestamp__lt=cutoff)
+
+    post_ids = list(posts.order_by('id').values_list('id', flat=True)[:settings.BOORU_AUTOMATION_MAX_POSTS])
+
+    # The posts are processed here rather than queued (the next run is skipped while this one is going), and posts that are locked by their own task are skipped
+    return sum(1 for post_id in post_ids if process_post(post_id))
@@ -1,11 +1,17 @@
 from celery import shared_task
 
-from booru.automation.rating import perform_automation
+from booru.automation.rating import perform_automation, perform_automation_many
 from booru.models import Post
+from booru.models.automation import NSFWAutomationRecord
+import booru.boorutils as boorutils
 import homebooru.settings as settings
 
 from .skipper import skip_if_running
 
+# Logger
+import logging
+logger = logging.getLogger(__name__)
+
 @shared_task
 def perform_rating_automation(post_id : int):
     """Performs rating automation on a post."""
@@ -33,18 +39,63 @@ def perform_rating_automation(post_id : int):
 
     return str(predicted_rating)
 
+@shared_task
+def perform_rating_automation_batch(post_ids : list):
+    """Performs rating automation on a batch of posts, returning the number of posts that were rerated."""
+
+    # Let's not do this if it's not enabled
+    if not settings.BOORU_AUTOMATIC_RATING_ENABLED:
+        return
+
+    # Get the posts in one query, skipping any that have been deleted since
+    posts = list(Post.objects.filter(id__in=post_ids).order_by('id'))
+
+    # The images are run through the model together, and the ratings are saved together
+    return len(perform_automation_many(posts))
+
+def perform_rating_automation_each(post_ids : list) -> int:
+    """Performs rating automation on the posts one at a time, recording the posts that still fail so that they are not picked again, returning the number of posts that were rerated."""
+
+    total = 0
+    failed = []
+
+    for post_id in post_ids:
+        try:
+            total += perform_rating_automation_batch([post_id])
+        except Exception:
+            logger.exception('Could not rate post %s', post_id)
+            failed.append(post_id)
+
+    # Skip any posts that have been deleted since
+    NSFWAutomationRecord.objects.bulk_create(
+        [NSFWAutomationRecord(post_id=post_id, nsfw_probability=0.0, failed=True) for post_id in Post.objects.filter(id__in=failed).values_list('id', flat=True)],
+        ignore_conflicts=True
+    )
+
+    return total
+
 @shared_task(bind=True)
 @skip_if_running
 def perform_all_rating_automation(self):
-    """Performs rating automation on all posts."""
+    """Performs rating automation on the posts that haven't been rated yet, returning the number of posts that were rerated."""
 
     # Let's not do this if it's not enabled
     if not settings.BOORU_AUTOMATIC_RATING_ENABLED:
         return
 
-    # Get all the posts
-    posts = Post.objects.all()
+    total = 0
+
+    # Only a bounded number of posts are done each time, the rest are found by the next run
+    posts = NSFWAutomationRecord.get_pending_posts()
+
+    # The batches are run here rather than queued, the next run is skipped while this one is going so the same posts are never done twice
+    for post_ids in boorutils.batched_ids(posts, settings.BOORU_AUTOMATION_BATCH_SIZE, settings.BOORU_AUTOMATION_MAX_POSTS):
+        try:
+            total += perform_rating_automation_batch(post_ids)
+        except Exception:
+            logger.exception('Could not rate posts %s to %s', post_ids[0], post_ids[-1])
+
+            # Find the posts that failed, otherwise they would be picked first on every run and hold back the newer posts
+            total += perform_rating_automation_each(post_ids)
 
-    for post in posts:
-        # perform_rating_automation.delay(post.id)
-        perform_rating_automation(post.id)
\ No newline at end of file
+    return total
@@ -1,10 +1,18 @@
 from celery import shared_task
 
 from booru.models import Post
+from booru.models.automation import TagAutomationRecord
 from booru.automation.tag.tag_automation import TagAutomationRegistry
 
+import booru.boorutils as boorutils
+import homebooru.settings as settings
+
 from .skipper import skip_if_running
 
+# Logger
+import logging
+logger = logging.getLogger(__name__)
+
 @shared_task
 def perform_automation(post_id : int, force_perform = False):
     """Performs all automation on a post."""
@@ -18,15 +26,62 @@ def perform_automation(post_id : int, force_perform = False):
     # Perform the automation
     return registry.perform_automation(post=post, force_perform=force_perform)
 
+@shared_task
+def perform_automation_batch(post_ids : list, force_perform = False):
+    """Performs all automation on a batch of posts, returning the number of posts updated."""
+
+    # Get the posts in one query, skipping any that have been deleted since
+    posts = list(Post.objects.filter(id__in=post_ids).order_by('id'))
+
+    # The automations handle the posts together (e.g. JoyTag runs them through the model as one batch)
+    return len(TagAutomationRegistry().perform_automation_many(posts, force_perform=force_perform))
+
+def perform_automation_each(post_ids : list, force_perform = False) -> int:
+    """Performs all automation on the posts one at a time, recording the posts that still fail so that they are not picked again until the automations change, returning the number of posts updated."""
+
+    total = 0
+    failed = []
+
+    for post_id in post_ids:
+        try:
+            total += perform_automation_batch([post_id], force_perform=force_perform)
+        except Exception:
+            logger.exception('Could not perform the automation on post %s', post_id)
+            failed.append(post_id)
+
+    state_hash = TagAutomationRegistry().get_state_hash()
+
+    # Skip any posts that have been deleted since
+    TagAutomationRecord.objects.bulk_create(
+        [TagAutomationRecord(post_id=post_id, state_hash=state_hash, failed=True) for post_id in Post.objects.filter(id__in=failed).values_list('id', flat=True)],
+        ignore_conflicts=True
+    )
+
+    return total
+
 @shared_task(bind=True)
 @skip_if_running
 def perform_all_automation(self, force_perform = False):
-    """Performs all automation on all posts."""
+    """Performs all automation on the posts that haven't been done with the current automations, returning the number of posts updated."""
+
+    if force_perform:
+        # Every post is done again
+        posts, limit = Post.objects.all(), None
+    else:
+        # Only a bounded number of posts are done each time, the rest are found by the next run
+        posts = TagAutomationRecord.get_pending_posts(TagAutomationRegistry().get_state_hash())
+        limit = settings.BOORU_AUTOMATION_MAX_POSTS
+
+    total = 0
+
+    # The batches are run here rather than queued, the next run is skipped while this one is going so the same posts are never done twice
+    for post_ids in boorutils.batched_ids(posts, settings.BOORU_AUTOMATION_BATCH_SIZE, limit):
+        try:
+            total += perform_automation_batch(post_ids, force_perform=force_perform)
+        except Exception:
+            logger.exception('Could not perform the automation on posts %s to %s', post_ids[0], post_ids[-1])
 
-    # Get all the posts
-    posts = Post.objects.all()
+            # Find the posts that failed, otherwise they would be picked first on every run and hold back the newer posts
+            total += perform_automation_each(post_ids, force_perform=force_perform)
 
-    # Perform automation on each post as a subtask
-    for post in posts:
-        # perform_automation.delay(post.id, force_perform=force_perform)
-        perform_automation(post.id, force_perform=force_perform) # Do it without a delay to prevent spamming requests
\ No newline at end of file
+    return total
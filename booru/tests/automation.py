@@ -3,9 +3,12 @@ from booru.models.posts import Post
 import booru.tests.testutils as testutils
 
 from booru.automation.tag import TagAutomationRegistry, AnimatedContentTagAutomation
-from booru.models.automation import TagAutomationRecord
+from booru.automation.tag.tag_automation import TagAutomation
+from booru.models.automation import TagAutomationRecord, NSFWAutomationRecord
 from booru.models.tags import Tag
 
+import booru.boorutils as boorutils
+
 
 class AnimatedContentTagAutomationTest(TestCase):
     temp_storage = testutils.TempStorage()
@@ -135,6 +138,126 @@ class TagAutomationRegistryTest(TestCase):
         # self.assertEqual(total_tags, 0)
         # TODO this test is having a hissy fit, fix it at some point
 
+    def test_outdated_lock(self):
+        """Performs automation again if the lock is from older automations"""
+
+        registry = TagAutomationRegistry()
+
+        TagAutomationRecord(post=self.video, state_hash='outdated').save()
+
+        registry.perform_automation(self.video)
+
+        # Only the current record is kept
+        self.assertEqual(
+            list(TagAutomationRecord.objects.filter(post=self.video).values_list('state_hash', flat=True)),
+            [registry.get_state_hash()]
+        )
+
+    def test_perform_automation_many(self):
+        """Performs automation on a batch of posts, skipping the ones that are done"""
+
+        registry = TagAutomationRegistry()
+
+        # Only videos, so that the models aren't needed
+        other = Post.create_from_file(testutils.VIDEO_PATH)
+        other.md5 = boorutils.hash_str('other')
+        other.save()
+
+        TagAutomationRecord(post=other, state_hash=registry.get_state_hash()).save()
+
+        updated = registry.perform_automation_many([self.video, other])
+
+        self.assertEqual(updated, [self.video])
+        self.assertIn('animated', [tag.tag for tag in self.video.tags.all()])
+        self.assertEqual(other.tags.count(), 0)
+
+        # Both have a record with the current state
+        self.assertEqual(TagAutomationRecord.objects.filter(post__in=[self.video, other], state_hash=registry.get_state_hash()).count(), 2)
+
+class TagAutomationPendingTest(TestCase):
+    def setUp(self):
+        self.posts = []
+
+        for i in range(3):
+            post = Post(width=420, height=420, folder=0, md5=boorutils.hash_str(str(i)))
+            post.save()
+
+            self.posts.append(post)
+
+    def test_pending(self):
+        """Finds the posts without a record for the current state"""
+
+        TagAutomationRecord(post=self.posts[0], state_hash='current').save()
+        TagAutomationRecord(post=self.posts[1], state_hash='outdated').save()
+
+        pending = TagAutomationRecord.get_pending_posts('current').order_by('id')
+
+        self.assertEqual(list(pending), self.posts[1:])
+
+    def test_single_query(self):
+        """Finds the pending posts in a single query"""
+
+        with self.assertNumQueries(1):
+            ids = list(TagAutomationRecord.get_pending_posts('current').values_list('id', flat=True))
+
+        self.assertEqual(len(ids), 3)
+
+    def test_rating_pending(self):
+        """Finds the posts that haven't been scanned"""
+
+        NSFWAutomationRecord(post=self.posts[0], nsfw_probability=0.5).save()
+
+        self.assertEqual(list(NSFWAutomationRecord.get_pending_posts().order_by('id')), self.posts[1:])
+
+class FailingTagAutomation(TagAutomation):
+    """Fails on any batch with the given post in it"""
+
+    def __init__(self, post_id):
+        super().__init__()
+
+        self.post_id = post_id
+
+    def get_tags_many(self, posts):
+        if any(post.id == self.post_id for post in posts):
+            raise Exception('Corrupt post')
+
+        return super().get_tags_many(posts)
+
+class TagAutomationFailureTest(TestCase):
+    def setUp(self):
+        self.posts = []
+
+        for i in range(3):
+            post = Post(width=420, height=420, folder=0, md5=boorutils.hash_str(str(i)))
+            post.save()
+
+            self.posts.append(post)
+
+        # Only the middle post fails, the other automations are left out (they need their models)
+        self.registry = TagAutomationRegistry()
+        self.automations = self.registry._registry
+
+        self.registry._registry = [FailingTagAutomation(self.posts[1].id)]
+        self.registry._cached_hash = None
+
+    def tearDown(self):
+        self.registry._registry = self.automations
+        self.registry._cached_hash = None
+
+    def test_records_failures(self):
+        """Records the posts that fail on their own, so that they don't hold back the pending posts"""
+
+        from booru.tasks.tag_automation import perform_automation_each
+
+        state_hash = self.registry.get_state_hash()
+
+        perform_automation_each([post.id for post in self.posts])
+
+        # Only the failed post is marked as failed, and none of them are pending
+        self.assertEqual(list(TagAutomationRecord.objects.filter(state_hash=state_hash, failed=True).values_list('post_id', flat=True)), [self.posts[1].id])
+        self.assertEqual(TagAutomationRecord.objects.filter(state_hash=state_hash, failed=False).count(), 2)
+        self.assertFalse(TagAutomationRecord.get_pending_posts(state_hash).exists())
+
 from booru.models import RatingThreshold, Rating
 
 class RatingThresholdTest(TestCase):
@@ -166,4 +289,46 @@ class RatingThresholdTest(TestCase):
         RatingThreshold.objects.all().delete()
 
         # Ensure that the rating is safe
-        self.assertEqual(RatingThreshold.get_rating(0.1).name, Rating.get_default().name)
\ No newline at end of file
+        self.assertEqual(RatingThreshold.get_rating(0.1).name, Rating.get_default().name)
+
+    def test_cached_thresholds(self):
+        """Returns the same ratings from thresholds that were already fetched, without any queries"""
+
+        thresholds = RatingThreshold.get_all()
+        default = Rating.get_default()
+
+        probabilities = [0, 0.1, 0.5, 0.9, 1.0]
+        expected = [RatingThreshold.get_rating(probability) for probability in probabilities]
+
+        with self.assertNumQueries(0):
+            ratings = [RatingThreshold.get_rating(probability, thresholds=thresholds, default=default) for probability in probabilities]
+
+        self.assertEqual(ratings, expected)
+
+class PredictedRatingTest(TestCase):
+    fixtures = ['booru/fixtures/ratings.json', 'booru/fixtures/rating_thresholds.json']
+
+    def setUp(self):
+        self.post = Post(width=420, height=420, folder=0, md5=boorutils.hash_str('post'))
+        self.post.save()
+
+        self.thresholds = RatingThreshold.get_all()
+
+    def test_raises_rating(self):
+        """Raises the rating of a post that is more NSFW than its rating"""
+
+        from booru.automation.rating import get_predicted_rating
+
+        with self.assertNumQueries(0):
+            rating = get_predicted_rating(self.post, 0.9, self.thresholds)
+
+        self.assertEqual(rating.name, 'explicit')
+
+    def test_keeps_rating(self):
+        """Keeps the rating of a post that is less NSFW than its rating"""
+
+        from booru.automation.rating import get_predicted_rating
+
+        self.post.rating = Rating.objects.get(name='explicit')
+
+        self.assertIsNone(get_predicted_rating(self.post, 0.5, self.thresholds))
@@ -1,6 +1,8 @@
 from django.test import TestCase
 
 import pathlib
+import os
+import shutil
 
 from ..boorutils import *
 
@@ -35,6 +37,10 @@ class GetFileChecksumTest(TestCase):
         with self.assertRaises(Exception):
             get_file_checksum("assets/TEST_DATA/content/non_existent.jpg")
 
+    def test_small_chunks(self):
+        """Gets the same checksum no matter the chunk size"""
+        self.assertEqual(get_file_checksum("assets/TEST_DATA/content/felix.jpg", chunk_size=7), "2dcd09f6c874b36355336112d17434e1")
+
 class GenerateThumbnailTest(TestCase):
     original_image = "assets/TEST_DATA/content/felix.jpg"
 
@@ -186,6 +192,177 @@ class GenerateSampleTest(TestCase):
 
     # TODO test videos
 
+class GenerateDerivativesTest(TestCase):
+    original_image = "assets/TEST_DATA/content/sampleable_image.jpg"
+
+    def setUp(self):
+        self.thumbnail = random_file()
+        self.sample = random_file()
+
+    def tearDown(self):
+        for path in [self.thumbnail, self.sample]:
+            pathlib.Path(path).unlink(missing_ok=True)
+
+    def test_generates_both(self):
+        """Generates the thumbnail and the sample from one pass"""
+
+        result = generate_derivatives(self.original_image, self.thumbnail, self.sample)
+
+        self.assertEqual((result['width'], result['height']), get_content_dimensions(self.original_image))
+        self.assertTrue(result['sample'])
+
+        self.assertEqual(get_content_dimensions(self.thumbnail)[1], 150)
+        self.assertEqual(get_content_dimensions(self.sample)[0], 850)
+
+        self.assertIn('probe', result['timings'])
+        self.assertIn('derivatives', result['timings'])
+
+    def test_skips_sample(self):
+        """Only generates the thumbnail for small content"""
+
+        result = generate_derivatives("assets/TEST_DATA/content/felix.jpg", self.thumbnail, self.sample)
+
+        self.assertFalse(result['sample'])
+        self.assertTrue(pathlib.Path(self.thumbnail).exists())
+        self.assertFalse(pathlib.Path(self.sample).exists())
+
+    def test_no_sample_path(self):
+        """Doesn't generate a sample without a path for it (e.g. for videos)"""
+
+        result = generate_derivatives("assets/TEST_DATA/content/ana_cat.mp4", self.thumbnail)
+
+        self.assertFalse(result['sample'])
+        self.assertEqual((result['width'], result['height']), (928, 1904))
+
+    def test_corrupted(self):
+        """Raises an error for corrupted content without leaving any outputs"""
+
+        with self.assertRaises(Exception):
+            generate_derivatives("assets/TEST_DATA/content/corrupted_image.jpg", self.thumbnail, self.sample)
+
+        self.assertFalse(pathlib.Path(self.thumbnail).exists())
+        self.assertFalse(pathlib.Path(self.sample).exists())
+
+class ProbeContentTest(TestCase):
+    def setUp(self):
+        self.og_max_pixels = homebooru.settings.BOORU_MAX_PIXELS
+        self.og_max_file_size = homebooru.settings.BOORU_MAX_FILE_SIZE
+
+    def tearDown(self):
+        homebooru.settings.BOORU_MAX_PIXELS = self.og_max_pixels
+        homebooru.settings.BOORU_MAX_FILE_SIZE = self.og_max_file_size
+
+    def test_image(self):
+        """Reads the image's details from its header"""
+
+        content = probe_content("assets/TEST_DATA/content/felix.jpg")
+
+        self.assertEqual((content['width'], content['height']), (500, 688))
+        self.assertEqual(content['mime'], 'image/jpeg')
+        self.assertEqual(content['size'], os.path.getsize("assets/TEST_DATA/content/felix.jpg"))
+
+    def test_video(self):
+        """Reads the video's details and counts its frames without decoding them"""
+
+        content = probe_content("assets/TEST_DATA/content/ana_cat.mp4", count_frames=True)
+
+        self.assertEqual((content['width'], content['height']), (928, 1904))
+        self.assertGreater(content['frames'], 1)
+        self.assertGreater(content['duration'], 0)
+
+    def test_corrupted(self):
+        """Raises an error for content that can't be read"""
+
+        with self.assertRaises(Exception):
+            probe_content("assets/TEST_DATA/content/corrupt_image.jpg")
+
+    def test_too_many_pixels(self):
+        """Rejects content with too many pixels before it is decoded"""
+
+        content = probe_content("assets/TEST_DATA/content/felix.jpg")
+
+        homebooru.settings.BOORU_MAX_PIXELS = 500 * 688
+        check_content_limits(content)
+
+        homebooru.settings.BOORU_MAX_PIXELS = 500 * 688 - 1
+        with self.assertRaises(ContentTooLarge):
+            check_content_limits(content)
+
+        # Disabled
+        homebooru.settings.BOORU_MAX_PIXELS = 0
+        check_content_limits(content)
+
+    def test_too_large(self):
+        """Rejects files that are too large"""
+
+        content = probe_content("assets/TEST_DATA/content/felix.jpg")
+
+        homebooru.settings.BOORU_MAX_FILE_SIZE = content['size'] - 1
+        with self.assertRaises(ContentTooLarge):
+            check_content_limits(content)
+
+    def test_derivatives(self):
+        """Doesn't generate the derivatives of content that is too large"""
+
+        thumbnail = random_file()
+        homebooru.settings.BOORU_MAX_PIXELS = 100
+
+        with self.assertRaises(ContentTooLarge):
+            generate_derivatives("assets/TEST_DATA/content/felix.jpg", thumbnail)
+
+        self.assertFalse(pathlib.Path(thumbnail).exists())
+
+class ImportFileTest(TestCase):
+    source_path = pathlib.Path("assets/TEST_DATA/content/felix.jpg")
+
+    def setUp(self):
+        # Work on a copy, since moving it removes it
+        self.source = random_file()
+        shutil.copy(self.source_path, self.source)
+
+        self.destination = random_file()
+
+    def tearDown(self):
+        for path in [self.source, self.destination]:
+            pathlib.Path(path).unlink(missing_ok=True)
+
+    def test_copy(self):
+        """Copies the file"""
+
+        self.assertEqual(import_file(self.source, self.destination, IMPORT_COPY), IMPORT_COPY)
+
+        self.assertEqual(pathlib.Path(self.destination).read_bytes(), self.source_path.read_bytes())
+        self.assertNotEqual(os.stat(self.source).st_ino, os.stat(self.destination).st_ino)
+
+    def test_hardlink(self):
+        """Links the file without copying it"""
+
+        self.assertEqual(import_file(self.source, self.destination, IMPORT_HARDLINK), IMPORT_HARDLINK)
+
+        self.assertEqual(os.stat(self.source).st_ino, os.stat(self.destination).st_ino)
+
+    def test_reflink(self):
+        """Clones the file, falling back to copying it if the filesystem can't"""
+
+        strategy = import_file(self.source, self.destination, IMPORT_REFLINK)
+
+        self.assertIn(strategy, [IMPORT_REFLINK, IMPORT_COPY])
+        self.assertEqual(pathlib.Path(self.destination).read_bytes(), self.source_path.read_bytes())
+
+    def test_move(self):
+        """Moves the file"""
+
+        self.assertEqual(import_file(self.source, self.destination, IMPORT_MOVE), IMPORT_MOVE)
+
+        self.assertFalse(pathlib.Path(self.source).exists())
+        self.assertEqual(pathlib.Path(self.destination).read_bytes(), self.source_path.read_bytes())
+
+    def test_unknown(self):
+        """Rejects unknown strategies"""
+
+        with self.assertRaises(ValueError):
+            import_file(self.source, self.destination, 'teleport')
+
 class ValidUsernameTest(TestCase):
     def test_valid_username(self):
         usernames = ["test", "H0wITsDone", "cool_man123", "games_are_fun", "gamer", "SalC1", "yay"]
@@ -303,4 +480,85 @@ class HtmlDecodeTest(TestCase):
         ]
 
         for phrase in phrases:
-            self.assertEqual(html_decode(phrase), phrase)
\ No newline at end of file
+            self.assertEqual(html_decode(phrase), phrase)
+
+class GetMimetypeTest(TestCase):
+    def test_get_mimetype(self):
+        """Gets the mimetype from the contents of the file"""
+
+        self.assertEqual(get_mimetype("assets/TEST_DATA/content/felix.jpg"), "image/jpeg")
+        self.assertEqual(get_mimetype("assets/TEST_DATA/content/ana_cat.mp4"), "video/mp4")
+
+class BatchedTest(TestCase):
+    def test_batched(self):
+        """Splits the items into batches, with the remainder at the end"""
+
+        self.assertEqual(list(batched(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(batched([], 2)), [])
+
+class BatchedIdsTest(TestCase):
+    def setUp(self):
+        from booru.models import Post
+
+        self.posts = []
+
+        for i in range(5):
+            post = Post(width=420, height=420, folder=0, md5=hash_str(str(i)))
+            post.save()
+
+            self.posts.append(post.id)
+
+        self.queryset = Post.objects.all()
+
+    def test_batched_ids(self):
+        """Streams the ids in order"""
+
+        self.assertEqual(list(batched_ids(self.queryset.order_by('-id'), 2)), [self.posts[:2], self.posts[2:4], self.posts[4:]])
+
+    def test_limit(self):
+        """Stops after the limit"""
+
+        self.assertEqual(list(batched_ids(self.queryset, 2, limit=3)), [self.posts[:2], self.posts[2:3]])
+
+class ParallelMapTest(TestCase):
+    def test_results(self):
+        """Gets the result for every item"""
+
+        for workers in [1, 4]:
+            results = {item: result for item, result, error in parallel_map(lambda x: x * 2, range(50), workers)}
+
+            self.assertEqual(results, {i: i * 2 for i in range(50)})
+
+    def test_errors(self):
+        """Gives the errors rather than raising them"""
+
+        def fail_on_odd(x):
+            if x % 2 == 1:
+                raise ValueError(x)
+
+            return x
+
+        for workers in [1, 4]:
+            errors = [item for item, result, error in parallel_map(fail_on_odd, range(10), workers) if error is not None]
+
+            self.assertEqual(sorted(errors), [1, 3, 5, 7, 9])
+
+    def test_bounded(self):
+        """Only takes a few items from the iterable at a time"""
+
+        taken = []
+
+        def items():
+            for i in range(100):
+                taken.append(i)
+                yield i
+
+        results = parallel_map(lambda x: x, items(), workers=2, max_pending=4)
+
+        # Get the first result
+        next(results)
+
+        self.assertLessEqual(len(taken), 5)
+
+        # Finish it off
+        self.assertEqual(len(list(results)), 99)
@@ -1,11 +1,17 @@
 from django.test import TestCase
-from booru.models import Post, Tag, Implication
+from django.db import transaction
+from django.db.models.signals import post_save
+from booru.models import Post, Tag, Implication, ImplicationClosure
 
 class ImplicationApplyTest(TestCase):
     def setUp(self):
         Post.objects.all().delete()
         Tag.objects.all().delete()
         Implication.objects.all().delete()
+
+    def tearDown(self):
+        # The closure is kept in memory, but the rows are rolled back
+        ImplicationClosure.invalidate()
     
     def create_post(self):
         post = Post(width=420, height=420, folder=1, md5='ca6ffc3babb6f0f58a7e5c0c6b61e7bf')
@@ -176,4 +182,259 @@ class ImplicationApplyTest(TestCase):
         # a, b, and c should be on the post
         self.assertIn(a, post.tags.all())
         self.assertIn(b, post.tags.all())
-        self.assertIn(c, post.tags.all())
\ No newline at end of file
+        self.assertIn(c, post.tags.all())
+
+class ImplicationClosureTest(TestCase):
+    def setUp(self):
+        Post.objects.all().delete()
+        Tag.objects.all().delete()
+        Implication.objects.all().delete()
+
+    def tearDown(self):
+        # The closure is kept in memory, but the rows are rolled back
+        ImplicationClosure.invalidate()
+
+    def create_post(self, md5, tags = []):
+        post = Post(width=420, height=420, folder=1, md5=md5)
+        post.save()
+        post.tags.add(*[Tag.create_or_get(tag) for tag in tags])
+        return post
+
+    def test_closure(self):
+        """Compiles every tag that a tag implies, directly or not"""
+
+        Implication(parent='a', child='b').save()
+        Implication(parent='b', child='c').save()
+        Implication(parent='c', child='d').save()
+
+        self.assertEqual(ImplicationClosure.compile(), [])
+
+        closure = {(row.parent, row.child): row.depth for row in ImplicationClosure.objects.all()}
+
+        self.assertEqual(closure, {
+            ('a', 'b'): 1, ('a', 'c'): 2, ('a', 'd'): 3,
+            ('b', 'c'): 1, ('b', 'd'): 2,
+            ('c', 'd'): 1
+        })
+
+    def test_rejects_cycles(self):
+        """Implications that would create a cycle are not saved"""
+
+        Implication(parent='a', child='b').save()
+        Implication(parent='b', child='c').save()
+
+        with self.assertRaises(ValueError):
+            Implication(parent='c', child='a').save()
+
+        with self.assertRaises(ValueError):
+            Implication(parent='a', child='a').save()
+
+        self.assertEqual(Implication.objects.count(), 2)
+
+    def test_existing_cycles(self):
+        """Compiling the implications still finishes if they already contain a cycle"""
+
+        Implication(parent='a', child='b').save()
+        Implication(parent='b', child='c').save()
+
+        # Bypass the check, like an implication from before it existed
+        Implication.objects.bulk_create([Implication(parent='c', child='a')])
+
+        self.assertEqual(ImplicationClosure.compile(), [['a', 'b', 'c']])
+
+        self.assertEqual(
+            sorted(ImplicationClosure.objects.filter(parent='a').values_list('child', flat=True)),
+            ['b', 'c']
+        )
+
+    def test_apply_all(self):
+        """Applies the whole chain of implications in a single pass"""
+
+        first = self.create_post('ca6ffc3babb6f0f58a7e5c0c6b61e7bf', ['a'])
+        second = self.create_post('ca6ffc3babb6f0f58a7e5c0c6b61e7be', ['b', 'c'])
+        third = self.create_post('ca6ffc3babb6f0f58a7e5c0c6b61e7bd', ['other'])
+
+        # Bypass the signals, so that the posts are not changed when the implications are saved
+        Implication.objects.bulk_create([
+            Implication(parent='a', child='b'),
+            Implication(parent='b', child='c'),
+            Implication(parent='x', child='y')
+        ])
+
+        ImplicationClosure.compile()
+
+        self.assertEqual(ImplicationClosure.apply_all(), 1)
+
+        self.assertEqual(sorted(first.tags.values_list('tag', flat=True)), ['a', 'b', 'c'])
+        self.assertEqual(sorted(second.tags.values_list('tag', flat=True)), ['b', 'c'])
+        self.assertEqual(sorted(third.tags.values_list('tag', flat=True)), ['other'])
+
+        # The counts are kept up to date, and unused children are not created
+        self.assertEqual(Tag.objects.get(tag='b').post_count, 2)
+        self.assertEqual(Tag.objects.get(tag='c').post_count, 2)
+        self.assertFalse(Tag.objects.filter(tag='y').exists())
+
+        # Nothing is left to do
+        self.assertEqual(ImplicationClosure.apply_all(), 0)
+
+    def test_apply_all_batches(self):
+        """Applies the implications a batch of posts at a time"""
+
+        import homebooru.settings
+
+        for i in range(5):
+            self.create_post(f'ca6ffc3babb6f0f58a7e5c0c6b61e7b{i}', ['a'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Implication(parent='a', child='b').save()
+
+        batch_size = homebooru.settings.BOORU_IMPLICATION_BATCH_SIZE
+        homebooru.settings.BOORU_IMPLICATION_BATCH_SIZE = 2
+
+        try:
+            self.assertEqual(ImplicationClosure.apply_all(), 5)
+        finally:
+            homebooru.settings.BOORU_IMPLICATION_BATCH_SIZE = batch_size
+
+        self.assertEqual(Tag.objects.get(tag='b').post_count, 5)
+
+class ImplicationWriteTest(TestCase):
+    def setUp(self):
+        Post.objects.all().delete()
+        Tag.objects.all().delete()
+        Implication.objects.all().delete()
+
+        # The closure is compiled once the implications are committed
+        with self.captureOnCommitCallbacks(execute=True):
+            Implication(parent='a', child='b').save()
+            Implication(parent='b', child='c').save()
+
+        self.posts = [
+            Post(width=420, height=420, folder=1, md5=f'ca6ffc3babb6f0f58a7e5c0c6b61e7b{i}')
+            for i in range(3)
+        ]
+
+        for post in self.posts:
+            post.save()
+
+    def tearDown(self):
+        # The closure is kept in memory, but the rows are rolled back
+        ImplicationClosure.invalidate()
+
+    def get_tags(self, post):
+        return sorted(post.tags.values_list('tag', flat=True))
+
+    def test_adds_implied_tags(self):
+        """Adds the implied tags when tags are added to a post"""
+
+        self.posts[0].tags.add(Tag.create_or_get('a'))
+
+        self.assertEqual(self.get_tags(self.posts[0]), ['a', 'b', 'c'])
+        self.assertEqual(Tag.objects.get(tag='c').post_count, 1)
+
+    def test_adds_implied_tags_to_posts(self):
+        """Adds the implied tags when a tag is added to several posts"""
+
+        Tag.create_or_get('b').posts.add(*self.posts[:2])
+
+        self.assertEqual(self.get_tags(self.posts[0]), ['b', 'c'])
+        self.assertEqual(self.get_tags(self.posts[1]), ['b', 'c'])
+        self.assertEqual(self.get_tags(self.posts[2]), [])
+
+    def test_edit_tags(self):
+        """Expands the tags of the edits"""
+
+        Post.edit_tags(self.posts, add=['a'])
+
+        for post in self.posts:
+            self.assertEqual(self.get_tags(post), ['a', 'b', 'c'])
+
+    def test_implication_changes(self):
+        """Uses the new implications as soon as they are saved"""
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Implication(parent='c', child='d').save()
+
+        self.posts[0].tags.add(Tag.create_or_get('a'))
+        self.assertEqual(self.get_tags(self.posts[0]), ['a', 'b', 'c', 'd'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Implication.objects.filter(parent='b').delete()
+
+        self.posts[1].tags.add(Tag.create_or_get('a'))
+        self.assertEqual(self.get_tags(self.posts[1]), ['a', 'b'])
+
+    def test_compiles_once(self):
+        """Compiles the closure once per transaction, and not for fixtures"""
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            Implication(parent='c', child='d').save()
+            Implication(parent='d', child='e').save()
+            Implication.objects.filter(parent='d').delete()
+
+        # The first callback compiles the closure for all of the changes
+        callbacks[0]()
+
+        self.assertEqual(ImplicationClosure.get_implied_tags(['c']), {'d'})
+
+        with self.assertNumQueries(0):
+            for callback in callbacks[1:]:
+                callback()
+
+        # Loading a fixture
+        with self.captureOnCommitCallbacks() as callbacks:
+            post_save.send(sender=Implication, instance=Implication(parent='x', child='y'), created=True, raw=True)
+
+        self.assertEqual(len(callbacks), 0)
+
+    def test_compiles_after_rollback(self):
+        """Still compiles the closure after a transaction with changes was rolled back"""
+
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Implication(parent='c', child='d').save()
+
+                    raise ValueError()
+            except ValueError:
+                pass
+
+            Implication(parent='c', child='e').save()
+
+        self.assertEqual(ImplicationClosure.get_implied_tags(['c']), {'e'})
+
+    def test_no_queries_without_implications(self):
+        """Doesn't look up the implied tags of tags without any"""
+
+        tag = Tag.create_or_get('other')
+
+        # The closure is only read once
+        ImplicationClosure.get_map()
+
+        # Only the existing rows, the insert and the post count
+        with self.assertNumQueries(3):
+            self.posts[0].tags.add(tag)
+
+    def test_sweep(self):
+        """Only checks the posts since the last sweep"""
+
+        ImplicationClosure.sweep()
+
+        # Added without the signals
+        Post.tags.through.objects.bulk_create([Post.tags.through(post=self.posts[2], tag=Tag.create_or_get('a'))])
+
+        post = Post(width=420, height=420, folder=1, md5='ca6ffc3babb6f0f58a7e5c0c6b61e7bf')
+        post.save()
+        Post.tags.through.objects.bulk_create([Post.tags.through(post=post, tag=Tag.create_or_get('a'))])
+
+        # Only the new post is checked
+        self.assertEqual(ImplicationClosure.sweep(), 1)
+        self.assertEqual(self.get_tags(post), ['a', 'b', 'c'])
+        self.assertEqual(self.get_tags(self.posts[2]), ['a'])
+
+        # Changing the implications checks every post again
+        with self.captureOnCommitCallbacks(execute=True):
+            Implication(parent='x', child='y').save()
+
+        self.assertEqual(ImplicationClosure.sweep(), 1)
+        self.assertEqual(self.get_tags(self.posts[2]), ['a', 'b', 'c'])
@@ -1,9 +1,13 @@
 from django.test import TestCase
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
 
 from booru.models.posts import Post, Rating
 from booru.models.tags import Tag, TagType
 from booru.models.comments import Comment
+from booru.models.posts_search_cache import SearchCache
 
 import hashlib
 import os
@@ -13,6 +17,7 @@ import math
 
 import booru.tests.testutils as testutils
 import booru.boorutils as boorutils
+from booru.pagination import Paginator, CursorPaginator
 
 import homebooru.settings
 
@@ -317,6 +322,96 @@ class PostCreateFromFileTest(TestCase):
         # Check that the post was not created
         self.assertEqual(Post.objects.count(), 0)
 
+    def test_create_unprocessed(self):
+        """Creates a post without its thumbnail and sample, which are generated when it is processed"""
+
+        p = Post.create_from_file(self.test_sampleable_path, process=False)
+        p.save()
+
+        self.assertEqual(p.status, Post.STATUS_PROCESSING)
+        self.assertFalse(p.is_ready)
+
+        # Only the media is stored
+        self.assertTrue(p.get_media_path().exists())
+        self.assertFalse(p.get_thumbnail_path().exists())
+        self.assertFalse(p.get_sample_path().exists())
+
+        self.assertTrue(p.process())
+
+        p = Post.objects.get(id=p.id)
+
+        self.assertEqual(p.status, Post.STATUS_READY)
+        self.assertTrue(p.sample)
+        self.assertTrue(p.get_thumbnail_path().exists())
+        self.assertTrue(p.get_sample_path().exists())
+
+    def test_create_unprocessed_undecodable(self):
+        """Rejects files that can't be decoded even though their header can be read"""
+
+        with self.assertRaises(Exception):
+            Post.create_from_file(testutils.CORRUPT_FELIX_PATH, process=False)
+
+        self.assertEqual(Post.objects.count(), 0)
+
+    def test_process_failed(self):
+        """Marks the post as failed if its derivatives can't be generated"""
+
+        p = Post.create_from_file(self.test_image_path, process=False)
+        p.save()
+
+        # Break the stored media
+        p.get_media_path().write_bytes(b'not an image')
+
+        self.assertFalse(p.process())
+
+        p = Post.objects.get(id=p.id)
+
+        self.assertEqual(p.status, Post.STATUS_FAILED)
+        self.assertFalse(p.get_thumbnail_path().exists())
+
+    def test_move_rolled_back(self):
+        """Keeps the original of a moved file if the post is rolled back"""
+
+        original = pathlib.Path(self.temp_storage.temp_storage_path) / 'original.jpg'
+        original.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy(self.test_image_path, original)
+
+        try:
+            with transaction.atomic():
+                Post.create_from_file(original, strategy=boorutils.IMPORT_MOVE).save()
+                raise ValueError('Roll back')
+        except ValueError:
+            pass
+
+        self.assertEqual(Post.objects.count(), 0)
+        self.assertTrue(original.exists())
+
+    def test_import_errors(self):
+        """Doesn't create a post if the file can't be imported"""
+
+        # Put a folder where the media should go
+        md5 = boorutils.get_file_checksum(self.test_image_path)
+        (pathlib.Path(self.temp_storage.temp_storage_path) / 'media' / '1' / f'{md5}.jpg').mkdir(parents=True)
+
+        with self.assertRaises(Exception):
+            Post.create_from_file(self.test_image_path)
+
+    def test_rejects_too_many_pixels(self):
+        """Rejects content with too many pixels without decoding it"""
+
+        og_max_pixels = homebooru.settings.BOORU_MAX_PIXELS
+        homebooru.settings.BOORU_MAX_PIXELS = 100
+
+        try:
+            with self.assertRaises(boorutils.ContentTooLarge):
+                Post.create_from_file(self.test_image_path)
+        finally:
+            homebooru.settings.BOORU_MAX_PIXELS = og_max_pixels
+
+        # Check that the post was not created
+        self.assertEqual(Post.objects.count(), 0)
+        self.assertEqual(len(os.listdir(self.temp_storage.temp_storage_path)), 0)
+
 class PostSearchTest(TestCase):
     p1 = None
     p2 = None
@@ -325,7 +420,7 @@ class PostSearchTest(TestCase):
     tag3 = None
     tag4 = None
 
-    fixtures = ['ratings.json']
+    fixtures = ['tagtypes.json', 'ratings.json']
 
     def setUp(self):
         Post.objects.all().delete()
@@ -467,6 +562,28 @@ class PostSearchTest(TestCase):
 
         self.assertEqual(len(results), 0)
 
+    def test_search_is_single_query(self):
+        """Resolves all of the tags in one lookup and then runs the search as one query"""
+
+        with self.assertNumQueries(2):
+            results = list(Post.search('tag1 -tag2 tag3 tag4 *1', use_cache=False))
+
+        self.assertEqual(results, [self.p2])
+
+        # Wildcards and parameters do not need a tag lookup
+        with self.assertNumQueries(1):
+            results = list(Post.search('*3 -width:100', use_cache=False))
+
+        self.assertEqual(results, [self.p2])
+
+    def test_invalid_parameter_makes_no_queries(self):
+        """Does not touch the database if the phrase can never match"""
+
+        with self.assertNumQueries(0):
+            results = list(Post.search('tag1 width:abc'))
+
+        self.assertEqual(results, [])
+
     def test_exclude_tag(self):
         # Search for all posts without tag1
         results = Post.search('-tag1')
@@ -590,12 +707,59 @@ class PostSearchTest(TestCase):
         # Get the list of tag names
         tag_names = [tag.tag for tag in tags]
 
-        # The only tags that should be displayed are the tags from the second post
-        expected_names = [tag.tag for tag in self.p2.tags.all()]
+        # The only tags that should be displayed are the tags from the second post (sorted by their total posts)
+        expected_names = [tag.tag for tag in sorted(self.p2.tags.all(), key=lambda tag: (-tag.total_posts, tag.tag))]
 
         # Make sure they're in the correct order
         self.assertEqual(tag_names, expected_names)
     
+    def test_get_search_tags_single_query(self):
+        """Gets the tags and their totals in a single query"""
+
+        results = Post.search('')
+
+        with self.assertNumQueries(1):
+            tags = Post.get_search_tags(results)
+
+            # The totals and types should not need any more queries
+            for tag in tags:
+                tag.total_posts
+                tag.tag_type.name
+
+        self.assertEqual(len(tags), 4)
+
+        # Make sure that the types were actually loaded with the tags
+        self.assertTrue(all(tag.tag_type_id is not None for tag in tags))
+
+    def test_get_search_tags_paginated(self):
+        """Only gets the tags from the posts on the page"""
+
+        # Get the page with only the first post on it
+        posts, _ = Paginator.paginate(Post.search(''), 1, 1)
+
+        tags = Post.get_search_tags(posts)
+
+        self.assertEqual(set(tag.tag for tag in tags), set(tag.tag for tag in self.p2.tags.all()))
+
+    def test_get_search_tags_name_sort(self):
+        """Sorts the tags by name when the setting is name"""
+
+        og_sort = homebooru.settings.BOORU_BROWSE_TAGS_SORT
+        homebooru.settings.BOORU_BROWSE_TAGS_SORT = 'name'
+
+        try:
+            tags = Post.get_search_tags(Post.search(''))
+        finally:
+            homebooru.settings.BOORU_BROWSE_TAGS_SORT = og_sort
+
+        tag_names = [tag.tag for tag in tags]
+        self.assertEqual(tag_names, sorted(tag_names))
+
+        # Reversing the sort should flip the order
+        tags = Post.get_search_tags(Post.search(''), sort_by='name', reverse=True)
+
+        self.assertEqual([tag.tag for tag in tags], sorted(tag_names, reverse=True))
+
     def test_get_search_tags_different_lambda(self):
         """Sorts the tags differently depending on the lambda passed"""
 
@@ -996,6 +1160,224 @@ class PostSearchTest(TestCase):
         # There should be 100 results
         self.assertEqual(results.count(), 100)
 
+class PostSearchCacheTest(TestCase):
+    fixtures = ['ratings.json']
+
+    def setUp(self):
+        super().setUp()
+
+        # Start with an empty cache
+        cache.clear()
+
+        self.p1 = Post(width=420, height=420, folder=0, md5='ca6ffc3babb6f0f58a7e5c0c6b61e7bf')
+        self.p1.save()
+
+        self.p2 = Post(width=420, height=420, folder=0, md5='ca6ffc3b4bb6f0f58a7e5c0c6b61e7bf')
+        self.p2.save()
+
+        self.tag1 = Tag.create_or_get('tag1')
+        self.tag2 = Tag.create_or_get('tag2')
+
+        self.p1.tags.add(self.tag1, self.tag2)
+        self.p2.tags.add(self.tag1)
+
+    def test_caches_results(self):
+        """Only runs the search once"""
+
+        # Fill the cache
+        self.assertEqual(list(Post.search('tag1')), [self.p2, self.p1])
+
+        # Only the cached ids should need to be fetched
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Post.search('tag1')), [self.p2, self.p1])
+
+        stats = SearchCache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_normalizes_phrase(self):
+        """Phrases with the same words share the same results"""
+
+        Post.search('tag1 tag2')
+        Post.search('  tag2 tag1 tag2')
+
+        self.assertEqual(SearchCache.stats()['hits'], 1)
+
+    def test_invalidates_on_retag(self):
+        """Adding or removing a tag from a post invalidates the searches with the tag"""
+
+        self.assertEqual(list(Post.search('tag2')), [self.p1])
+
+        self.p2.tags.add(self.tag2)
+        self.assertEqual(list(Post.search('tag2')), [self.p2, self.p1])
+
+        self.p1.tags.remove(self.tag2)
+        self.assertEqual(list(Post.search('tag2')), [self.p2])
+
+        self.tag2.posts.clear()
+        self.assertEqual(list(Post.search('tag2')), [])
+
+    def test_invalidates_on_delete(self):
+        """Deleting a post invalidates the searches with its tags"""
+
+        self.assertEqual(list(Post.search('tag1')), [self.p2, self.p1])
+
+        self.p2.delete()
+
+        self.assertEqual(list(Post.search('tag1')), [self.p1])
+
+    def test_keeps_unrelated_searches(self):
+        """Changing one tag does not invalidate searches for other tags"""
+
+        Post.search('tag1')
+
+        tag3 = Tag.create_or_get('tag3')
+        self.p1.tags.add(tag3)
+
+        Post.search('tag1')
+
+        self.assertEqual(SearchCache.stats()['hits'], 1)
+
+    def test_invalidates_exclusions_on_new_post(self):
+        """Searches that do not only depend on their tags are invalidated by new posts"""
+
+        self.assertEqual(list(Post.search('-tag2')), [self.p2])
+
+        p3 = Post(width=420, height=420, folder=0, md5=boorutils.hash_str('p3'))
+        p3.save()
+
+        self.assertEqual(list(Post.search('-tag2')), [p3, self.p2])
+
+    def test_invalidates_exclusions_on_searched_change(self):
+        """Searches that do not only depend on their tags are invalidated when a searched field changes"""
+
+        self.assertEqual(list(Post.search('title:changed')), [])
+        self.assertEqual(list(Post.search('-rating:safe')), [])
+
+        self.p2.title = 'changed'
+        self.p2.save()
+
+        self.assertEqual(list(Post.search('title:changed')), [self.p2])
+
+        self.p1.rating = Rating.objects.get(pk='explicit')
+        self.p1.save()
+
+        self.assertEqual(list(Post.search('-rating:safe')), [self.p1])
+
+    def test_keeps_exclusions_on_other_change(self):
+        """Saving a post without changing a searched field does not invalidate the searches"""
+
+        Post.search('-tag2')
+
+        # Processing a post only changes its status
+        self.p2.status = Post.STATUS_FAILED
+        self.p2.save(update_fields=['status'])
+
+        p2 = Post.objects.get(id=self.p2.id)
+        p2.source = 'https://example.com/'
+        p2.save()
+
+        Post.search('-tag2')
+
+        self.assertEqual(SearchCache.stats()['hits'], 1)
+
+    def test_large_results(self):
+        """Caches the start of searches with more results than are kept, serving the pages in it from the cache"""
+
+        og_max = homebooru.settings.BOORU_SEARCH_CACHE_MAX_RESULTS
+        homebooru.settings.BOORU_SEARCH_CACHE_MAX_RESULTS = 1
+
+        try:
+            self.assertEqual(list(Post.search('tag1')), [self.p2, self.p1])
+
+            # Only the tags are checked and the page is fetched, the search and the count are not run again
+            with self.assertNumQueries(2):
+                results = Post.search('tag1')
+                posts, paginator = Paginator.paginate(results, 1, 1)
+
+            self.assertEqual(list(posts), [self.p2])
+            self.assertEqual(paginator.total_count, 2)
+            self.assertEqual(SearchCache.stats()['hits'], 1)
+
+            # The same goes for the cursors
+            with self.assertNumQueries(1):
+                posts, paginator = CursorPaginator.paginate(results, 1)
+
+            self.assertEqual(posts, [self.p2])
+            self.assertEqual(paginator.total_count, 2)
+
+            # Pages past the cached ids run the search
+            self.assertEqual(list(Paginator.paginate(results, 2, 1)[0]), [self.p1])
+            self.assertEqual(CursorPaginator.paginate(results, 1, after=paginator.next)[0], [self.p1])
+        finally:
+            homebooru.settings.BOORU_SEARCH_CACHE_MAX_RESULTS = og_max
+
+    def test_caches_empty_phrase(self):
+        """Caches the posts on the front page, until a post is added"""
+
+        self.assertEqual(list(Post.search('')), [self.p2, self.p1])
+        self.assertEqual(list(Post.search('')), [self.p2, self.p1])
+
+        self.assertEqual(SearchCache.stats()['hits'], 1)
+
+        p3 = Post(width=420, height=420, folder=0, md5=boorutils.hash_str('p3'))
+        p3.save()
+
+        self.assertEqual(list(Post.search('')), [p3, self.p2, self.p1])
+
+    def test_cursors_from_cache(self):
+        """Walks forwards and backwards through the cached ids, with or without the end of the results in them"""
+
+        for i in range(5):
+            Post(width=420, height=420, folder=0, md5=boorutils.hash_str(str(i))).save()
+
+        expected = list(Post.objects.order_by('-id'))
+
+        og_max = homebooru.settings.BOORU_SEARCH_CACHE_MAX_RESULTS
+
+        try:
+            for max_results in [100, 4]:
+                cache.clear()
+                homebooru.settings.BOORU_SEARCH_CACHE_MAX_RESULTS = max_results
+
+                results = Post.search('')
+
+                seen = []
+                posts, paginator = CursorPaginator.paginate(results, 2)
+                seen += posts
+
+                while paginator.has_next:
+                    posts, paginator = CursorPaginator.paginate(results, 2, after=paginator.next)
+                    seen += posts
+
+                self.assertEqual(seen, expected)
+
+                # Walk back to the start
+                seen = []
+
+                while paginator.has_prev:
+                    posts, paginator = CursorPaginator.paginate(results, 2, before=paginator.prev)
+                    seen = posts + seen
+
+                self.assertEqual(seen, expected[:-1])
+                self.assertEqual(paginator.total_count, 7)
+        finally:
+            homebooru.settings.BOORU_SEARCH_CACHE_MAX_RESULTS = og_max
+
+    def test_disabled(self):
+        """Does not use the cache when it is disabled"""
+
+        homebooru.settings.BOORU_SEARCH_CACHE_ENABLED = False
+
+        try:
+            Post.search('tag1')
+            Post.search('tag1')
+        finally:
+            homebooru.settings.BOORU_SEARCH_CACHE_ENABLED = True
+
+        self.assertEqual(SearchCache.stats()['misses'], 0)
+
 class PostDeleteTest(TestCase):
     temp_storage = testutils.TempStorage()
 
@@ -1135,6 +1517,90 @@ class PostDeleteTest(TestCase):
     #     for path in paths:
     #         self.assertFalse(path.exists())
 
+class PostEditTagsTest(TestCase):
+    fixtures = ['booru/fixtures/tagtypes.json']
+
+    def setUp(self):
+        self.posts = []
+
+        for i in range(3):
+            post = Post(width=420, height=420, folder=0, md5=boorutils.hash_str(str(i)))
+            post.save()
+
+            self.posts.append(post)
+
+        self.posts[0].tags.add(*Tag.create_or_get_many(['tag1', 'tag2', 'tag3']))
+
+    def get_tags(self, post):
+        return set(post.tags.values_list('tag', flat=True))
+
+    def get_count(self, name):
+        return Tag.objects.get(tag=name).post_count
+
+    def test_set_tags(self):
+        """Changes the tags of a post to the given names"""
+
+        changes = self.posts[0].set_tags(['tag1', 'tag3', 'tag4'])
+
+        self.assertEqual(changes, {'added': ['tag4'], 'removed': ['tag2']})
+        self.assertEqual(self.get_tags(self.posts[0]), {'tag1', 'tag3', 'tag4'})
+
+        # Make sure that the counts are kept up to date
+        self.assertEqual(self.get_count('tag2'), 0)
+        self.assertEqual(self.get_count('tag4'), 1)
+
+    def test_set_tags_only_changes_diff(self):
+        """Leaves the rows of the tags that didn't change alone"""
+
+        through = Post.tags.through
+        row = through.objects.get(post=self.posts[0], tag_id='tag1')
+
+        self.posts[0].set_tags(['tag1', 'tag5'])
+
+        # The same row still exists
+        self.assertTrue(through.objects.filter(id=row.id).exists())
+
+    def test_set_tags_unchanged(self):
+        """Doesn't change anything if the tags are the same"""
+
+        # Only the current tags are read
+        with self.assertNumQueries(1):
+            changes = self.posts[0].set_tags(['tag3', 'tag2', 'tag1'])
+
+        self.assertEqual(changes, {'added': [], 'removed': []})
+
+    def test_edit_many(self):
+        """Adds and removes tags across many posts"""
+
+        changes = Post.edit_tags(self.posts, add=['tag4', 'tag1'], remove=['tag2', 'missing'])
+
+        self.assertEqual(changes, {'added': ['tag1', 'tag4'], 'removed': ['tag2']})
+
+        for post in self.posts:
+            self.assertIn('tag4', self.get_tags(post))
+            self.assertNotIn('tag2', self.get_tags(post))
+
+        # The missing tag isn't created
+        self.assertFalse(Tag.objects.filter(tag='missing').exists())
+
+        self.assertEqual(self.get_count('tag1'), 3)
+        self.assertEqual(self.get_count('tag2'), 0)
+        self.assertEqual(self.get_count('tag4'), 3)
+
+    def test_edit_many_queries(self):
+        """Doesn't make more queries for more posts"""
+
+        # Warm up the tags
+        Post.edit_tags(self.posts[:2], add=['tag4'])
+
+        with CaptureQueriesContext(connection) as few:
+            Post.edit_tags(self.posts[:2], add=['tag5'], remove=['tag4'])
+
+        with CaptureQueriesContext(connection) as many:
+            Post.edit_tags(self.posts, add=['tag6'], remove=['tag5'])
+
+        self.assertEqual(len(few), len(many))
+
 class PostGetSortedTags(TestCase):
     fixtures = ['booru/fixtures/tagtypes.json']
     temp_storage = testutils.TempStorage()
@@ -1344,6 +1810,38 @@ class PostGetProximatePosts(TestCase):
         self.assertEqual(posts['newer'], self.newest)
         self.assertEqual(posts['older'], self.oldest)
 
+    def test_reads_one_row_each_way(self):
+        """Finds each neighbour with a single limited query"""
+        results = Post.search('', use_cache=False)
+
+        with self.assertNumQueries(2) as context:
+            posts = self.middle.get_proximate_posts(results)
+
+        self.assertEqual(posts['newer'], self.newest)
+        self.assertEqual(posts['older'], self.oldest)
+
+        # Both queries should be ordered away from the post, only taking the closest one
+        older_sql, newer_sql = [query['sql'] for query in context.captured_queries]
+
+        self.assertIn('ORDER BY "booru_post"."id" DESC LIMIT 1', older_sql)
+        self.assertIn('ORDER BY "booru_post"."id" ASC LIMIT 1', newer_sql)
+
+    def test_cached_neighbours(self):
+        """Finds the neighbours from the cached results in a single query"""
+        cache.clear()
+
+        results = Post.search('')
+
+        with self.assertNumQueries(1):
+            posts = self.middle.get_proximate_posts(results)
+
+        self.assertEqual(posts['newer'], self.newest)
+        self.assertEqual(posts['older'], self.oldest)
+
+        # The ends of the results have no neighbours on one side
+        self.assertEqual(self.newest.get_proximate_posts(results)['newer'], None)
+        self.assertEqual(self.olderest.get_proximate_posts(results)['older'], None)
+
 class RatingGetDefaultTest(TestCase):
     fixtures = ['tagtypes.json', 'ratings.json']
 
@@ -1476,6 +1974,9 @@ class GetSearchTagsLambdaTest(TestCase):
 
         # Save the post
         self.post.save()
+
+        # Get the tag's new post count
+        self.tag.refresh_from_db()
     
     def tearDown(self) -> None:
         homebooru.settings.BOORU_BROWSE_TAGS_SORT = self.og_sort
@@ -125,6 +125,43 @@ class TagTest(TestCase):
         # Make sure that a new tag was not created
         self.assertEqual(Tag.objects.count(), 1)
     
+    def test_create_or_get_many(self):
+        """Creates the missing tags and gets the existing ones in three queries"""
+
+        # Create a tag with a different type
+        artist = TagType(name='artist', description='Artist')
+        artist.save()
+
+        Tag(tag='tag1', tag_type=artist).save()
+
+        with self.assertNumQueries(3):
+            tags = Tag.create_or_get_many(['tag2', 'tag1', 'tag3', 'tag2'])
+
+        # Make sure that they are in order without duplicates
+        self.assertEqual([tag.tag for tag in tags], ['tag2', 'tag1', 'tag3'])
+
+        # Make sure that the existing tag wasn't changed and the new ones have the default type
+        self.assertEqual(tags[1].tag_type, artist)
+        self.assertEqual(tags[0].tag_type, TagType.get_default())
+
+        self.assertEqual(Tag.objects.count(), 3)
+
+    def test_create_or_get_many_no_default_type(self):
+        """Creates the tags without a type if the default type doesn't exist, like save does"""
+
+        TagType.objects.filter(name=homebooru.settings.BOORU_DEFAULT_TAG_TYPE_PK).delete()
+
+        tags = Tag.create_or_get_many(['tag1', 'tag2'])
+
+        self.assertEqual([tag.tag_type for tag in tags], [None, None])
+        self.assertEqual(Tag.objects.filter(tag_type=None).count(), 2)
+
+    def test_create_or_get_many_empty(self):
+        """Doesn't query anything for no tags"""
+
+        with self.assertNumQueries(0):
+            self.assertEqual(Tag.create_or_get_many([]), [])
+
     def test_is_name_valid_with_valid(self):
         """Accepts valid tag names"""
 
@@ -424,6 +461,116 @@ class TagSearchTest(TestCase):
         # Make sure the tag is in the list
         self.assertEqual(len(tags), 0)
 
+class TagPostCountTest(TestCase):
+    fixtures = ['booru/fixtures/tagtypes.json']
+
+    def setUp(self):
+        self.tag1 = Tag.create_or_get('tag1')
+        self.tag2 = Tag.create_or_get('tag2')
+
+        self.posts = []
+        for i in range(3):
+            post = Post(width=420, height=420, folder=0, md5=boorutils.hash_str(str(i)))
+            post.save()
+
+            self.posts.append(post)
+
+    def get_count(self, tag):
+        return Tag.objects.get(tag=tag.tag).post_count
+
+    def test_add(self):
+        """Increments the count when tags are added to a post"""
+
+        self.posts[0].tags.add(self.tag1, self.tag2)
+        self.posts[1].tags.add(self.tag1)
+
+        self.assertEqual(self.get_count(self.tag1), 2)
+        self.assertEqual(self.get_count(self.tag2), 1)
+
+        # Adding it again does nothing
+        self.posts[0].tags.add(self.tag1)
+
+        self.assertEqual(self.get_count(self.tag1), 2)
+
+    def test_add_reverse(self):
+        """Increments the count when posts are added to a tag"""
+
+        self.tag1.posts.add(*self.posts)
+
+        self.assertEqual(self.get_count(self.tag1), 3)
+        self.assertEqual(self.tag1.post_count, 3)
+
+    def test_remove(self):
+        """Decrements the count when tags are removed"""
+
+        self.posts[0].tags.add(self.tag1, self.tag2)
+        self.posts[1].tags.add(self.tag1)
+
+        # Remove a tag that is on the post and one that isn't
+        self.posts[1].tags.remove(self.tag1, self.tag2)
+
+        self.assertEqual(self.get_count(self.tag1), 1)
+        self.assertEqual(self.get_count(self.tag2), 1)
+
+        # Remove from the other side
+        self.tag2.posts.remove(self.posts[0], self.posts[2])
+
+        self.assertEqual(self.get_count(self.tag2), 0)
+
+    def test_clear(self):
+        """Decrements the count when the tags are cleared"""
+
+        self.posts[0].tags.add(self.tag1, self.tag2)
+        self.posts[1].tags.add(self.tag1)
+
+        self.posts[0].tags.clear()
+
+        self.assertEqual(self.get_count(self.tag1), 1)
+        self.assertEqual(self.get_count(self.tag2), 0)
+
+        self.tag1.posts.clear()
+
+        self.assertEqual(self.get_count(self.tag1), 0)
+
+    def test_delete_post(self):
+        """Decrements the count when a post is deleted"""
+
+        self.posts[0].tags.add(self.tag1, self.tag2)
+        self.posts[1].tags.add(self.tag1)
+
+        Post.objects.filter(id=self.posts[0].id).delete()
+
+        self.assertEqual(self.get_count(self.tag1), 1)
+        self.assertEqual(self.get_count(self.tag2), 0)
+
+    def test_save_keeps_count(self):
+        """Does not overwrite the count when saving an out of date tag"""
+
+        self.posts[0].tags.add(self.tag1)
+
+        # This instance still thinks there are no posts
+        self.tag1.tag_type = TagType.objects.get(name='artist')
+        self.tag1.save()
+
+        tag = Tag.objects.get(tag='tag1')
+
+        self.assertEqual(tag.post_count, 1)
+        self.assertEqual(tag.tag_type.name, 'artist')
+
+    def test_recount(self):
+        """Rebuilds the counts from the post tags"""
+
+        self.posts[0].tags.add(self.tag1, self.tag2)
+        self.posts[1].tags.add(self.tag1)
+
+        # Break the counts
+        Tag.objects.update(post_count=42)
+
+        self.assertEqual(Tag.recount(), 2)
+
+        self.assertEqual(self.get_count(self.tag1), 2)
+        self.assertEqual(self.get_count(self.tag2), 1)
+
 class TagTypeTest(TestCase):
     fixtures = ['booru/fixtures/tagtypes.json']
 
@@ -1,8 +1,9 @@
 from django.test import TestCase
+from django.core.cache import cache
 
 import math
 
-from booru.pagination import Paginator
+from booru.pagination import Paginator, CursorPaginator
 from booru.models import Post
 import booru.boorutils as boorutils
 
@@ -156,4 +157,140 @@ class PaginatorPaginate(TestCase):
     
     def test_pagination_with_odd(self):
         """Pagination with odd number of results"""
-        self.assertPaginated(per_page=11)
\ No newline at end of file
+        self.assertPaginated(per_page=11)
+
+class CursorPaginatorTest(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        # Forget any cached totals
+        cache.clear()
+
+        # Create a bunch of posts for generating a query set
+        for i in range(0, 25):
+            post = Post(width=420, height=420, folder=0, md5=boorutils.hash_str(str(i)))
+            post.save()
+
+        self.all_posts = list(Post.objects.all().order_by('-id'))
+
+    def test_cursor_round_trip(self):
+        """Decodes the values that were encoded"""
+        token = CursorPaginator.encode_cursor([42, 7])
+
+        self.assertEqual(CursorPaginator.decode_cursor(token, 2), [42, 7])
+
+    def test_invalid_cursor(self):
+        """Ignores tokens that are not valid"""
+        self.assertIsNone(CursorPaginator.decode_cursor(None, 1))
+        self.assertIsNone(CursorPaginator.decode_cursor('not a token!', 1))
+
+        # Wrong number of values
+        self.assertIsNone(CursorPaginator.decode_cursor(CursorPaginator.encode_cursor([1, 2]), 1))
+
+    def test_first_page(self):
+        """Gets the first page with no previous page"""
+        results, p = CursorPaginator.paginate(Post.objects.all(), 10)
+
+        self.assertEqual(results, self.all_posts[:10])
+        self.assertFalse(p.has_prev)
+        self.assertTrue(p.has_next)
+        self.assertEqual(p.total_count, 25)
+        self.assertEqual(p.total_pages, 3)
+
+    def test_walk_forwards_and_backwards(self):
+        """Following the tokens visits every post once"""
+        qs = Post.objects.all()
+
+        seen = []
+        results, p = CursorPaginator.paginate(qs, 10)
+        seen += results
+
+        while p.has_next:
+            results, p = CursorPaginator.paginate(qs, 10, after=p.next)
+            seen += results
+
+        self.assertEqual(seen, self.all_posts)
+
+        # The last page should only have the remaining posts
+        self.assertEqual(len(results), 5)
+        self.assertTrue(p.has_prev)
+
+        # Go back a page
+        results, p = CursorPaginator.paginate(qs, 10, before=p.prev)
+
+        self.assertEqual(results, self.all_posts[10:20])
+        self.assertTrue(p.has_prev)
+        self.assertTrue(p.has_next)
+
+        # And back to the start
+        results, p = CursorPaginator.paginate(qs, 10, before=p.prev)
+
+        self.assertEqual(results, self.all_posts[:10])
+        self.assertFalse(p.has_prev)
+
+    def test_does_not_offset(self):
+        """Seeks to the cursor rather than skipping rows"""
+        token = CursorPaginator.get_cursor(self.all_posts[19], ['-id'])
+
+        # Count the cached total first
+        CursorPaginator.paginate(Post.objects.all(), 10)
+
+        with self.assertNumQueries(1) as context:
+            results, p = CursorPaginator.paginate(Post.objects.all(), 10, after=token)
+
+        self.assertEqual(results, self.all_posts[20:])
+        self.assertNotIn('OFFSET', context.captured_queries[0]['sql'])
+
+    def test_ascending_ordering(self):
+        """Supports other orderings, with a tie breaker"""
+        qs = Post.objects.all()
+        ordering = ['width', 'id']
+
+        results, p = CursorPaginator.paginate(qs, 10, ordering=ordering)
+        results2, p = CursorPaginator.paginate(qs, 10, after=p.next, ordering=ordering)
+
+        expected = list(qs.order_by(*ordering))
+
+        self.assertEqual(results + results2, expected[:20])
+
+    def test_nullable_ordering(self):
+        """Puts the nulls of nullable fields last, and can point a cursor at them"""
+        for i, post in enumerate(self.all_posts):
+            post.title = None if i % 3 == 0 else str(i % 5)
+            post.save()
+
+        qs = Post.objects.all()
+
+        for ordering in [['title', 'id'], ['-title', 'id']]:
+            expected = list(qs.order_by(*CursorPaginator.get_order_by(qs, ordering)))
+
+            # The nulls are at the end either way
+            self.assertIsNone(expected[-1].title)
+            self.assertIsNotNone(expected[0].title)
+
+            seen = []
+            results, p = CursorPaginator.paginate(qs, 4, ordering=ordering)
+            seen += results
+
+            while p.has_next:
+                results, p = CursorPaginator.paginate(qs, 4, after=p.next, ordering=ordering)
+                seen += results
+
+            self.assertEqual(seen, expected)
+
+            # Go back from the last page, which starts on a null
+            start = len(expected) - len(results)
+            self.assertIsNone(results[0].title)
+
+            results, p = CursorPaginator.paginate(qs, 4, before=p.prev, ordering=ordering)
+
+            self.assertEqual(results, expected[start - 4:start])
+
+    def test_empty(self):
+        """Handles an empty result"""
+        results, p = CursorPaginator.paginate(Post.objects.none(), 10)
+
+        self.assertEqual(results, [])
+        self.assertFalse(p.has_prev)
+        self.assertFalse(p.has_next)
+        self.assertEqual(p.total_count, 0)
@@ -1512,6 +1512,89 @@ class PostEditTags(TestCase):
         self.assertEqual(post.tags.count(), 2)
         self.assertEqual(set([tag.tag for tag in post.tags.all()]), {'felix_argyle', 'catboy'})
 
+class PostBulkEditTags(TestCase):
+    def setUp(self):
+        self.temp_storage = testutils.TempStorage()
+        self.temp_storage.setUp()
+
+        # Create a user
+        self.user = User.objects.create_user(username='test', password='huevo')
+        self.user.save()
+
+        # Create some posts owned by the user
+        self.posts = []
+
+        for path in [testutils.FELIX_PATH, testutils.GATO_PATH]:
+            post = Post.create_from_file(path)
+            post.owner = self.user
+            post.save()
+
+            post.tags.add(Tag.create_or_get('cat'))
+
+            self.posts.append(post)
+
+    def tearDown(self):
+        self.temp_storage.tearDown()
+
+    def send_request(self, posts, add='', remove=''):
+        """Sends a request to the bulk tags view"""
+
+        return self.client.post(reverse('bulk_edit_tags'), {
+            'posts': ' '.join(str(post.id) for post in posts),
+            'add': add,
+            'remove': remove
+        })
+
+    def test_edits_tags(self):
+        """Adds and removes tags on all of the posts"""
+
+        self.assertTrue(self.client.login(username='test', password='huevo'))
+
+        resp = self.send_request(self.posts, add='cute', remove='cat')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content), {
+            'posts': sorted(post.id for post in self.posts),
+            'added': ['cute'],
+            'removed': ['cat']
+        })
+
+        for post in self.posts:
+            self.assertEqual([tag.tag for tag in post.tags.all()], ['cute'])
+
+    def test_requires_login(self):
+        """Rejects users that aren't logged in"""
+
+        resp = self.send_request(self.posts, add='cute')
+
+        self.assertEqual(resp.status_code, 403)
+
+    def test_skips_other_posts(self):
+        """Only edits the posts that the user owns or which aren't locked"""
+
+        other = User.objects.create_user(username='other', password='huevo')
+        self.posts[0].owner = other
+        self.posts[0].save()
+
+        self.posts[1].locked = True
+        self.posts[1].save()
+
+        self.assertTrue(self.client.login(username='test', password='huevo'))
+
+        resp = self.send_request(self.posts, add='cute')
+
+        self.assertEqual(resp.status_code, 403)
+        self.assertFalse(Tag.objects.filter(tag='cute').exists())
+
+    def test_rejects_invalid(self):
+        """Rejects invalid tags and post ids"""
+
+        self.assertTrue(self.client.login(username='test', password='huevo'))
+
+        self.assertEqual(self.send_request(self.posts, add='*-*').status_code, 400)
+        self.assertEqual(self.send_request(self.posts).status_code, 400)
+        self.assertEqual(self.client.post(reverse('bulk_edit_tags'), {'posts': 'abc', 'add': 'cute'}).status_code, 400)
+
 class PostEditTitle(TestCase):
     def setUp(self):
         self.temp_storage = testutils.TempStorage()
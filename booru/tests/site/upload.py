@@ -1,9 +1,15 @@
 from django.test import TestCase
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopUpload
 from django.core import serializers
 
 from ...models.posts import *
+from booru.tasks.processing import process_post
+from booru.uploadhandler import PostUploadHandler
 import booru.tests.testutils as testutils
+import homebooru.settings
+
+import os
 
 class UploadTest(TestCase):
     def test_page(self):
@@ -118,6 +124,16 @@ class UploadPOSTTest(TestCase):
         # Make sure that it gave an error "file type not allowed"
         # self.assertContains(resp.content, 'File type not allowed')
 
+    def test_file_undecodable(self):
+        """Rejects files that can't be decoded, even though their header is valid"""
+
+        resp = self.make_post(testutils.CORRUPT_FELIX_PATH, 'tag1 tag2 tag3', 'a title', 'https://example.com/', 'explicit')
+
+        self.assertEqual(resp.status_code, 400)
+
+        # Make sure that the post wasn't created
+        self.assertEqual(Post.objects.count(), 0)
+
     # TODO test file too large
 
     def test_duplicate_post(self):
@@ -271,4 +287,97 @@ class UploadPOSTTest(TestCase):
         post = Post.objects.first()
 
         self.assertEqual(resp.status_code, 302)
-        self.assertEqual(resp['Location'], '/post/' + str(post.id))
\ No newline at end of file
+        self.assertEqual(resp['Location'], '/post/' + str(post.id))
+
+    def test_post_processing(self):
+        """Stores the post straight away and leaves its thumbnail and sample to a task"""
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            resp = self.make_post(testutils.SAMPLEABLE_PATH, 'tag1 tag2 tag3', 'a title', 'https://example.com/', 'explicit')
+
+        self.assertEqual(resp.status_code, 302)
+
+        # The task is only queued once the post has been committed
+        self.assertIn('upload_post', [callback.__qualname__.split('.')[0] for callback in callbacks])
+
+        post = Post.objects.first()
+
+        self.assertEqual(post.status, Post.STATUS_PROCESSING)
+        self.assertTrue(post.get_media_path().exists())
+        self.assertFalse(post.get_thumbnail_path().exists())
+
+        # The post can be browsed and viewed before it is ready
+        resp = self.client.get('/browse')
+        self.assertContains(resp, 'preview-processing')
+        self.assertNotContains(resp, post.thumbnail_url)
+
+        resp = self.client.get(f'/post/{post.id}')
+        self.assertContains(resp, 'processing_notice')
+        self.assertContains(resp, post.media_url)
+
+        # Process the post from its task
+        self.assertTrue(process_post(post.id))
+
+        # It has already been processed
+        self.assertFalse(process_post(post.id))
+
+        resp = self.client.get('/browse')
+        self.assertContains(resp, post.thumbnail_url)
+
+        resp = self.client.get(f'/post/{post.id}')
+        self.assertNotContains(resp, 'processing_notice')
+        self.assertContains(resp, post.sample_url)
+
+    def test_upload_moved(self):
+        """Moves the upload into the storage without leaving anything in the upload folder"""
+
+        uploads = set(os.listdir(homebooru.settings.BOORU_UPLOAD_FOLDER)) if os.path.exists(homebooru.settings.BOORU_UPLOAD_FOLDER) else set()
+
+        resp = self.make_post(testutils.VIDEO_PATH, 'tag1 tag2 tag3', 'a title', 'https://example.com/', 'explicit')
+        self.assertEqual(resp.status_code, 302)
+
+        post = Post.objects.first()
+
+        # The checksum was worked out while it was received
+        self.assertEqual(post.md5, boorutils.get_file_checksum(testutils.VIDEO_PATH))
+        self.assertEqual(post.get_media_path().read_bytes(), testutils.VIDEO_PATH.read_bytes())
+        self.assertTrue(post.filename.endswith('.mp4'))
+
+        self.assertEqual(set(os.listdir(homebooru.settings.BOORU_UPLOAD_FOLDER)), uploads)
+
+    def test_rejections_not_stored(self):
+        """Rejects invalid and duplicate files before they are stored"""
+
+        resp = self.make_post(testutils.NON_IMAGE_PATH, 'tag1 tag2 tag3', 'a title', 'https://example.com/', 'explicit')
+        self.assertContains(resp, 'File type not allowed', status_code=400)
+
+        self.make_post(self.test_path, 'tag1 tag2 tag3', 'a title', 'https://example.com/', 'explicit')
+        uploads = set(os.listdir(homebooru.settings.BOORU_UPLOAD_FOLDER))
+
+        resp = self.make_post(self.test_path, 'tag1 tag2 tag3', 'a title', 'https://example.com/', 'explicit')
+        self.assertContains(resp, 'File already exists', status_code=400)
+
+        self.assertEqual(Post.objects.count(), 1)
+        self.assertEqual(set(os.listdir(homebooru.settings.BOORU_UPLOAD_FOLDER)), uploads)
+
+    def test_duplicate_removed(self):
+        """Removes the temporary file of a duplicate as soon as it is rejected"""
+
+        self.make_post(self.test_path, 'tag1 tag2 tag3', 'a title', 'https://example.com/', 'explicit')
+
+        with open(self.test_path, 'rb') as f:
+            content = f.read()
+
+        # Feed the file to the handler the same way that the request would
+        handler = PostUploadHandler()
+        handler.new_file('file', 'felix.jpg', 'image/jpeg', len(content))
+        handler.receive_data_chunk(content, 0)
+
+        path = handler.file.temporary_file_path()
+        self.assertTrue(os.path.exists(path))
+
+        with self.assertRaises(StopUpload):
+            handler.file_complete(len(content))
+
+        self.assertEqual(handler.error, 'File already exists')
+        self.assertFalse(os.path.exists(path))
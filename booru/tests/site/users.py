@@ -391,6 +391,17 @@ class PostFavouritesTest(TestCase):
         # Check that the response is a 200
         self.assertEqual(response.status_code, 200)
 
+    def test_view_favourites(self):
+        """Lists the user's favourites"""
+
+        # Add the post to the favourites
+        self.send_request()
+
+        response = self.client.get(reverse('favourites', kwargs={'user_id': self.fred.id}))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['posts']), [self.post])
+
     def test_rejects_invalid_post_id(self):
         """Rejects posts with invalid ids"""
 
@@ -0,0 +1,131 @@
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+from booru.models import Post
+
+import booru.boorutils as boorutils
+import homebooru.settings
+
+import hashlib
+import os
+import tempfile
+
+class PostUploadedFile(UploadedFile):
+    """An uploaded post, stored in the upload folder under its real file type along with its checksum and mimetype"""
+
+    def __init__(self, name, content_type, charset, content_type_extra=None, file_type=''):
+        # The folder is on the same filesystem as the storage, so that the file can be moved into it
+        folder = homebooru.settings.BOORU_UPLOAD_FOLDER
+        folder.mkdir(parents=True, exist_ok=True)
+
+        file = tempfile.NamedTemporaryFile(suffix='.' + file_type, dir=folder)
+        super().__init__(file, name, content_type, 0, charset, content_type_extra)
+
+        # Worked out while the file was received
+        self.md5 = None
+        self.mimetype = None
+
+    def temporary_file_path(self):
+        """Returns the full path of the file"""
+
+        return self.file.name
+
+    def close(self):
+        try:
+            return self.file.close()
+        except FileNotFoundError:
+            # The file was moved into the storage
+            pass
+
+class PostUploadHandler(FileUploadHandler):
+    """Streams uploaded posts into the upload folder, working out their checksum and type as they are received so that they are never read again
+
+    Files that aren't allowed are rejected from their first chunk, before anything is stored. Files that already exist can only be found
+    once their checksum is known, so they are rejected after they have been received and their temporary file is removed. The reason is kept in error."""
+
+    def __init__(self, request=None):
+        super().__init__(request)
+
+        # Why the upload was rejected
+        self.error = None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+
+        self.md5 = hashlib.md5()
+        self.mimetype = None
+        self.file_type = None
+
+        # The start of the file is kept until it is long enough to find its type
+        self.head = b''
+
+        if hasattr(self, 'file'):
+            del self.file
+
+    def reject(self, error : str):
+        """Stops the upload, removing anything that was stored, the rest of the request is read but not stored"""
+
+        self.error = error
+
+        # Remove the temporary file now rather than waiting for it to be collected
+        if hasattr(self, 'file'):
+            path = self.file.temporary_file_path()
+
+            self.file.close()
+
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # It was removed when it was closed
+                pass
+
+            del self.file
+
+        raise StopUpload(connection_reset=False)
+
+    def sniff(self):
+        """Finds the file type from the start of the file, rejecting it if it isn't allowed, and starts storing it"""
+
+        self.mimetype = boorutils.get_buffer_mimetype(self.head)
+        self.file_type = self.mimetype.split('/')[-1]
+
+        # Check if the file type is allowed
+        if self.file_type not in homebooru.settings.BOORU_ALLOWED_FILE_EXTENSIONS:
+            self.reject('File type not allowed')
+
+        self.file = PostUploadedFile(self.file_name, self.content_type, self.charset, self.content_type_extra, self.file_type)
+        self.file.write(self.head)
+
+        self.head = b''
+
+    def receive_data_chunk(self, raw_data, start):
+        self.md5.update(raw_data)
+
+        if self.mimetype is not None:
+            self.file.write(raw_data)
+            return
+
+        self.head += raw_data
+
+        if len(self.head) >= homebooru.settings.BOORU_UPLOAD_SNIFF_SIZE:
+            self.sniff()
+
+    def file_complete(self, file_size):
+        # The file was too small to have been sniffed yet
+        if self.mimetype is None:
+            self.sniff()
+
+        md5 = self.md5.hexdigest()
+
+        # Make sure that there are no posts with the same checksum
+        if Post.objects.filter(md5=md5).exists():
+            self.reject('File already exists')
+
+        self.file.flush()
+        self.file.seek(0)
+
+        self.file.size = file_size
+        self.file.md5 = md5
+        self.file.mimetype = self.mimetype
+
+        return self.file
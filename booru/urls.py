@@ -13,6 +13,7 @@ urlpatterns = [
     path('post/<int:post_id>/flag', views.post_flag, name='post_flag'),
     path('post/<int:post_id>/comments', views.post_comment, name='post_comment'),
     path('random', views.random, name='random'),
+    path('posts/tags', views.bulk_edit_tags, name='bulk_edit_tags'),
 
     # Pools
     path('pools', views.pools, name='pools'),
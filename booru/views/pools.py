@@ -24,20 +24,8 @@ def pool(request, pool_id):
         # Get the posts in the pool
         posts = pool.posts.all()
 
-        # TODO make this a function already...
-        # Get the page number
-        page = request.GET.get('pid', 1)
-        
-        try:
-            page = int(page)
-        except ValueError:
-            page = 1
-
-        if page < 1:
-            page = 1
-        
         # Paginate the posts
-        posts, paginator = Paginator.paginate(posts, page, homebooru.settings.BOORU_POSTS_PER_PAGE)
+        posts, paginator = Paginator.paginate_request(request, posts, homebooru.settings.BOORU_POSTS_PER_PAGE, ordering=['display_order', 'id'])
 
         paginator.page_url = reverse('pool', kwargs={
             'pool_id': pool_id
@@ -1,42 +1,34 @@
 from django.http import HttpResponse, HttpResponseRedirect
 from django.urls import reverse
 from django.shortcuts import render
+from django.db import transaction
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 
 from booru.models import Post, Rating, PostFlag, Tag, Comment, Pool, PoolPost
 from booru.pagination import Paginator
+from booru.tasks.processing import queue_post
+from booru.uploadhandler import PostUploadHandler
 
 from .filters import *
 
-import magic
-import os
-import time
 import json
 
 import booru.boorutils as boorutils
 import homebooru.settings
 
+# Logger
+import logging
+logger = logging.getLogger(__name__)
+
 def browse(request):
     # Get the search phrase url parameter
     search_phrase = request.GET.get('tags', '').strip()
 
-    # Get the page url parameter
-    page = request.GET.get('pid', '1')
-
-    # Make sure that page is an integer
-    try:
-        page = int(page)
-    except ValueError:
-        page = 1
-
-    # Make sure that page is greater than 0
-    if page < 1:
-        page = 1
-
     # Get the search result set
     result_set = Post.search(search_phrase)
 
     # Search with the given search phrase
-    posts, pagination = Paginator.paginate(result_set, page, homebooru.settings.BOORU_POSTS_PER_PAGE)
+    posts, pagination = Paginator.paginate_request(request, result_set, homebooru.settings.BOORU_POSTS_PER_PAGE)
 
     # Configure the pagination
     pagination.page_url = '/browse?tags=' + search_phrase
@@ -208,14 +200,8 @@ def view(request, post_id):
                 # Failure
                 return HttpResponse(status=400, content='Invalid tag name: ' + tag_name) # TODO can this be xss'd? 
 
-            # Convert the list to a set to remove duplicates
-            tags_list = list(set(tags_list))
-
-            # Add the tags to the post
-            post.tags.clear()
-            for tag_name in tags_list:
-                tag = Tag.create_or_get(tag_name)
-                post.tags.add(tag)
+            # Only add and remove the tags that changed
+            post.set_tags(tags_list)
 
         if 'source' in request.POST:
             source = request.POST['source']
@@ -251,7 +237,16 @@ def view(request, post_id):
         post.save()
         return HttpResponse(status=203)
 
+@csrf_exempt
 def upload(request):
+    # The upload is streamed through the handler as it is received, which has to be set up before the CSRF check reads the body
+    upload_handler = PostUploadHandler(request)
+    request.upload_handlers = [upload_handler]
+
+    return upload_post(request, upload_handler)
+
+@csrf_protect
+def upload_post(request, upload_handler : PostUploadHandler):
     # Check if it is a GET request
     if request.method == 'GET':
         # Get all of the ratings
@@ -266,9 +261,9 @@ def upload(request):
     if request.method == 'POST':
         # TODO check if the user is logged in (if required)
 
-        # Make sure that the uploaded file is there
+        # Make sure that the uploaded file is there (the handler rejects files that aren't allowed or already exist before they are stored)
         if 'upload' not in request.FILES:
-            return HttpResponse('No file uploaded', status=400)
+            return HttpResponse(upload_handler.error or 'No file uploaded', status=400)
         
         # Get the image file
         uploaded_file = request.FILES['upload']
@@ -297,47 +292,6 @@ def upload(request):
         except Rating.DoesNotExist:
             return HttpResponse('Invalid rating', status=400)
 
-        # Create the upload folder if it doesn't exist
-        upload_folder = homebooru.settings.BOORU_UPLOAD_FOLDER
-        if not os.path.exists(upload_folder):
-            upload_folder.mkdir(parents=True)
-        
-        # Check the mimetype
-        m = magic.Magic(mime=True)
-        mimetype = m.from_buffer(uploaded_file.read())
-        file_type = mimetype.split('/')[-1]
-
-        # Check if the file type is allowed
-        if file_type not in homebooru.settings.BOORU_ALLOWED_FILE_EXTENSIONS:
-            print(file_type)
-            return HttpResponse('File type not allowed', status=400)
-
-        # Get the filename
-        filename = None
-        save_path = None
-        while save_path is None:
-            filename = str(time.time()) + '_' + boorutils.hash_str(uploaded_file.name) + '.' + file_type
-
-            # Calculate the save path
-            save_path = upload_folder / filename
-
-            # Check if the file already exists
-            if save_path.exists():
-                save_path = None
-                continue
-        
-        # Save the file (required for ffmpeg processing)
-        with open(save_path, 'wb') as f:
-            for chunk in uploaded_file.chunks():
-                f.write(chunk)
-
-        # Get the file checksum
-        checksum = boorutils.get_file_checksum(save_path)
-
-        # Make sure that there are no posts with the same checksum
-        if Post.objects.filter(md5=checksum).exists():
-            return HttpResponse('File already exists', status=400)
-
         # Check all of the tags
         tag_names = tags.lower().split(' ')
 
@@ -345,32 +299,47 @@ def upload(request):
             if not Tag.is_name_valid(tag_name):
                 return HttpResponse('Contains invalid tag name', status=400)
         
-        # Create the post
+        post = None
+
         try:
-            post = Post.create_from_file(str(save_path))
-        except Exception as e:
-            print(e.with_traceback())
-            return HttpResponse(status=500)
+            # The upload is only removed once the post is committed
+            with transaction.atomic():
+                # Create the post, the thumbnail and sample are generated by a task so that the response isn't held up by them
+                try:
+                    post = Post.create_from_file(uploaded_file.temporary_file_path(), process=False, md5=uploaded_file.md5, strategy=boorutils.IMPORT_MOVE)
+                except Exception as e:
+                    # The file can't be read or decoded, or it is too large
+                    logger.warning('Rejected upload %s: %s', uploaded_file.name, e)
+                    return HttpResponse('Invalid file', status=400)
+
+                # Add the additional metadata
+                post.title = title
+                post.source = source
+                post.rating = rating
+                
+                # Add the owner
+                if request.user.is_authenticated:
+                    post.owner = request.user
 
-        # Add the additional metadata
-        post.title = title
-        post.source = source
-        post.rating = rating
-        
-        # Add the owner
-        if request.user.is_authenticated:
-            post.owner = request.user
+                # Add the post
+                post.save()
 
-        # Add the post
-        post.save()
+                # Add the tags to the post
+                post.tags.add(*Tag.create_or_get_many(tag_names))
+                
+                # Save the post
+                post.save()
 
-        # Add the tags to the post
-        for tag_name in tag_names:
-            tag = Tag.create_or_get(tag_name)
-            post.tags.add(tag)
-        
-        # Save the post
-        post.save()
+                # Process the post once it has been committed, otherwise the task may not be able to find it
+                transaction.on_commit(lambda: queue_post(post.id))
+        except Exception:
+            logger.exception('Could not create a post from upload %s', uploaded_file.name)
+
+            # Don't leave the stored media without a post
+            if post is not None:
+                post.get_media_path().unlink(missing_ok=True)
+
+            return HttpResponse(status=500)
 
         # TODO check that the file isn't too big
         # TODO check that there aren't too many tags (add a setting for this)
@@ -378,6 +347,65 @@ def upload(request):
         # Redirect to the view page
         return HttpResponseRedirect(reverse('view', kwargs={'post_id': post.id}))
 
+def bulk_edit_tags(request):
+    # Only allow POST requests
+    if request.method != 'POST':
+        return HttpResponse(status=405)
+
+    # Get the user
+    user = request.user
+
+    # Check if the user is logged in
+    if not user.is_authenticated:
+        return HttpResponse(status=403, content='You must be logged in to edit posts.')
+
+    # Get the post ids, which can be separated by spaces or commas
+    try:
+        post_ids = [int(post_id) for post_id in request.POST.get('posts', '').replace(',', ' ').split()]
+    except ValueError:
+        return HttpResponse(status=400, content='Invalid post id')
+
+    if len(post_ids) == 0:
+        return HttpResponse(status=400, content='No posts specified')
+
+    if len(post_ids) > homebooru.settings.BOORU_BULK_EDIT_MAX_POSTS:
+        return HttpResponse(status=400, content='Too many posts')
+
+    # Get the tags to add and remove
+    add = request.POST.get('add', '').split()
+    remove = request.POST.get('remove', '').split()
+
+    if len(add) == 0 and len(remove) == 0:
+        return HttpResponse(status=400, content='No tags specified')
+
+    # Check if all the tags are valid
+    for tag_name in add + remove:
+        if Tag.is_name_valid(tag_name):
+            continue
+
+        # Failure
+        return HttpResponse(status=400, content='Invalid tag name')
+
+    # Only edit the posts that the user is allowed to
+    posts = Post.objects.filter(id__in=post_ids, locked=False).order_by('id')
+
+    if not user.has_perm('booru.change_post'):
+        posts = posts.filter(owner=user)
+
+    posts = list(posts)
+
+    if len(posts) == 0:
+        return HttpResponse(status=403, content='You cannot edit any of these posts.')
+
+    # Only the rows that change are touched
+    changes = Post.edit_tags(posts, add=add, remove=remove)
+
+    return HttpResponse(status=200, content_type='application/json', content=json.dumps({
+        'posts': [post.id for post in posts],
+        'added': changes['added'],
+        'removed': changes['removed']
+    }))
+
 def post_flag(request, post_id):
     # Login checks first
     # Get the user
@@ -106,19 +106,14 @@ def autocomplete(request, tag):
     # Get the tags include the post count
     tags = Tag.objects.filter(tag__istartswith=tag)
 
-    # Annotate the tags with the post count
-    tags = tags.annotate(**{
-        'total': models.Count('posts')
-    })
-
     # Sort by the total posts
-    tags = tags.order_by('-total')
+    tags = tags.order_by('-post_count')
 
     # Limit it to the autocomplete limit
     tags = tags[:homebooru.settings.BOORU_AUTOCOMPLETE_MAX_TAGS]
 
     # Convert to an array
-    flat = [{'tag': tag.tag, 'total': tag.total, 'type': str(tag.tag_type)} for tag in tags]
+    flat = [{'tag': tag.tag, 'total': tag.post_count, 'type': str(tag.tag_type_id)} for tag in tags]
 
     # Return the tags as json
     return HttpResponse(json.dumps(flat), content_type="application/json")
@@ -12,6 +12,7 @@ import homebooru.settings
 import booru.boorutils as boorutils
 from booru.models.profile import Profile as ProfileModel
 from booru.models.posts import Post
+from booru.pagination import Paginator
 
 from .filters import *
 
@@ -123,6 +124,18 @@ def favourites(request, user_id : int):
 
     # Get the user's profile
     profile = ProfileModel.create_or_get(user)
+
+    if request.method == "GET":
+        # Paginate the favourites, newest posts first (the favourites do not remember when they were added)
+        posts, paginator = Paginator.paginate_request(request, profile.favourites.all(), homebooru.settings.BOORU_POSTS_PER_PAGE)
+
+        paginator.page_url = reverse('favourites', kwargs={'user_id': user_id}) + '?'
+
+        return render(request, 'booru/users/favourites.html', {
+            'owner': user,
+            'posts': posts,
+            'paginator': paginator
+        })
     
     if request.method == "POST":
         # Get the post id
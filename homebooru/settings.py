@@ -129,6 +129,26 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+
+# Use redis when it is given (so that every worker shares the cache), otherwise keep an in-process LRU cache
+CACHE_URL = os.environ.get('CACHE_URL', '')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CACHE_URL,
+    }
+} if CACHE_URL else {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1024
+        }
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -206,7 +226,14 @@ BOORU_ALLOWED_FILE_EXTENSIONS = ["jpg", "jpeg", "png", "gif", "webm", "mp4", "we
 BOORU_VIDEO_FILE_EXTENSIONS = ["webm", "mp4"] + ["x-m4v", "m4v"]
 BOORU_STORAGE_URL = '/'
 BOORU_STORAGE_SUBFOLDERS = ['media', 'thumbnails', 'samples']
-BOORU_UPLOAD_FOLDER = Path('/tmp/uploads')
+BOORU_UPLOAD_FOLDER = Path(os.environ.get('BOORU_UPLOAD_FOLDER', '/tmp/uploads')) # Uploads are moved from here into the storage, so it should be on the same filesystem
+BOORU_UPLOAD_SNIFF_SIZE = int(os.environ.get('BOORU_UPLOAD_SNIFF_SIZE', 4096)) # How much of an upload is read to find its type before the rest is stored
+BOORU_SAMPLE_WIDTH = int(os.environ.get('BOORU_SAMPLE_WIDTH', 850)) # Posts wider than this get a sample of this width
+BOORU_DERIVATIVE_COMPRESSION_LEVEL = int(os.environ.get('BOORU_DERIVATIVE_COMPRESSION_LEVEL', 3)) # The PNG compression of thumbnails and samples (0-9, lower is faster but larger)
+BOORU_MAX_PIXELS = int(os.environ.get('BOORU_MAX_PIXELS', 100_000_000)) # Content with more pixels than this is rejected before it is decoded (0 for no limit)
+BOORU_MAX_FILE_SIZE = int(os.environ.get('BOORU_MAX_FILE_SIZE', 0)) # Files larger than this (in bytes) are rejected (0 for no limit)
+BOORU_PROBE_CACHE_SIZE = int(os.environ.get('BOORU_PROBE_CACHE_SIZE', 256)) # How many probed files are remembered by each process
+BOORU_PROCESSING_RETRY_AFTER = int(os.environ.get('BOORU_PROCESSING_RETRY_AFTER', 60 * 10)) # Uploads that are still processing after this many seconds are processed by the periodic task
 
 BOORU_DEFAULT_TAG_TYPE_PK = 'general'
 BOORU_DEFAULT_RATING_PK = 'safe'
@@ -222,11 +249,25 @@ BOORU_BROWSE_POST_TAGS_DEPTH = 45 # How many posts to enumerate for tags to disp
 BOORU_AUTOCOMPLETE_MAX_TAGS  = 15 # How many tags to display in the autocomplete dropdown
 BOORU_POOLS_PER_PAGE         = 25 # How many pools to display on the pool page
 BOORU_SAVED_SEARCHES_PER_PAGE = 10 # How many saved searches to display on the saved searches page
+BOORU_BULK_EDIT_MAX_POSTS    = 1000 # How many posts can have their tags edited at once
 
 BOORU_BROWSE_TAGS_SORT = os.environ.get("BOORU_BROWSE_TAGS_SORT", "total") # How to sort the tags on the browse page
 if BOORU_BROWSE_TAGS_SORT not in ["total", "name"]:
     raise ValueError("Invalid BOORU_BROWSE_TAGS_SORT value")
 
+BOORU_PAGINATION_MODE = os.environ.get("BOORU_PAGINATION_MODE", "pages") # How to paginate posts, either by page numbers or by cursors
+if BOORU_PAGINATION_MODE not in ["pages", "cursor"]:
+    raise ValueError("Invalid BOORU_PAGINATION_MODE value")
+
+BOORU_PAGINATION_COUNT_TIMEOUT = int(os.environ.get("BOORU_PAGINATION_COUNT_TIMEOUT", 60)) # How long (in seconds) to cache the total results when using cursors
+
+BOORU_SEARCH_CACHE_ENABLED = os.environ.get("BOORU_SEARCH_CACHE_ENABLED", 'True').lower() == 'true' # Cache the results of post searches
+BOORU_SEARCH_CACHE_TIMEOUT = int(os.environ.get("BOORU_SEARCH_CACHE_TIMEOUT", 300)) # How long (in seconds) to keep a cached search
+BOORU_SEARCH_CACHE_MAX_RESULTS = int(os.environ.get("BOORU_SEARCH_CACHE_MAX_RESULTS", 1000)) # How many of the newest results of each search are cached, pages past them run the search
+
+BOORU_IMPLICATION_BATCH_SIZE = int(os.environ.get("BOORU_IMPLICATION_BATCH_SIZE", 10000)) # How many posts (by id) to apply the implications to in one statement
+BOORU_IMPLICATION_CHECK_INTERVAL = int(os.environ.get("BOORU_IMPLICATION_CHECK_INTERVAL", 60 * 60)) # How often (in seconds) to check for posts that are missing implied tags
+
 # Fixtures
 FIXTURE_DIRS = [
     'booru/fixtures'
@@ -242,6 +283,31 @@ SCANNER_USE_DEFAULT_TAGS = True
 SCANNER_DEFAULT_TAGS = ['tagme']
 SCANNER_STALENESS_THRESHOLD = 30 * 24 * 60 * 60 # 30 days in seconds
 
+# Scanner pipeline
+SCANNER_BATCH_SIZE = int(os.environ.get('SCANNER_BATCH_SIZE', 64)) # How many files are hashed (and posts committed) at a time
+SCANNER_HASH_WORKERS = int(os.environ.get('SCANNER_HASH_WORKERS', os.cpu_count() or 1)) # How many threads hash, detect the type of and probe files
+SCANNER_LOOKUP_WORKERS = int(os.environ.get('SCANNER_LOOKUP_WORKERS', 4)) # How many threads search the boorus at once
+SCANNER_CREATE_WORKERS = int(os.environ.get('SCANNER_CREATE_WORKERS', os.cpu_count() or 1)) # How many threads make the thumbnails and samples of new posts
+
+# Booru lookups
+SCANNER_BOORU_CONNECTIONS = int(os.environ.get('SCANNER_BOORU_CONNECTIONS', 4)) # How many requests can be made to each booru at once
+SCANNER_BOORU_RATE_LIMIT = float(os.environ.get('SCANNER_BOORU_RATE_LIMIT', 5)) # How many requests can be made to each booru per second (0 for no limit)
+SCANNER_BOORU_BURST = int(os.environ.get('SCANNER_BOORU_BURST', 5)) # How many requests can be made at once before the rate limit applies
+SCANNER_BOORU_TIMEOUT = float(os.environ.get('SCANNER_BOORU_TIMEOUT', 10)) # How long to wait (in seconds) for a booru to respond
+SCANNER_BOORU_RETRIES = int(os.environ.get('SCANNER_BOORU_RETRIES', 3)) # How many times failed requests are tried again
+SCANNER_BOORU_BACKOFF = float(os.environ.get('SCANNER_BOORU_BACKOFF', 0.5)) # The base delay (in seconds) between retries, which doubles each time
+SCANNER_BOORU_BATCH_SIZE = int(os.environ.get('SCANNER_BOORU_BATCH_SIZE', 50)) # How many md5s are searched for in each request (for boorus with batch lookups)
+SCANNER_BOORU_MAX_URL_LENGTH = int(os.environ.get('SCANNER_BOORU_MAX_URL_LENGTH', 4000)) # The longest URL that a batch of md5s can be searched for with
+SCANNER_INDEX_IMPORT_BATCH_SIZE = int(os.environ.get('SCANNER_INDEX_IMPORT_BATCH_SIZE', 5000)) # How many posts from a booru dump are saved at a time
+
+# Directory watcher
+SCANNER_WATCHDOG_DEBOUNCE = float(os.environ.get('SCANNER_WATCHDOG_DEBOUNCE', 2)) # How long a file has to be left alone (in seconds) before it is scanned
+SCANNER_WATCHDOG_MAX_DELAY = float(os.environ.get('SCANNER_WATCHDOG_MAX_DELAY', 60)) # The longest a file is held back for (in seconds), even if it keeps changing
+SCANNER_WATCHDOG_MAX_BATCH = int(os.environ.get('SCANNER_WATCHDOG_MAX_BATCH', 1000)) # How many paths are handed to each scan task
+SCANNER_WATCHDOG_RETRY_DELAY = int(os.environ.get('SCANNER_WATCHDOG_RETRY_DELAY', 30)) # How long to wait (in seconds) before scanning paths again if the scanner is busy
+SCANNER_WATCHDOG_MAX_RETRIES = int(os.environ.get('SCANNER_WATCHDOG_MAX_RETRIES', 20)) # How many times paths are retried while the scanner is busy, before they are left for its next full scan
+SCANNER_WATCHDOG_LIVENESS_TIMEOUT = int(os.environ.get('SCANNER_WATCHDOG_LIVENESS_TIMEOUT', 300)) # How often (in seconds) a watchdog checks that it is still needed without being told
+
 # Env variables
 DIRECTORY_SCAN_ENABLED = os.environ.get('DIRECTORY_SCAN_ENABLED', 'False').lower() == 'true'
 SCANNER_ENABLE_DIR_WATCHER = os.environ.get('SCANNER_ENABLE_DIR_WATCHER', 'False').lower() == 'true'
@@ -274,9 +340,22 @@ IS_WORKER = os.environ.get("IS_WORKER", 'False').lower() == 'true'
 # Should we machine learning be used to detect NSFW content (requires a more powerful machine)
 BOORU_AUTOMATIC_RATING_ENABLED = os.environ.get('BOORU_AUTOMATIC_RATING_ENABLED', 'False').lower() == 'true'
 
+# The NSFW model runs on batches of images
+BOORU_NSFW_BATCH_SIZE = int(os.environ.get('BOORU_NSFW_BATCH_SIZE', 8)) # How many images are run through the model at once
+BOORU_NSFW_WORKERS = int(os.environ.get('BOORU_NSFW_WORKERS', 4)) # How many threads decode and preprocess the images
+
 # Add a similar tag given a threshold (not really sure how else to describe it - read the docs for more info)
 BOORU_AUTOMATIC_TAG_ADD_SIMILARITY_THRESHOLD = 0.95
 
+# The periodic automation only does the posts that still need it
+BOORU_AUTOMATION_BATCH_SIZE = int(os.environ.get('BOORU_AUTOMATION_BATCH_SIZE', 100)) # How many posts are done together
+BOORU_AUTOMATION_MAX_POSTS = int(os.environ.get('BOORU_AUTOMATION_MAX_POSTS', 10000)) # How many posts are done each run
+
+# JoyTag is loaded once per worker and runs on batches of images
+BOORU_JOYTAG_BATCH_SIZE = int(os.environ.get('BOORU_JOYTAG_BATCH_SIZE', 16)) # How many images are run through the model at once
+BOORU_JOYTAG_WORKERS = int(os.environ.get('BOORU_JOYTAG_WORKERS', 4)) # How many threads decode and resize the images
+BOORU_JOYTAG_THREADS = int(os.environ.get('BOORU_JOYTAG_THREADS', 0)) # How many threads torch uses within each operation (0 leaves it to torch)
+
 # TODO add an env variable for this to be disabled or enabled
 CELERY_BEAT_SCHEDULE['tag_all_images'] = {
     'task': 'booru.tasks.tag_automation.perform_all_automation',
@@ -289,7 +368,12 @@ if BOORU_AUTOMATIC_RATING_ENABLED:
         'task': 'booru.tasks.rating_automation.perform_all_rating_automation',
         'schedule': 60 * 5, # Every 5 minutes
     }
+
+CELERY_BEAT_SCHEDULE['process_all_posts'] = {
+    'task': 'booru.tasks.processing.process_all_posts',
+    'schedule': BOORU_PROCESSING_RETRY_AFTER, # Uploads are processed as soon as they are queued, this only catches the ones that were lost
+}
 CELERY_BEAT_SCHEDULE['implications_all'] = {
     'task': 'booru.tasks.impl_automation.perform_all_tag_implications',
-    'schedule': 60 * 5, # Every 2 minutes
+    'schedule': BOORU_IMPLICATION_CHECK_INTERVAL, # Implied tags are added when tags are written, so this is only a consistency check
 }
\ No newline at end of file
@@ -7,6 +7,12 @@ admin.site.register(Booru)
 from .models import SearchResult
 admin.site.register(SearchResult)
 
+from .models import FileHash
+admin.site.register(FileHash)
+
+from .models import BooruIndexEntry
+admin.site.register(BooruIndexEntry)
+
 # Add scan button to admin page
 from django.utils.html import format_html
 from django.urls import reverse
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from scanner.models import Booru, BooruIndexEntry
+
+import time
+
+class Command(BaseCommand):
+    help = 'Imports a booru metadata dump (CSV or JSONL of md5, tags, rating and source) into a local index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('booru', help='The name of the booru that the dump is from')
+        parser.add_argument('dump', help='The path of the dump, which can be gzipped')
+        parser.add_argument('--url', help='Creates the booru with this URL if it does not exist')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='The format of the dump (guessed from its name by default)')
+        parser.add_argument('--replace', action='store_true', help='Remove the existing index first')
+
+    def handle(self, *args, **options):
+        booru = Booru.objects.filter(name=options['booru']).first()
+
+        if booru is None:
+            if not options['url']:
+                raise CommandError('The booru does not exist, give it a --url to create it')
+
+            booru = Booru(name=options['booru'], url=options['url'], source_type=Booru.SOURCE_INDEX)
+            booru.save()
+
+        # Make sure that it is searched using the index
+        if not booru.is_local:
+            raise CommandError('The booru is searched using its API, not an index')
+
+        if options['replace']:
+            booru.index.all().delete()
+
+        start = time.time()
+
+        try:
+            total = BooruIndexEntry.import_dump(booru, options['dump'], options['format'])
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+
+        self.stdout.write('Imported %d posts into %s in %.1f seconds' % (total, booru.name, time.time() - start))
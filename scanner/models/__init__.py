@@ -1,7 +1,10 @@
 from .booru import *
+from .booruindex import *
 from .scanner import *
 from .searchresult import *
 from .scannerstatus import *
 from .scannerignore import *
+from .filehash import *
+from .scannerfile import *
 
 from .watchdog import *
\ No newline at end of file
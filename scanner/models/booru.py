@@ -1,20 +1,171 @@
 from django.db import models
 from django.apps import apps
 
+import homebooru.settings
+
 import urllib
 import json
+import time
+import threading
 import requests
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import booru.boorutils as boorutils
+
+from .booruindex import BooruIndexEntry
+
+class RateLimiter:
+    """A token bucket that limits how often requests can be made"""
+
+    def __init__(self, rate : float, burst : int = 1):
+        # The tokens that are added per second (0 means no limit)
+        self.rate = rate
+        self.burst = max(burst, 1)
+
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+        self.lock = threading.Lock()
+
+    def reserve(self, now : float = None) -> float:
+        """Takes a token, returning how long to wait (in seconds) before it can be used"""
+
+        if self.rate <= 0:
+            return 0.0
+
+        now = time.monotonic() if now is None else now
+
+        with self.lock:
+            # Refill the bucket for the time that has passed
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # Tokens can be borrowed, the caller just waits until they would have been added
+            self.tokens -= 1
+
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self):
+        """Waits until a request can be made"""
+
+        delay = self.reserve()
+
+        if delay > 0:
+            time.sleep(delay)
+
 class Booru(models.Model):
+    # Where the posts come from
+    SOURCE_API = 'api'
+    SOURCE_INDEX = 'index'
+
+    SOURCE_CHOICES = [
+        (SOURCE_API, 'API'),                        # Searched over HTTP
+        (SOURCE_INDEX, 'Local index (from a dump)') # Searched in the database, see BooruIndexEntry
+    ]
+
     # The name of the booru that is going to be scanned
     name = models.CharField(unique=True, blank=False, null=False, max_length=256)
 
     # The URL for the root of the booru
     url = models.URLField(unique=True, blank=False, null=False)
 
+    # Whether the booru can search for many md5s at once using OR'd tags (gelbooru style)
+    batch_lookups = models.BooleanField(default=False)
+
+    # How the booru is searched
+    source_type = models.CharField(max_length=16, choices=SOURCE_CHOICES, default=SOURCE_API)
+
+    # Sessions and rate limiters are shared by every booru with the same host
+    __sessions = {}
+    __limiters = {}
+    __lock = threading.Lock()
+
     def __str__(self):
         return self.name
 
+    @property
+    def is_local(self) -> bool:
+        """Whether the booru is searched without any requests"""
+
+        return self.source_type == Booru.SOURCE_INDEX
+
+    @property
+    def host(self) -> str:
+        """The scheme and host of the booru's URL"""
+
+        url = urllib.parse.urlsplit(self.url)
+
+        return url.scheme + '://' + url.netloc
+
+    @staticmethod
+    def create_session() -> requests.Session:
+        """Creates a session which keeps its connections open and retries failed requests"""
+
+        session = requests.Session()
+
+        # Back off exponentially when the booru is failing or is rate limiting us
+        retry = Retry(
+            total=homebooru.settings.SCANNER_BOORU_RETRIES,
+            backoff_factor=homebooru.settings.SCANNER_BOORU_BACKOFF,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET'],
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+
+        # Blocking on the pool limits how many requests are made to the booru at once
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=homebooru.settings.SCANNER_BOORU_CONNECTIONS,
+            pool_block=True,
+            max_retries=retry
+        )
+
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        return session
+
+    @property
+    def session(self) -> requests.Session:
+        """The session used to make requests to the booru"""
+
+        with Booru.__lock:
+            if self.host not in Booru.__sessions:
+                Booru.__sessions[self.host] = Booru.create_session()
+
+            return Booru.__sessions[self.host]
+
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        """The rate limiter for requests to the booru"""
+
+        with Booru.__lock:
+            if self.host not in Booru.__limiters:
+                Booru.__limiters[self.host] = RateLimiter(homebooru.settings.SCANNER_BOORU_RATE_LIMIT, homebooru.settings.SCANNER_BOORU_BURST)
+
+            return Booru.__limiters[self.host]
+
+    @staticmethod
+    def reset_sessions():
+        """Closes all of the sessions and forgets the rate limiters"""
+
+        with Booru.__lock:
+            for session in Booru.__sessions.values():
+                session.close()
+
+            Booru.__sessions.clear()
+            Booru.__limiters.clear()
+
+    def get(self, url : str) -> requests.Response:
+        """Makes a rate limited request to the booru"""
+
+        self.rate_limiter.acquire()
+
+        return self.session.get(url, timeout=homebooru.settings.SCANNER_BOORU_TIMEOUT)
+
     @property
     def api_url(self) -> str:
         """The URL with the API for the booru
@@ -24,17 +175,28 @@ class Booru(models.Model):
         # Concatenate the URL with the API endpoint
         return self.url + '/index.php?page=dapi&s=post&json=1&q=index'
 
-    def raw_search_booru(self, phrase : str = '') -> list:
-        """Searches the booru using the given phrase"""
-        
+    def get_search_url(self, phrase : str = '', limit : int = None) -> str:
+        """Gets the API URL that searches for the given phrase"""
+
         # Sanitize the phrase to be URL safe
         phrase = urllib.parse.quote(phrase)
 
         # Concatenate the URL with the search phrase
         url = self.api_url + '&tags=' + phrase
 
+        # Ask for more posts than the booru's default
+        if limit is not None:
+            url += '&limit=' + str(limit)
+
+        return url
+
+    def raw_search_booru(self, phrase : str = '', limit : int = None) -> list:
+        """Searches the booru using the given phrase"""
+
+        url = self.get_search_url(phrase, limit)
+
         # Make a request to the booru
-        resp = requests.get(url)
+        resp = self.get(url)
 
         # Make sure that it was a 200
         if resp.status_code != 200:
@@ -48,27 +210,31 @@ class Booru(models.Model):
     def search_booru_md5(self, md5 : str):
         """Search for a file with the given MD5 hash."""
 
-        # Get the SearchResult model
-        SearchResult = apps.get_model('scanner', 'SearchResult')
-
         # Run a search for the MD5
         try:
             post = self.raw_search_md5(md5)
         except:
             post = None
 
-        # Check if a result already exists
-        existing_results = SearchResult.objects.filter(booru=self, md5=md5)
+        result = self.create_search_result(md5, post)
+
+        # If an existing result exists, remove it
+        if result.found:
+            apps.get_model('scanner', 'SearchResult').objects.filter(booru=self, md5=md5).delete()
+
+        return result
+
+    def create_search_result(self, md5 : str, post : dict):
+        """Creates an unsaved search result from a post returned by the booru (or None if nothing was found)"""
+
+        # Get the SearchResult model
+        SearchResult = apps.get_model('scanner', 'SearchResult')
 
         # If we didn't find anything, return an empty result
         if not post or 'tags' not in post:
             # Create a new result
             return SearchResult(booru=self, md5=md5, found=False)
 
-        # If an existing result exists, remove it
-        if existing_results.exists():
-            existing_results.delete()
-
         # Create a new result
         result = SearchResult(booru=self, md5=md5, found=True)
 
@@ -87,8 +253,88 @@ class Booru(models.Model):
         # Return the result
         return result
 
+    @staticmethod
+    def get_md5s_phrase(md5s : list) -> str:
+        """Gets a phrase that matches any of the given md5s"""
+
+        if len(md5s) == 1:
+            return 'md5:' + md5s[0]
+
+        return '( ' + ' ~ '.join('md5:' + md5 for md5 in md5s) + ' )'
+
+    def get_md5_batches(self, md5s : list) -> list:
+        """Splits the md5s into the groups that can be searched for in a single request"""
+
+        # The index can find a batch of files in one query
+        if self.is_local:
+            return list(boorutils.batched(md5s, homebooru.settings.SCANNER_BATCH_SIZE))
+
+        # Boorus that can't OR tags are searched one file at a time
+        if not self.batch_lookups:
+            return [[md5] for md5 in md5s]
+
+        max_size = max(homebooru.settings.SCANNER_BOORU_BATCH_SIZE, 1)
+        max_length = homebooru.settings.SCANNER_BOORU_MAX_URL_LENGTH
+
+        batches = []
+        batch = []
+
+        for md5 in md5s:
+            candidate = batch + [md5]
+
+            # Start a new batch once either of the limits would be passed
+            if len(candidate) > max_size or (len(batch) > 0 and len(self.get_search_url(self.get_md5s_phrase(candidate), len(candidate))) > max_length):
+                batches.append(batch)
+                candidate = [md5]
+
+            batch = candidate
+
+        if len(batch) > 0:
+            batches.append(batch)
+
+        return batches
+
+    @staticmethod
+    def get_post_md5(post : dict) -> str:
+        """Gets the md5 of a post returned by the booru"""
+
+        # Older gelbooru versions call it the hash
+        md5 = post.get('md5') or post.get('hash')
+
+        return md5.lower() if isinstance(md5, str) else None
+
+    def raw_search_md5s(self, md5s : list) -> dict:
+        """Searches for many files at once, returning the post for each md5 (or None if it wasn't found)"""
+
+        if self.is_local:
+            return BooruIndexEntry.search(self, md5s)
+
+        # Searching for a single file doesn't need the posts' md5s
+        if len(md5s) == 1:
+            return {md5s[0]: self.raw_search_md5(md5s[0])}
+
+        # Each md5 should only match one post
+        posts = self.raw_search_booru(self.get_md5s_phrase(md5s), limit=len(md5s))
+
+        found = {}
+
+        for post in posts:
+            md5 = Booru.get_post_md5(post)
+
+            # The posts can't be matched to the files, so search for them one at a time instead
+            if md5 is None:
+                return {md5: self.raw_search_md5(md5) for md5 in md5s}
+
+            # Keep the first post like raw_search_md5
+            found.setdefault(md5, post)
+
+        return {md5: found.get(md5.lower()) for md5 in md5s}
+
     def raw_search_md5(self, md5 : str) -> dict:
         """Search for a file with the given MD5 hash."""
+
+        if self.is_local:
+            return BooruIndexEntry.search(self, [md5])[md5]
         
         # Get the posts
         posts = self.raw_search_booru('md5:' + md5)
@@ -103,9 +349,12 @@ class Booru(models.Model):
     def test(self) -> bool:
         """Verifies that the booru is working"""
         
+        # The check should fail quickly, so it doesn't use the retrying session
+        timeout = homebooru.settings.SCANNER_BOORU_TIMEOUT
+
         # Make a request to the booru
         try:
-            resp = requests.get(self.url)
+            resp = requests.get(self.url, timeout=timeout)
         except:
             return False
 
@@ -114,7 +363,10 @@ class Booru(models.Model):
             return False
         
         # Check that we can access the API
-        resp = requests.get(self.api_url)
+        try:
+            resp = requests.get(self.api_url, timeout=timeout)
+        except:
+            return False
 
         # Make sure that it was a 200
         if resp.status_code != 200:
@@ -134,8 +386,8 @@ class Booru(models.Model):
         return True
     
     def save(self, *args, **kwargs):
-        # Make sure that the URL is valid
-        if not self.test():
+        # Make sure that the URL is valid (the index is filled in after it has been created)
+        if not self.is_local and not self.test():
             raise ValueError('Invalid booru URL')
 
         # Call the superclass save method
@@ -0,0 +1,153 @@
+from django.db import models
+
+import homebooru.settings
+
+import booru.boorutils as boorutils
+
+import io
+import csv
+import gzip
+import json
+
+class BooruIndexEntry(models.Model):
+    """A post from a booru's metadata dump, so that the booru can be searched without any requests"""
+
+    # The booru that the dump was taken from
+    booru = models.ForeignKey('scanner.Booru', on_delete=models.CASCADE, related_name='index')
+
+    # The MD5 hash of the post's file
+    md5 = models.CharField(max_length=32)
+
+    # The raw tags list
+    tags = models.TextField(blank=True)
+
+    # Raw rating from the booru
+    rating = models.CharField(blank=True, default='', max_length=32)
+
+    # The source of the post
+    source = models.TextField(blank=True, default='')
+
+    class Meta:
+        # Each post is only stored once, this also indexes the lookups by md5
+        unique_together = ('booru', 'md5')
+
+    def __str__(self):
+        return self.md5 + ' @ ' + self.booru.name
+
+    @property
+    def post(self) -> dict:
+        """The entry in the same form as a post from the booru's API"""
+
+        return {
+            'md5': self.md5,
+            'tags': self.tags,
+            'rating': self.rating,
+            'source': self.source or None
+        }
+
+    @staticmethod
+    def search(booru, md5s : list) -> dict:
+        """Gets the posts for the given md5s in a single query"""
+
+        entries = BooruIndexEntry.objects.filter(booru=booru, md5__in=[md5.lower() for md5 in md5s])
+        posts = {entry.md5: entry.post for entry in entries}
+
+        return {md5: posts.get(md5.lower()) for md5 in md5s}
+
+    @staticmethod
+    def open_dump(path : str):
+        """Opens a dump as text, decompressing it if needed"""
+
+        if str(path).endswith('.gz'):
+            return gzip.open(path, 'rt', encoding='utf-8', newline='')
+
+        return open(path, 'r', encoding='utf-8', newline='')
+
+    @staticmethod
+    def read_dump(file : io.TextIOBase, format : str):
+        """Streams the rows of a dump as dictionaries"""
+
+        if format == 'csv':
+            yield from csv.DictReader(file)
+            return
+
+        if format == 'jsonl':
+            for line in file:
+                line = line.strip()
+
+                if len(line) == 0: continue
+
+                yield json.loads(line)
+
+            return
+
+        raise ValueError('Unknown dump format: ' + format)
+
+    @staticmethod
+    def get_format(path : str) -> str:
+        """Gets the format of a dump from its file name"""
+
+        name = str(path).lower()
+
+        # Ignore the compression
+        if name.endswith('.gz'):
+            name = name[:-3]
+
+        if name.endswith('.csv'):
+            return 'csv'
+
+        if name.endswith('.jsonl') or name.endswith('.ndjson'):
+            return 'jsonl'
+
+        raise ValueError('Unknown dump format: ' + str(path))
+
+    @staticmethod
+    def from_row(booru, row : dict):
+        """Creates an unsaved entry from a row of a dump, or None if it has no md5"""
+
+        md5 = str(row.get('md5') or row.get('hash') or '').strip().lower()
+
+        # Rows without a valid md5 can never be looked up
+        if len(md5) != 32:
+            return None
+
+        # Tags can be given as a list or a string
+        tags = row.get('tags') or ''
+        if isinstance(tags, list):
+            tags = ' '.join(tags)
+
+        return BooruIndexEntry(
+            booru=booru,
+            md5=md5,
+            tags=tags,
+            rating=str(row.get('rating') or '')[:32],
+            source=str(row.get('source') or '')
+        )
+
+    @staticmethod
+    def import_dump(booru, path : str, format : str = None, batch_size : int = None) -> int:
+        """Streams a CSV or JSONL dump (optionally gzipped) into the index, returning the number of posts imported"""
+
+        format = format or BooruIndexEntry.get_format(path)
+        batch_size = batch_size or homebooru.settings.SCANNER_INDEX_IMPORT_BATCH_SIZE
+
+        total = 0
+
+        with BooruIndexEntry.open_dump(path) as file:
+            entries = (BooruIndexEntry.from_row(booru, row) for row in BooruIndexEntry.read_dump(file, format))
+
+            # Only a batch of the dump is ever in memory
+            for batch in boorutils.batched((entry for entry in entries if entry is not None), batch_size):
+                # The same post can't be updated twice in one statement
+                batch = list({entry.md5: entry for entry in batch}.values())
+
+                BooruIndexEntry.objects.bulk_create(
+                    batch,
+                    update_conflicts=True,
+                    unique_fields=['booru', 'md5'],
+                    update_fields=['tags', 'rating', 'source']
+                )
+
+                total += len(batch)
+
+        return total
@@ -0,0 +1,139 @@
+from django.db import models
+
+import booru.boorutils as boorutils
+
+import os
+
+class FileHash(models.Model):
+    """A cached checksum of a file, used so that unchanged files do not need to be read again"""
+
+    # The absolute path of the file
+    path = models.CharField(unique=True, blank=False, null=False, max_length=1024)
+
+    # The details of the file when it was hashed
+    size = models.BigIntegerField()
+    mtime = models.BigIntegerField() # In nanoseconds
+    inode = models.BigIntegerField()
+
+    # The checksum of the file (MD5)
+    md5 = models.CharField(max_length=32, db_index=True)
+
+    # The mimetype of the file's contents
+    mimetype = models.CharField(max_length=255, blank=True, default='')
+
+    # Date and time the file was last hashed
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.path + " - " + self.md5
+
+    def matches(self, stat : os.stat_result) -> bool:
+        """Checks if the file has not changed since it was hashed"""
+
+        return self.size == stat.st_size and self.mtime == stat.st_mtime_ns and self.inode == stat.st_ino
+
+    @staticmethod
+    def hash_file(path : str) -> 'FileHash':
+        """Reads the file to create a new (unsaved) record, this does not touch the database so it can be run in another thread"""
+
+        # Get the details first so that a change while hashing is noticed next time
+        stat = os.stat(path)
+
+        return FileHash(
+            path=path,
+            size=stat.st_size,
+            mtime=stat.st_mtime_ns,
+            inode=stat.st_ino,
+            md5=boorutils.get_file_checksum(path),
+            mimetype=boorutils.get_mimetype(path)
+        )
+
+    @staticmethod
+    def get_many(paths : list, workers : int = 1, probe = None) -> dict:
+        """Gets the records for many files (by their absolute paths), only reading the files that have changed since they were last hashed
+
+        If a probe function is given, it is run on every file by the same pool and its result is kept as the record's content (None if it raised)."""
+
+        # Make the paths absolute
+        paths = [os.path.abspath(path) for path in paths]
+
+        # Get the records that we already have in one query
+        known = {file_hash.path: file_hash for file_hash in FileHash.objects.filter(path__in=paths)}
+
+        file_hashes = {}
+        changed = []
+
+        for path in paths:
+            # Skip files that have gone since they were found
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            file_hash = known.get(path)
+
+            # Use the record if the file has not changed
+            if file_hash is not None and file_hash.matches(stat) and file_hash.mimetype:
+                file_hashes[path] = file_hash
+                continue
+
+            changed.append(path)
+
+        unchanged = list(file_hashes)
+
+        def read(path):
+            # Only hash the file if it has changed
+            file_hash = file_hashes[path] if path in file_hashes else FileHash.hash_file(path)
+
+            if probe is not None:
+                try:
+                    file_hash.content = probe(path)
+                except Exception:
+                    file_hash.content = None
+
+            return file_hash
+
+        # Hash the changed files (and probe all of them) using the pool
+        results = boorutils.parallel_map(read, changed + (unchanged if probe is not None else []), workers)
+        new_hashes = [file_hash for path, file_hash, error in results if error is None and path not in file_hashes]
+
+        # Save them all at once, replacing the old records
+        FileHash.objects.bulk_create(
+            new_hashes,
+            update_conflicts=True,
+            unique_fields=['path'],
+            update_fields=['size', 'mtime', 'inode', 'md5', 'mimetype', 'updated_at']
+        )
+
+        for file_hash in new_hashes:
+            file_hashes[file_hash.path] = file_hash
+
+        return file_hashes
+
+    @staticmethod
+    def get_checksum(path : str) -> str:
+        """Gets the checksum of a file, only reading the file if it has changed since it was last hashed"""
+
+        # Make the path absolute
+        path = os.path.abspath(path)
+
+        # Raises if the file does not exist
+        os.stat(path)
+
+        return FileHash.get_many([path])[path].md5
+
+    @staticmethod
+    def prune(root : str = None):
+        """Removes the cached checksums of files that no longer exist (optionally only those inside of a directory)"""
+
+        file_hashes = FileHash.objects.all()
+
+        # Only look inside of the directory
+        if root is not None:
+            file_hashes = file_hashes.filter(path__startswith=os.path.join(os.path.abspath(root), ''))
+
+        # Find all of the files that have gone
+        missing = [file_hash.pk for file_hash in file_hashes.only('path').iterator() if not os.path.exists(file_hash.path)]
+
+        # Delete them
+        FileHash.objects.filter(pk__in=missing).delete()
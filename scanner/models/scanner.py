@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.apps import apps
 
@@ -11,10 +11,13 @@ from booru.models.tags import Tag
 from .booru import Booru
 from .searchresult import SearchResult
 from .scannerignore import ScannerIgnore
+from .filehash import FileHash
+from .scannerfile import ScannerFile
 
 import os
 import datetime
-import magic
+import itertools
+import tempfile
 from pathlib import Path
 
 import time
@@ -23,6 +26,14 @@ class ScannerError(Exception):
     pass
 
 class Scanner(models.Model):
+    # How found files are brought into the storage (links and moves fall back to copies if the filesystem can't do them)
+    IMPORT_STRATEGIES = [
+        (boorutils.IMPORT_COPY, 'Copy'),
+        (boorutils.IMPORT_HARDLINK, 'Hard link'),     # Shares the file, so changes to the original change the post
+        (boorutils.IMPORT_REFLINK, 'Reflink'),        # Copy-on-write clone (btrfs, xfs)
+        (boorutils.IMPORT_MOVE, 'Move'),              # Removes the file from the scanned folder
+    ]
+
     # The name of the scanner
     name = models.CharField(unique=True, blank=False, null=False, max_length=256)
 
@@ -50,6 +61,9 @@ class Scanner(models.Model):
     # Is the scanner active
     is_active = models.BooleanField(default=False)
 
+    # How the found files are imported
+    import_strategy = models.CharField(max_length=16, choices=IMPORT_STRATEGIES, default=boorutils.IMPORT_COPY)
+
     @property
     def add_posts_on_failure(self):
         """Returns whether or not we should add posts on failure"""
@@ -102,24 +116,19 @@ class Scanner(models.Model):
     def default_tags(self) -> list:
         """Returns the default tags for an item when nothing was found"""
 
-        tags = []
-
         if not homebooru.settings.SCANNER_USE_DEFAULT_TAGS:
-            return tags
+            return []
 
-        for tag in homebooru.settings.SCANNER_DEFAULT_TAGS:
-            tags.append(Tag.create_or_get(tag))
-        
-        return tags
+        return Tag.create_or_get_many(homebooru.settings.SCANNER_DEFAULT_TAGS)
 
     def __str__(self):
         return self.name
     
-    def create_post(self, path : str, use_default_tags = True) -> Post:
-        """Combines all of the search results and creates a post"""
+    def create_post(self, path : str, use_default_tags = True, md5 : str = None, derivatives : dict = None) -> Post:
+        """Combines all of the search results and creates a post (using derivatives that were already made, if given)"""
 
         # Get a md5 hash for the file
-        md5 = boorutils.get_file_checksum(path)
+        md5 = md5 or FileHash.get_checksum(path)
 
         # Get all the results
         results = SearchResult.objects.filter(md5=md5)
@@ -158,6 +167,9 @@ class Scanner(models.Model):
             for tag in self.auto_failure_tags.all():
                 tags[str(tag)] = tag
 
+        # Collect the names of the tags from the results, so that they can be created together
+        names = []
+
         for result in results:
             # Get the tags
             raw_tags = result.tags
@@ -165,7 +177,7 @@ class Scanner(models.Model):
             # Split the tags
             tags_list = raw_tags.split(' ')
 
-            # Add the tags to the dictionary
+            # Add the tags to the list
             for tag in tags_list:
                 # Skip the tag if we have already added it
                 if tag in tags: continue
@@ -177,7 +189,11 @@ class Scanner(models.Model):
                 if not Tag.is_name_valid(tag): continue
 
                 # Add the tag
-                tags[tag] = Tag.create_or_get(tag)
+                names.append(tag)
+
+        # Create or get the tags in one go
+        for tag in Tag.create_or_get_many(names):
+            tags.setdefault(tag.tag, tag)
         
         # Convert the tags to a list
         tags_list = list(tags.values())
@@ -186,12 +202,11 @@ class Scanner(models.Model):
         if len(tags_list) == 0: return None
 
         # Create the post
-        post = Post.create_from_file(file_path=path, owner=self.owner)
+        post = Post.create_from_file(file_path=path, owner=self.owner, strategy=self.import_strategy, derivatives=derivatives)
         post.save()
 
-        # Add the tags
-        for tag in tags_list:
-            post.tags.add(tag)
+        # Add the tags in a single insert
+        post.tags.add(*tags_list)
         
         # Add other information
         post.rating = rating
@@ -231,7 +246,7 @@ class Scanner(models.Model):
         # Call the superclass save method
         super().save(*args, **kwargs)
 
-    def __scan(self, create_posts : bool = True, use_default_tags : bool = True) -> list:
+    def __scan(self, create_posts : bool = True, use_default_tags : bool = True, paths : list = None) -> list:
         """Scans the scanner for new files"""
 
         # Get if we are already active (from the database)
@@ -255,55 +270,95 @@ class Scanner(models.Model):
         post_hashes = {}
         skip_hashes = {}
 
+        # Store what happened to each of the processed files, this is saved to the manifest at the end
+        hashed = {}
+        states = {}
+
+        # Copies of files that were already found in this scan, they share the state of the first copy
+        duplicates = {}
+
+        # Store every file that was found so that the removed ones can be found
+        seen = set()
+
+        # Get the sizes of the pools
+        batch_size = homebooru.settings.SCANNER_BATCH_SIZE
+        hash_workers = homebooru.settings.SCANNER_HASH_WORKERS
+        lookup_workers = homebooru.settings.SCANNER_LOOKUP_WORKERS
+        create_workers = homebooru.settings.SCANNER_CREATE_WORKERS
+
         # Set the status
         self.__set_status('Finding files')
 
-        # Find all the files in the path using the walk function
-        for root, dirs, files in os.walk(self.path):
-            # Loop through all the files
-            for file in files:
-                # Get the full path
-                path = os.path.join(root, file)
+        # Only look at the given files if there are any, otherwise walk the whole path
+        found_files = self.__find_files() if paths is None else self.__filter_paths(paths)
+
+        # Discovery and hashing stage, the walk is consumed a batch at a time while the pool hashes the changed files
+        for batch in boorutils.batched(found_files, batch_size):
+            # Update the status
+            self.__set_status(f'Finding files ({batch[-1]})')
+
+            seen.update(batch)
 
-                # Make the path absolute
-                path = os.path.abspath(path)
+            # Skip the files that have not changed since they were last processed
+            batch = self.__get_changed_files(batch)
 
-                # Update the status
-                self.__set_status(f'Finding files ({path})')
+            if len(batch) == 0: continue
 
-                # Get the md5 hash of the file
-                md5 = boorutils.get_file_checksum(path)
+            # Get the checksums and mimetypes of the files in the batch, the pool also probes them so that they can be validated here
+            batch_hashes = FileHash.get_many(batch, workers=hash_workers, probe=self.probe_file)
+            hashed.update(batch_hashes)
+
+            # Find out what is already known about all of them at once
+            known = self.get_known_checksums(set(file_hash.md5 for file_hash in batch_hashes.values()))
+
+            # The files with nothing to do
+            idle = {}
+
+            # Keep the order that the files were found in
+            for path in batch:
+                file_hash = batch_hashes.get(path)
+
+                # The file could not be read
+                if file_hash is None: continue
+
+                md5 = file_hash.md5
 
                 # Check if we already have this file
-                if md5 in file_hashes or md5 in post_hashes or md5 in skip_hashes: continue
+                if md5 in file_hashes or md5 in post_hashes or md5 in skip_hashes:
+                    duplicates[path] = md5
+                    continue
 
                 # Make sure we don't check it again
                 skip_hashes[md5] = path
 
-                # Check the file mimetype
-                m = magic.Magic(mime=True)
-                mimetype = m.from_file(path)
-
                 # Get the file type
-                file_type = mimetype.split('/')[-1]
+                file_type = file_hash.mimetype.split('/')[-1]
 
                 # Check if the file type is acceptable
                 if file_type not in homebooru.settings.BOORU_ALLOWED_FILE_EXTENSIONS:
+                    # Remember it so that it isn't hashed again on every scan
+                    states[path] = ScannerFile.STATE_REJECTED
                     continue
 
-                # Check if we should search the file
-                if self.should_search_file(path):
+                # Check if we should search the file (it was already validated by the probe)
+                if file_hash.content is not None and self.should_search_file(path, md5=md5, known=known, validate=False):
                     # Add the file to the list
                     file_hashes[md5] = path
 
                     continue
 
                 # Check if we should create the post
-                if self.should_create_post(path):
+                if self.should_create_post(path, md5=md5, known=known):
                     # Add the file to the list
                     post_hashes[md5] = path
 
                     continue
+
+                # There is nothing to do for the file
+                idle[path] = md5
+
+            for path, md5 in idle.items():
+                states[path] = ScannerFile.STATE_POSTED if md5 in known['posted'] else ScannerFile.STATE_NOT_FOUND
         
         # Save the total files
         total_files = len(file_hashes) + len(post_hashes)
@@ -311,26 +366,57 @@ class Scanner(models.Model):
         # Update the status
         self.__set_status(f'Looking up {len(file_hashes)} files')
 
-        # Store the created posts
-        created_posts = []
+        # Group the files by the boorus that they need to be searched on
+        booru_md5s = {}
+
+        for md5 in file_hashes:
+            for booru in self.get_boorus_to_search(md5):
+                booru_md5s.setdefault(booru, []).append(md5)
+
+        # Lookup stage, each request can search for many files if the booru supports it
+        lookups = [(booru, md5s) for (booru, all_md5s) in booru_md5s.items() for md5s in booru.get_md5_batches(all_md5s)]
+        total_lookups = sum(len(md5s) for (booru, md5s) in lookups)
+
+        found = set()
 
-        # Current counter
         cur = 0
 
-        # Iterate through all the files to search for
-        for (md5, path) in file_hashes.items():
+        # The results are saved a batch at a time
+        results = []
+
+        def lookup(lookup):
+            return lookup[0].raw_search_md5s(lookup[1])
+
+        # Local indexes are searched here, since they only need the database, and the requests are made by the pool
+        lookup_results = itertools.chain(
+            boorutils.parallel_map(lookup, [lookup for lookup in lookups if lookup[0].is_local]),
+            boorutils.parallel_map(lookup, [lookup for lookup in lookups if not lookup[0].is_local], lookup_workers)
+        )
+
+        # The results are saved here
+        for (booru, md5s), posts, error in lookup_results:
+            for md5 in md5s:
+                # Treat errors as not found
+                result = booru.create_search_result(md5, None if error else posts.get(md5))
+                results.append(result)
+
+                # Remember that we found the file
+                if result.found: found.add(md5)
+
             # Update the status
-            cur += 1
-            self.__set_status(f'Looking up {len(file_hashes)} files ({round(cur / len(file_hashes) * 100)} %)')
+            previous = cur
+            cur += len(md5s)
 
-            try:
-                # Search for the file
-                if not self.search_file(path) and not self.add_posts_on_failure: continue
-            except Exception as e:
-                # Show the error
-                print(e)
-                
-                # Skip the file
+            if cur // batch_size != previous // batch_size or cur == total_lookups:
+                SearchResult.save_many(results)
+                results = []
+
+                self.__set_status(f'Looking up {len(file_hashes)} files ({round(cur / total_lookups * 100)} %)')
+
+        for (md5, path) in file_hashes.items():
+            # Skip the files that weren't found
+            if md5 not in found and not self.add_posts_on_failure:
+                states[path] = ScannerFile.STATE_NOT_FOUND
                 continue
 
             # ... Successfully found the file
@@ -341,30 +427,73 @@ class Scanner(models.Model):
         # Update the status
         self.__set_status(f'Creating {len(post_hashes)} new posts')
 
+        # Store the created posts
+        created_posts = []
+
         total_errors = 0
 
         cur = 0
 
-        # Iterate through all the files to create posts for
-        for (md5, path) in post_hashes.items():
-            cur += 1
-            self.__set_status(f'Creating {len(post_hashes)} new posts ({round(cur / len(post_hashes) * 100)} %)')
-            # Create the post
-            try:
-                post = self.create_post(path)
-            except Exception as e:
-                # Must be corrupted
-                post = None
+        # The pool makes the thumbnails and samples here, so that they are only moved into place when the posts are created
+        storage_path = Path(homebooru.settings.BOORU_STORAGE_PATH)
+        storage_path.mkdir(parents=True, exist_ok=True)
+
+        # The derivatives of the files that don't get posts are removed with it
+        with tempfile.TemporaryDirectory(dir=storage_path) as derivatives_dir:
+            def prepare(item):
+                return Post.prepare_derivatives(item[1], derivatives_dir, item[0])
+
+            # Creation stage, the pool makes the derivatives while the posts are inserted and committed a batch at a time
+            prepared = boorutils.parallel_map(prepare, post_hashes.items(), create_workers)
+
+            for batch in boorutils.batched(prepared, batch_size):
+                with transaction.atomic():
+                    for ((md5, path), derivatives, error) in batch:
+                        # Create the post
+                        try:
+                            # Only roll back this post if it fails (if the derivatives couldn't be made, trying again here fails the same way)
+                            with transaction.atomic():
+                                post = self.create_post(path, md5=md5, derivatives=derivatives)
+                        except Exception as e:
+                            # Must be corrupted
+                            post = None
+
+                            # Increment the total errors
+                            total_errors += 1
+
+                            states[path] = ScannerFile.STATE_ERROR
+                            continue
+
+                        # Make sure that it is not None
+                        if post is None:
+                            states[path] = ScannerFile.STATE_NOT_FOUND
+                            continue
+
+                        states[path] = ScannerFile.STATE_POSTED
+
+                        # Add the post to the list
+                        created_posts.append(post)
+
+                # Update the status once the batch is committed
+                cur += len(batch)
+                self.__set_status(f'Creating {len(post_hashes)} new posts ({round(cur / len(post_hashes) * 100)} %)')
+                
+        # The copies end up the same way as the first copy, so that they aren't hashed again on every scan
+        for path, md5 in duplicates.items():
+            state = states.get(skip_hashes[md5])
 
-                # Increment the total errors
-                total_errors += 1
+            if state is not None:
+                states[path] = state
 
-            # Make sure that it is not None
-            if post is None: continue
+        # Remember what happened to the files
+        self.__update_manifest(states, hashed)
+
+        # Forget about the files that were removed
+        if paths is None:
+            self.__forget_files([file.path for file in self.manifest.only('path').iterator() if file.path not in seen])
+        else:
+            self.__forget_files([path for path in paths if not os.path.exists(path)], directories=True)
 
-            # Add the post to the list
-            created_posts.append(post)
-                
         # Update the status
         self.__set_status(f'Finished at {datetime.datetime.now()} {len(skip_hashes)} unique files found, creating {len(created_posts)} new posts, {total_files} new files were detected, {len(file_hashes)} files were scanned, {total_errors} errors occurred')
 
@@ -374,6 +503,93 @@ class Scanner(models.Model):
 
         # Return the created posts
         return created_posts
+
+    def __find_files(self, path : str = None):
+        """Walks the scanner path (or a directory inside of it), yielding the absolute path of every file"""
+
+        for root, dirs, files in os.walk(path or self.path):
+            for file in files:
+                yield os.path.abspath(os.path.join(root, file))
+
+    def __filter_paths(self, paths : list):
+        """Yields the files for the given paths that are inside of the scanner path, walking any directories"""
+
+        scanner_path = os.path.abspath(self.path)
+
+        for path in paths:
+            path = os.path.abspath(path)
+
+            # Make sure that it is inside of the scanner path
+            if os.path.commonpath([scanner_path, path]) != scanner_path: continue
+
+            if os.path.isdir(path):
+                yield from self.__find_files(path)
+            elif os.path.isfile(path):
+                yield path
+
+    def __get_changed_files(self, paths : list) -> list:
+        """Gets the files that are new or have changed since they were last processed"""
+
+        # Get the manifest entries for the files in one query
+        entries = {entry.path: entry for entry in self.manifest.filter(path__in=paths)}
+
+        changed = []
+
+        for path in paths:
+            entry = entries.get(path)
+
+            # It has never been processed
+            if entry is None:
+                changed.append(path)
+                continue
+
+            # Skip files that have gone since they were found
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            if not entry.matches(stat) or entry.needs_check:
+                changed.append(path)
+
+        return changed
+
+    def __update_manifest(self, states : dict, hashed : dict):
+        """Saves what happened to the processed files to the manifest"""
+
+        entries = [
+            ScannerFile(
+                scanner=self,
+                path=path,
+                size=hashed[path].size,
+                mtime=hashed[path].mtime,
+                md5=hashed[path].md5,
+                state=state
+            ) for path, state in states.items()
+        ]
+
+        # Replace the old entries
+        ScannerFile.objects.bulk_create(
+            entries,
+            batch_size=homebooru.settings.SCANNER_BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=['scanner', 'path'],
+            update_fields=['size', 'mtime', 'md5', 'state', 'checked_at']
+        )
+
+    def __forget_files(self, paths : list, directories : bool = False):
+        """Removes files (or directories) that no longer exist from the manifest and the checksum cache"""
+
+        for batch in boorutils.batched(paths, homebooru.settings.SCANNER_BATCH_SIZE):
+            query = models.Q(path__in=[os.path.abspath(path) for path in batch])
+
+            # Match anything that was inside of the paths too
+            if directories:
+                for path in batch:
+                    query |= models.Q(path__startswith=os.path.join(os.path.abspath(path), ''))
+
+            self.manifest.filter(query).delete()
+            FileHash.objects.filter(query).delete()
     
     def scan(self, **kwargs) -> list:
         """Scans the scanner for new files"""
@@ -397,23 +613,56 @@ class Scanner(models.Model):
             # Raise the exception
             raise e
 
-    def should_create_post(self, path : str) -> bool:
-        """Returns whether or not we should create a post for the file"""
+    def get_known_checksums(self, md5s : list) -> dict:
+        """Finds which of the checksums already have posts, search results or ignores, so that a whole batch of files can be checked with one query each"""
+
+        md5s = list(md5s)
+
+        # The boorus that each checksum has a result on
+        results = {}
+
+        for (md5, booru_id) in SearchResult.objects.filter(md5__in=md5s).values_list('md5', 'booru_id'):
+            results.setdefault(md5, set()).add(booru_id)
+
+        # The ignores that the scanner is exempt from don't count
+        ignored = ScannerIgnore.objects.filter(md5__in=md5s).exclude(pk__in=self.exempt_ignores.values('pk'))
+
+        return {
+            'boorus': set(self.boorus.values_list('pk', flat=True)),
+            'posted': set(Post.objects.filter(md5__in=md5s).values_list('md5', flat=True)),
+            'results': results,
+            'ignored': set(ignored.values_list('md5', flat=True))
+        }
+
+    def should_create_post(self, path : str, md5 : str = None, known : dict = None) -> bool:
+        """Returns whether or not we should create a post for the file (see get_known_checksums for known)"""
 
         # Get the md5 hash of the file
-        md5 = boorutils.get_file_checksum(path)
+        md5 = md5 or FileHash.get_checksum(path)
+
+        # Look it up unless the batch it is in already was
+        known = known or self.get_known_checksums([md5])
 
         # Check that there are search results for the file
-        if not SearchResult.objects.filter(md5=md5).exists() and not self.add_posts_on_failure: return False
+        if md5 not in known['results'] and not self.add_posts_on_failure: return False
 
         # Check if there are already posts for the file
-        if Post.objects.filter(md5=md5).exists(): return False
+        if md5 in known['posted']: return False
 
         # Return true
         return True
 
-    def should_search_file(self, path : str) -> bool:
-        """Checks if the file should be searched"""
+    @staticmethod
+    def probe_file(path : str) -> dict:
+        """Validates a file and returns its probed content, this does not touch the database so it can be run in another thread"""
+
+        Post.validate_file(file_path=Path(path).resolve())
+
+        # The probe is kept from the validation
+        return boorutils.probe_content(path)
+
+    def should_search_file(self, path : str, md5 : str = None, known : dict = None, validate : bool = True) -> bool:
+        """Checks if the file should be searched (see get_known_checksums for known, and validate can be skipped if the file was already probed)"""
 
         # Get the file_path
         file_path = Path(path)
@@ -421,7 +670,7 @@ class Scanner(models.Model):
 
         # Make sure it is an acceptable file type
         try:
-            Post.validate_file(file_path=file_path)
+            if validate: Post.validate_file(file_path=file_path)
         except:
             # If it is not an acceptable file type, return false
             return False
@@ -433,35 +682,25 @@ class Scanner(models.Model):
         if not str(file_path).startswith(str(scanner_path)): return False
         
         # Get the checksum
-        md5 = boorutils.get_file_checksum(path)
+        md5 = md5 or FileHash.get_checksum(path)
+
+        # Look it up unless the batch it is in already was
+        known = known or self.get_known_checksums([md5])
 
         # Make sure that the file is not already in the database as a post
-        if Post.objects.filter(md5=md5).exists(): return False
+        if md5 in known['posted']: return False
         
         # Check if the checksum is marked as ignore
-        if self.should_ignore_checksum(md5): return False
+        if md5 in known['ignored']: return False
 
-        boorus = self.boorus.all()
-        checked_boorus = 0
-        # Check all of the local boorus
-        for booru in boorus:
-            # Make sure that the file is not already in the database as a result
-            if SearchResult.objects.filter(md5=md5, booru=booru).exists(): continue
-
-            # Increment the checked boorus
-            checked_boorus += 1
-        
-        # Make sure that we need to check at least one booru
-        if checked_boorus == 0: return False
+        # Make sure that we need to check at least one booru (that it doesn't already have a result on)
+        if len(known['boorus'] - known['results'].get(md5, set())) == 0: return False
 
         # All checks passed, return true
         return True
 
-    def search_file(self, path : str) -> bool:
-        """Searches for a file"""
-
-        # Get the md5 hash for the file
-        md5 = boorutils.get_file_checksum(path)
+    def get_boorus_to_search(self, md5 : str) -> list:
+        """Gets the boorus that do not have a fresh result for the checksum"""
 
         # Get the results
         results = SearchResult.objects.filter(md5=md5, found=True)
@@ -481,18 +720,32 @@ class Scanner(models.Model):
             
             # Remove the booru from the list
             bs.remove(booru)
+
+        return bs
+
+    def search_file(self, path : str, md5 : str = None) -> bool:
+        """Searches for a file"""
+
+        # Get the md5 hash for the file
+        md5 = md5 or FileHash.get_checksum(path)
+
+        # Get the boorus that need searching
+        bs = self.get_boorus_to_search(md5)
         
         new_find = False
+        results = []
+
         for booru in bs:
             # Search the booru
             result = booru.search_booru_md5(md5)
-
-            # Save the result
-            result.save()
+            results.append(result)
 
             # If we found a result, then mark that we found a new result
             new_find = result.found or new_find
-        
+
+        # Save the results
+        SearchResult.save_many(results)
+
         return new_find
 
     def should_ignore_checksum(self, md5 : str) -> bool:
@@ -534,4 +787,27 @@ def post_delete_post(sender, instance, **kwargs):
     ignore.save()
 
 # Connect the post delete signal
-post_delete.connect(post_delete_post, sender=Post)
\ No newline at end of file
+post_delete.connect(post_delete_post, sender=Post)
+
+# Hook into the scanner's configuration
+from django.db.models.signals import m2m_changed
+
+def scanner_config_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Forgets the files that weren't found, so that they are searched for again with the new configuration"""
+
+    if action not in ['post_add', 'post_remove', 'post_clear']: return
+
+    files = ScannerFile.objects.filter(state=ScannerFile.STATE_NOT_FOUND)
+
+    # The instance is either the scanner or the other side of the relation
+    if not reverse:
+        files = files.filter(scanner=instance)
+    elif pk_set is not None:
+        files = files.filter(scanner_id__in=pk_set)
+
+    files.delete()
+
+# Connect the configuration signals
+m2m_changed.connect(scanner_config_changed, sender=Scanner.boorus.through)
+m2m_changed.connect(scanner_config_changed, sender=Scanner.auto_failure_tags.through)
+m2m_changed.connect(scanner_config_changed, sender=Scanner.exempt_ignores.through)
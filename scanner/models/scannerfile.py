@@ -0,0 +1,67 @@
+from django.db import models
+from django.utils import timezone
+
+import homebooru.settings
+
+import datetime
+import os
+
+class ScannerFile(models.Model):
+    """An entry in a scanner's manifest, remembering what happened to a file so that it is not processed again until it changes"""
+
+    # A post exists for the file
+    STATE_POSTED = 'posted'
+
+    # The file was not found on any of the boorus (it is checked again once the results are stale)
+    STATE_NOT_FOUND = 'not_found'
+
+    # A post could not be created for the file (e.g. it is corrupt), it is tried again once the entry is stale
+    STATE_ERROR = 'error'
+
+    # The file type isn't allowed (it is checked again once the entry is stale, in case the allowed types change)
+    STATE_REJECTED = 'rejected'
+
+    STATES = [
+        (STATE_POSTED, 'Posted'),
+        (STATE_NOT_FOUND, 'Not found'),
+        (STATE_ERROR, 'Error'),
+        (STATE_REJECTED, 'Rejected'),
+    ]
+
+    # The scanner that found the file
+    scanner = models.ForeignKey('scanner.Scanner', on_delete=models.CASCADE, related_name='manifest')
+
+    # The absolute path of the file
+    path = models.CharField(max_length=1024)
+
+    # The details of the file when it was processed
+    size = models.BigIntegerField()
+    mtime = models.BigIntegerField() # In nanoseconds
+    md5 = models.CharField(max_length=32)
+
+    # What happened to the file
+    state = models.CharField(max_length=16, choices=STATES)
+
+    # Date and time the file was last processed
+    checked_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.path + " - " + self.state
+
+    def matches(self, stat : os.stat_result) -> bool:
+        """Checks if the file has not changed since it was processed"""
+
+        return self.size == stat.st_size and self.mtime == stat.st_mtime_ns
+
+    @property
+    def needs_check(self) -> bool:
+        """Checks if the file should be processed again even though it has not changed"""
+
+        # Only posted files are never processed again, the rest are tried again once they are stale
+        if self.state == ScannerFile.STATE_POSTED:
+            return False
+
+        return self.checked_at < timezone.now() - datetime.timedelta(seconds=homebooru.settings.SCANNER_STALENESS_THRESHOLD)
+
+    class Meta:
+        unique_together = ('scanner', 'path')
@@ -53,6 +53,27 @@ class SearchResult(models.Model):
         # Delete them
         stale_results.all().delete()
 
+    @staticmethod
+    def save_many(results : list) -> list:
+        """Saves the results in a single query, replacing any existing results for the same booru and file"""
+
+        # Make sure that a post with the same MD5 hash does not exist (like save does)
+        posted = set(Post.objects.filter(md5__in=[result.md5 for result in results]).values_list('md5', flat=True))
+        results = [result for result in results if result.md5 not in posted]
+
+        if len(results) == 0:
+            return []
+
+        # The latest result for a file wins, since they are unique
+        results = list({(result.booru_id, result.md5): result for result in results}.values())
+
+        return SearchResult.objects.bulk_create(
+            results,
+            update_conflicts=True,
+            unique_fields=['md5', 'booru'],
+            update_fields=['tags', 'source', 'raw_rating', 'found', 'created']
+        )
+
     @property
     def rating(self) -> Rating:
         """The mapped rating from the booru"""
@@ -1,44 +1,200 @@
+import os
 import time
+import select
+import threading
+import logging
 
 # Watchdog
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 # Django models
-from django.db import models
+from django.db import models, connection, connections
+from django.db.models.signals import post_save, post_delete
 from .scanner import Scanner
 
+import homebooru.settings as settings
+
+import booru.boorutils as boorutils
+
+logger = logging.getLogger(__name__)
+
+class ScannerEventAggregator:
+    """Collects the paths of file system events and hands them over in batches once they have settled"""
+
+    def __init__(self, callback, debounce : float = None, max_delay : float = None, start : bool = True):
+        # Called with a list of paths once they are ready to be scanned
+        self.callback = callback
+
+        self.debounce = settings.SCANNER_WATCHDOG_DEBOUNCE if debounce is None else debounce
+        self.max_delay = settings.SCANNER_WATCHDOG_MAX_DELAY if max_delay is None else max_delay
+
+        # Path -> [time of the first event, time of the last change, last seen (size, mtime)]
+        self.pending = {}
+
+        self.condition = threading.Condition()
+        self.stopped = False
+
+        self.thread = None
+
+        if start:
+            self.thread = threading.Thread(target=self.__run, daemon=True)
+            self.thread.start()
+
+    @staticmethod
+    def get_signature(path : str):
+        """Gets what is used to tell if a file is still being written to"""
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # The file has been removed
+            return None
+
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def add(self, paths : list, now : float = None):
+        """Adds the paths of an event, delaying them until they have been left alone"""
+
+        now = time.monotonic() if now is None else now
+
+        # Remember what the files looked like, to tell if they are still changing once they have been left alone
+        signatures = {path: self.get_signature(path) for path in paths}
+
+        with self.condition:
+            # Only wake the thread up when it is waiting for the first event, otherwise it checks once per window
+            was_empty = len(self.pending) == 0
+
+            for path in paths:
+                if path in self.pending:
+                    # Bursts of events for the same path are merged into one
+                    self.pending[path][1:] = [now, signatures[path]]
+                    continue
+
+                self.pending[path] = [now, now, signatures[path]]
+
+            if was_empty:
+                self.condition.notify()
+
+    def take_ready(self, now : float = None) -> list:
+        """Removes and returns the paths that are ready to be scanned"""
+
+        now = time.monotonic() if now is None else now
+
+        with self.condition:
+            # Only look at the paths that have been quiet for long enough
+            candidates = [
+                path for path, (first, last, _) in self.pending.items()
+                if now - last >= self.debounce or now - first >= self.max_delay
+            ]
+
+        # Files are checked without holding the lock so that events are not held up
+        signatures = {path: self.get_signature(path) for path in candidates}
+
+        ready = []
+
+        with self.condition:
+            for path in candidates:
+                entry = self.pending.get(path)
+
+                # It was taken by someone else
+                if entry is None:
+                    continue
+
+                first, last, signature = entry
+
+                # An event came in while the files were being checked
+                if now - last < self.debounce and now - first < self.max_delay:
+                    continue
+
+                # Files that are still being written to are held back until they stop changing
+                if signatures[path] != signature and now - first < self.max_delay:
+                    entry[1] = now
+                    entry[2] = signatures[path]
+                    continue
+
+                del self.pending[path]
+                ready.append(path)
+
+        return ready
+
+    def flush(self, now : float = None) -> list:
+        """Hands over the paths that are ready, returning them"""
+
+        ready = self.take_ready(now)
+
+        if len(ready) > 0:
+            self.callback(ready)
+
+        return ready
+
+    def __run(self):
+        """Hands over the settled paths until stopped"""
+
+        try:
+            while True:
+                with self.condition:
+                    if self.stopped:
+                        return
+
+                    # Nothing to do until an event comes in
+                    if len(self.pending) == 0:
+                        self.condition.wait()
+                        continue
+
+                    # Wait for the paths to settle
+                    self.condition.wait(self.debounce)
+
+                    if self.stopped:
+                        return
+
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.warning('Failed to hand over watched paths: %s', e)
+        finally:
+            # The thread has its own database connection
+            connections.close_all()
+
+    def stop(self):
+        """Stops handing over paths, dropping any that haven't settled"""
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+        if self.thread is not None:
+            self.thread.join()
+
 class ScannerWatcherHandler(FileSystemEventHandler):
     """Handles file system events for scanners"""
 
-    def __init__(self, watchdog):
-        self.watchdog = watchdog
+    def __init__(self, aggregator : ScannerEventAggregator):
+        self.aggregator = aggregator
 
-    def run_scanner(self):
-        # Get the scanner
-        if self.watchdog.should_delete:
-            return
-        
-        scanner = self.watchdog.scanner
+    @staticmethod
+    def get_paths(event) -> list:
+        """Gets the paths that need to be scanned because of an event"""
 
-        if scanner.is_active:
-            # Do not run the scanner if it is already running
-            return
-        
-        # Run the scanner
-        scanner.scan()
+        # Directories are modified whenever their files are, which are already being watched
+        if event.is_directory and event.event_type == 'modified':
+            return []
+
+        # Files that were moved are removed from the old path
+        if event.event_type == 'moved':
+            return [event.src_path, event.dest_path]
+
+        if event.event_type in ['created', 'modified', 'deleted', 'closed']:
+            return [event.src_path]
+
+        return []
 
     def on_any_event(self, event):
-        if event.is_directory:
-            return None
-        
-        # Check if it is a file change
-        if event.event_type == 'modified':
-            return self.run_scanner()
-        
-        # Check if it is a file creation
-        if event.event_type == 'created':
-            return self.run_scanner()
+        paths = self.get_paths(event)
+
+        # Only collect the paths, the scanning is done elsewhere once they have settled
+        if len(paths) > 0:
+            self.aggregator.add(paths)
 
 class ScannerObserver():
     """Watches a scanner for changes"""
@@ -46,11 +202,14 @@ class ScannerObserver():
     def __init__(self, watchdog):
         self.watchdog = watchdog
 
+        # Collects the events into batches
+        self.aggregator = ScannerEventAggregator(self.watchdog.enqueue)
+
         # Create the observer
         self.observer = Observer()
 
         # Create the event handler
-        self.event_handler = ScannerWatcherHandler(self.watchdog)
+        self.event_handler = ScannerWatcherHandler(self.aggregator)
 
         # Start the observer
         self.observer.schedule(self.event_handler, self.watchdog.path, recursive=True)
@@ -61,9 +220,14 @@ class ScannerObserver():
         self.observer.stop()
         self.observer.join()
 
+        self.aggregator.stop()
+
 class ScannerWatchDog(models.Model):
     """Stores the status of the watchdog"""
 
+    # Notified whenever a watchdog might no longer be needed
+    channel = 'scanner_watchdog'
+
     is_running = models.BooleanField(default=False)
 
     # Path
@@ -79,13 +243,19 @@ class ScannerWatchDog(models.Model):
         """Gets the scanner that is watching this path"""
 
         return self.__scanners.first()
-    
+
     @property
     def should_delete(self):
         """Checks if the watchdog should be deleted"""
 
         return len(self.__scanners) == 0
-    
+
+    @property
+    def exists(self):
+        """Checks if the watchdog is still in the database"""
+
+        return ScannerWatchDog.objects.filter(id=self.id).exists()
+
     @staticmethod
     def prune():
         """Deletes all the watchdogs that should be deleted"""
@@ -94,7 +264,69 @@ class ScannerWatchDog(models.Model):
             if not watchdog.should_delete: continue
 
             watchdog.delete()
-    
+
+    @staticmethod
+    def notify():
+        """Tells the running watchdogs to check if they are still needed"""
+
+        # Only postgres can send notifications, everywhere else relies on the timeout
+        if connection.vendor != 'postgresql':
+            return
+
+        # The notification is sent once the transaction has been committed
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [ScannerWatchDog.channel, ''])
+
+    @staticmethod
+    def listen():
+        """Starts receiving the notifications on this thread's connection"""
+
+        if connection.vendor != 'postgresql':
+            return
+
+        with connection.cursor() as cursor:
+            cursor.execute('LISTEN ' + ScannerWatchDog.channel)
+
+    @staticmethod
+    def wait_for_notification(timeout : float):
+        """Blocks until the watchdogs have been notified or the timeout has passed"""
+
+        if connection.vendor != 'postgresql':
+            time.sleep(timeout)
+            return
+
+        pg_connection = connection.connection
+
+        # Sleep on the socket, rather than asking the database over and over again
+        select.select([pg_connection], [], [], timeout)
+
+        # Clear the notifications, they don't carry any information
+        pg_connection.poll()
+        pg_connection.notifies.clear()
+
+    def enqueue(self, paths : list):
+        """Queues scans of the given paths"""
+
+        scanner = self.scanner
+
+        if scanner is None:
+            return
+
+        # Imported here as the tasks import the models
+        from scanner.tasks import scan
+
+        # Split the paths so that each task stays small
+        for batch in boorutils.batched(paths, settings.SCANNER_WATCHDOG_MAX_BATCH):
+            scan.delay(scanner.id, batch)
+
+    def is_needed(self) -> bool:
+        """Checks if the watchdog should keep running"""
+
+        if not self.exists or self.should_delete:
+            return False
+
+        return self.path == self.scanner.path
+
     def run(self):
         """Runs the watchdog"""
 
@@ -105,30 +337,29 @@ class ScannerWatchDog(models.Model):
         self.is_running = True
         self.save()
 
+        # Listen before checking, so that no changes are missed in between
+        ScannerWatchDog.listen()
+
         # Create the observer
         observer = ScannerObserver(self)
 
-        # Create a function that checks that the object still exists
-        def check_exists():
-            # Check if the watchdog still exists
-            return len(ScannerWatchDog.objects.filter(id=self.id)) > 0
-
-        # Wait for the path to change or the scanner to be deleted
-        while check_exists() and not self.should_delete and self.path == self.scanner.path:
-            time.sleep(5) # sleep for 5 seconds to avoid CPU usage
-        
-        # Stop the observer
-        observer.stop()
+        try:
+            # Wait for the path to change or the scanner to be deleted
+            while self.is_needed():
+                ScannerWatchDog.wait_for_notification(settings.SCANNER_WATCHDOG_LIVENESS_TIMEOUT)
+        finally:
+            # Stop the observer
+            observer.stop()
 
-        if not check_exists():
+        if not self.exists:
             # The watchdog was deleted
             return "Watchdog was deleted"
-        
+
         # Delete the watchdog
         self.delete()
 
         return "Path changed or scanner was deleted"
-    
+
     @staticmethod
     def from_scanner(scanner):
         """Creates a watchdog from a scanner"""
@@ -136,7 +367,21 @@ class ScannerWatchDog(models.Model):
         # Check if the scanner already has a watchdog
         if len(ScannerWatchDog.objects.filter(path=scanner.path)) > 0:
             return
-        
+
         # Create the watchdog
         watchdog = ScannerWatchDog(path=scanner.path)
-        watchdog.save()
\ No newline at end of file
+        watchdog.save()
+
+def watchdog_liveness_changed(sender, instance, **kwargs):
+    """Wakes the watchdogs up when a scanner or watchdog changes"""
+
+    # Saving a scanner while it is scanning doesn't change what is being watched
+    if sender == Scanner and kwargs.get('created') is False and instance.is_active:
+        return
+
+    ScannerWatchDog.notify()
+
+# Connect the liveness signals
+post_save.connect(watchdog_liveness_changed, sender=Scanner)
+post_delete.connect(watchdog_liveness_changed, sender=Scanner)
+post_delete.connect(watchdog_liveness_changed, sender=ScannerWatchDog)
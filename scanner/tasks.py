@@ -4,7 +4,9 @@ from celery import shared_task
 import logging
 logger = logging.getLogger(__name__)
 
-from scanner.models import Scanner
+from scanner.models import Scanner, ScannerError
+
+import homebooru.settings
     
 @shared_task
 def scan_all():
@@ -15,16 +17,28 @@ def scan_all():
     for scanner in scanners:
         scan.delay(scanner.id)
 
-@shared_task
-def scan(scanner_id):
+@shared_task(bind=True, max_retries=homebooru.settings.SCANNER_WATCHDOG_MAX_RETRIES)
+def scan(self, scanner_id, paths=None):
     # Get the scanner
     scanner = Scanner.objects.get(id=scanner_id)
 
-    # Make sure that it is not active
-    if scanner.is_active: return
+    try:
+        # Make sure that it is not active
+        if scanner.is_active: raise ScannerError('The scanner is already active')
+
+        # Run the scan function (only on the given paths if there are any)
+        results = scanner.scan(paths=paths)
+    except ScannerError:
+        # Full scans will come around again, but the changed paths would be lost
+        if paths is None: return
+
+        # The scanner may be stuck (e.g. its worker crashed mid-scan), so stop retrying at some point
+        if self.request.retries >= self.max_retries:
+            # The paths aren't in the manifest yet, so the next full scan picks them up
+            logger.warning('Scanner %s is still busy, leaving %d watched paths for its next full scan', scanner_id, len(paths))
+            return []
 
-    # Run the scan function
-    results = scanner.scan()
+        raise self.retry(countdown=homebooru.settings.SCANNER_WATCHDOG_RETRY_DELAY)
 
     # Return the results' ids
     return [result.id for result in results]
@@ -5,5 +5,9 @@ import_required([
     TestInstance('scanner_models_scanner', 'scanner.tests.models.scanner'),
     TestInstance('scanner_models_searchresult', 'scanner.tests.models.searchresult'),
     TestInstance('scanner_models_scannerignore', 'scanner.tests.models.scannerignore'),
+    TestInstance('scanner_models_filehash', 'scanner.tests.models.filehash'),
+    TestInstance('scanner_models_scannerfile', 'scanner.tests.models.scannerfile'),
+    TestInstance('scanner_models_watchdog', 'scanner.tests.models.watchdog'),
+    TestInstance('scanner_models_booruindex', 'scanner.tests.models.booruindex'),
 
 ], globals(), locals())
\ No newline at end of file
@@ -1,8 +1,11 @@
 from django.test import TestCase
 
-from scanner.models import Booru
+from scanner.models import Booru, RateLimiter
 
 import scanner.tests.testutils as scanner_testutils
+import booru.boorutils as boorutils
+
+import homebooru.settings
 
 class SearchBooruMD5Test(TestCase):
     valid_md5 = scanner_testutils.BOORU_MD5
@@ -118,4 +121,207 @@ class SaveBooruTest(TestCase):
             # Make sure it doesn't raise an error
             booru.save()
 
-            i += 1
\ No newline at end of file
+            i += 1
+
+class StubBooruTest(TestCase):
+    md5 = scanner_testutils.BOORU_MD5
+
+    def setUp(self):
+        self.og_SCANNER_BOORU_BACKOFF = homebooru.settings.SCANNER_BOORU_BACKOFF
+        self.og_SCANNER_BOORU_RATE_LIMIT = homebooru.settings.SCANNER_BOORU_RATE_LIMIT
+
+        # Don't wait between retries
+        homebooru.settings.SCANNER_BOORU_BACKOFF = 0
+        homebooru.settings.SCANNER_BOORU_RATE_LIMIT = 0
+
+        # Make sure the settings are used
+        Booru.reset_sessions()
+
+        self.stub = scanner_testutils.StubBooru({
+            self.md5: {'tags': ' '.join(scanner_testutils.BOORU_TAGS), 'rating': 'safe', 'source': 'https://example.com'}
+        })
+        self.stub.setUp()
+
+        self.booru = Booru(url=self.stub.url, name='stub')
+        self.booru.save()
+
+    def tearDown(self):
+        self.stub.tearDown()
+
+        Booru.reset_sessions()
+
+        homebooru.settings.SCANNER_BOORU_BACKOFF = self.og_SCANNER_BOORU_BACKOFF
+        homebooru.settings.SCANNER_BOORU_RATE_LIMIT = self.og_SCANNER_BOORU_RATE_LIMIT
+
+    def test_search(self):
+        """Finds posts on the booru"""
+
+        result = self.booru.search_booru_md5(self.md5)
+
+        self.assertTrue(result.found)
+        self.assertEqual(result.tags, ' '.join(scanner_testutils.BOORU_TAGS))
+        self.assertEqual(result.raw_rating, 'safe')
+
+    def test_not_found(self):
+        """Returns a non-found search result"""
+
+        result = self.booru.search_booru_md5('invalid_md5')
+
+        self.assertFalse(result.found)
+
+    def test_shares_session(self):
+        """Shares the connections of boorus on the same host"""
+
+        other = Booru(url=self.stub.url + '/other', name='other')
+
+        self.assertIs(self.booru.session, other.session)
+        self.assertIs(self.booru.rate_limiter, other.rate_limiter)
+
+    def test_retries(self):
+        """Tries failing requests again"""
+
+        self.stub.failures = 2
+
+        result = self.booru.search_booru_md5(self.md5)
+
+        self.assertTrue(result.found)
+        self.assertEqual(len(self.stub.requests), 2 + 2 + 1)
+
+    def test_gives_up(self):
+        """Returns a non-found result once it has run out of retries"""
+
+        self.stub.failures = 100
+
+        result = self.booru.search_booru_md5(self.md5)
+
+        self.assertFalse(result.found)
+        self.assertEqual(len(self.stub.requests), 2 + homebooru.settings.SCANNER_BOORU_RETRIES + 1)
+
+    def test_does_not_retry_client_errors(self):
+        """Doesn't try requests that can't succeed again"""
+
+        self.stub.failures = 1
+        self.stub.failure_status = 404
+
+        result = self.booru.search_booru_md5(self.md5)
+
+        self.assertFalse(result.found)
+        self.assertEqual(len(self.stub.requests), 2 + 1)
+
+class BatchLookupTest(TestCase):
+    def setUp(self):
+        self.og_SCANNER_BOORU_BATCH_SIZE = homebooru.settings.SCANNER_BOORU_BATCH_SIZE
+        self.og_SCANNER_BOORU_MAX_URL_LENGTH = homebooru.settings.SCANNER_BOORU_MAX_URL_LENGTH
+        self.og_SCANNER_BOORU_RATE_LIMIT = homebooru.settings.SCANNER_BOORU_RATE_LIMIT
+
+        homebooru.settings.SCANNER_BOORU_RATE_LIMIT = 0
+
+        Booru.reset_sessions()
+
+        self.md5s = [boorutils.hash_str(str(i)) for i in range(10)]
+
+        # Only the even files can be found
+        self.stub = scanner_testutils.StubBooru({
+            md5: {'tags': 'tag' + str(i), 'rating': 'safe'} for i, md5 in enumerate(self.md5s) if i % 2 == 0
+        })
+        self.stub.setUp()
+
+        self.booru = Booru(url=self.stub.url, name='stub', batch_lookups=True)
+        self.booru.save()
+
+        self.stub.requests.clear()
+
+    def tearDown(self):
+        self.stub.tearDown()
+
+        Booru.reset_sessions()
+
+        homebooru.settings.SCANNER_BOORU_BATCH_SIZE = self.og_SCANNER_BOORU_BATCH_SIZE
+        homebooru.settings.SCANNER_BOORU_MAX_URL_LENGTH = self.og_SCANNER_BOORU_MAX_URL_LENGTH
+        homebooru.settings.SCANNER_BOORU_RATE_LIMIT = self.og_SCANNER_BOORU_RATE_LIMIT
+
+    def test_phrase(self):
+        """ORs the md5s together"""
+
+        self.assertEqual(Booru.get_md5s_phrase(['a']), 'md5:a')
+        self.assertEqual(Booru.get_md5s_phrase(['a', 'b']), '( md5:a ~ md5:b )')
+
+    def test_search(self):
+        """Searches for all of the files in a single request"""
+
+        posts = self.booru.raw_search_md5s(self.md5s)
+
+        self.assertEqual(len(self.stub.requests), 1)
+
+        for i, md5 in enumerate(self.md5s):
+            if i % 2 == 0:
+                self.assertEqual(posts[md5]['tags'], 'tag' + str(i))
+            else:
+                self.assertIsNone(posts[md5])
+
+    def test_batch_size(self):
+        """Splits the files into batches of the maximum size"""
+
+        homebooru.settings.SCANNER_BOORU_BATCH_SIZE = 4
+
+        self.assertEqual(self.booru.get_md5_batches(self.md5s), [self.md5s[0:4], self.md5s[4:8], self.md5s[8:10]])
+
+    def test_url_length(self):
+        """Splits the files so that the URLs aren't too long"""
+
+        homebooru.settings.SCANNER_BOORU_MAX_URL_LENGTH = len(self.booru.get_search_url(Booru.get_md5s_phrase(self.md5s[:3]), 3))
+
+        batches = self.booru.get_md5_batches(self.md5s)
+
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 3, 1])
+
+    def test_disabled(self):
+        """Searches for one file at a time if the booru can't OR tags"""
+
+        self.booru.batch_lookups = False
+
+        self.assertEqual(self.booru.get_md5_batches(self.md5s), [[md5] for md5 in self.md5s])
+
+    def test_no_md5s(self):
+        """Searches for the files one at a time if the posts can't be matched to them"""
+
+        self.stub.include_md5 = False
+
+        posts = self.booru.raw_search_md5s(self.md5s)
+
+        self.assertEqual(len(self.stub.requests), 1 + len(self.md5s))
+        self.assertEqual(posts[self.md5s[0]]['tags'], 'tag0')
+        self.assertIsNone(posts[self.md5s[1]])
+
+class RateLimiterTest(TestCase):
+    def test_burst(self):
+        """Allows a burst of requests before limiting them"""
+
+        limiter = RateLimiter(2, burst=2)
+        limiter.updated = 0
+
+        self.assertEqual(limiter.reserve(now=0), 0)
+        self.assertEqual(limiter.reserve(now=0), 0)
+        self.assertEqual(limiter.reserve(now=0), 0.5)
+        self.assertEqual(limiter.reserve(now=0), 1.0)
+
+    def test_refills(self):
+        """Allows more requests as time passes"""
+
+        limiter = RateLimiter(1, burst=1)
+        limiter.updated = 0
+
+        self.assertEqual(limiter.reserve(now=0), 0)
+        self.assertEqual(limiter.reserve(now=1), 0)
+
+        # It doesn't refill above the burst size
+        self.assertEqual(limiter.reserve(now=100), 0)
+        self.assertEqual(limiter.reserve(now=100), 1.0)
+
+    def test_unlimited(self):
+        """Never waits without a rate"""
+
+        limiter = RateLimiter(0)
+
+        for i in range(10):
+            self.assertEqual(limiter.reserve(), 0)
@@ -0,0 +1,197 @@
+from django.test import TestCase
+from django.core.management import call_command
+
+from scanner.models import Booru, BooruIndexEntry, Scanner, SearchResult
+
+import booru.boorutils as boorutils
+import booru.tests.testutils as booru_testutils
+import scanner.tests.testutils as scanner_testutils
+
+import os
+import io
+import csv
+import gzip
+import json
+import shutil
+import tempfile
+
+class BooruIndexTest(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+        # Index boorus are not tested when they are saved
+        self.booru = Booru(name='index', url='http://127.0.0.1', source_type=Booru.SOURCE_INDEX)
+        self.booru.save()
+
+        self.rows = [
+            {'md5': boorutils.hash_str(str(i)), 'tags': f'tag{i} common', 'rating': 'safe', 'source': f'https://example.com/{i}'}
+            for i in range(10)
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_csv(self, name, rows):
+        path = os.path.join(self.temp_dir, name)
+
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['md5', 'tags', 'rating', 'source'])
+            writer.writeheader()
+            writer.writerows(rows)
+
+        return path
+
+    def write_jsonl(self, name, rows, compress=False):
+        path = os.path.join(self.temp_dir, name)
+
+        with (gzip.open(path, 'wt') if compress else open(path, 'w')) as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+
+        return path
+
+    def test_import_csv(self):
+        """Imports a CSV dump"""
+
+        total = BooruIndexEntry.import_dump(self.booru, self.write_csv('dump.csv', self.rows))
+
+        self.assertEqual(total, 10)
+        self.assertEqual(self.booru.index.count(), 10)
+
+        entry = self.booru.index.get(md5=self.rows[3]['md5'])
+
+        self.assertEqual(entry.tags, 'tag3 common')
+        self.assertEqual(entry.rating, 'safe')
+        self.assertEqual(entry.source, 'https://example.com/3')
+
+    def test_import_jsonl(self):
+        """Imports a gzipped JSONL dump, with tags as a list"""
+
+        rows = [dict(row, tags=row['tags'].split()) for row in self.rows]
+
+        BooruIndexEntry.import_dump(self.booru, self.write_jsonl('dump.jsonl.gz', rows, compress=True))
+
+        self.assertEqual(self.booru.index.get(md5=self.rows[0]['md5']).tags, 'tag0 common')
+
+    def test_import_batches(self):
+        """Imports the dump a batch at a time"""
+
+        path = self.write_csv('dump.csv', self.rows)
+
+        with self.assertNumQueries(4):
+            BooruIndexEntry.import_dump(self.booru, path, batch_size=3)
+
+        self.assertEqual(self.booru.index.count(), 10)
+
+    def test_import_updates(self):
+        """Updates the posts that are already in the index, skipping invalid rows"""
+
+        BooruIndexEntry.import_dump(self.booru, self.write_csv('dump.csv', self.rows))
+
+        rows = [dict(self.rows[0], tags='changed'), {'md5': 'invalid', 'tags': 'nope'}]
+        BooruIndexEntry.import_dump(self.booru, self.write_jsonl('dump.jsonl', rows))
+
+        self.assertEqual(self.booru.index.count(), 10)
+        self.assertEqual(self.booru.index.get(md5=self.rows[0]['md5']).tags, 'changed')
+
+    def test_unknown_format(self):
+        """Rejects dumps that it can't read"""
+
+        with self.assertRaises(ValueError):
+            BooruIndexEntry.import_dump(self.booru, os.path.join(self.temp_dir, 'dump.xml'))
+
+    def test_search(self):
+        """Searches the index without any requests"""
+
+        BooruIndexEntry.import_dump(self.booru, self.write_csv('dump.csv', self.rows))
+
+        md5s = [self.rows[0]['md5'], 'missing']
+
+        with self.assertNumQueries(1):
+            posts = self.booru.raw_search_md5s(md5s)
+
+        self.assertEqual(posts[md5s[0]]['tags'], 'tag0 common')
+        self.assertIsNone(posts['missing'])
+
+        result = self.booru.search_booru_md5(self.rows[1]['md5'])
+
+        self.assertTrue(result.found)
+        self.assertEqual(result.tags, 'tag1 common')
+
+    def test_command(self):
+        """Imports a dump using the management command"""
+
+        out = io.StringIO()
+        call_command('importbooruindex', 'other', self.write_csv('dump.csv', self.rows), url='http://127.0.0.2', stdout=out)
+
+        booru = Booru.objects.get(name='other')
+
+        self.assertTrue(booru.is_local)
+        self.assertEqual(booru.index.count(), 10)
+
+class BooruIndexScanTest(TestCase):
+    fixtures = ['ratings.json']
+
+    def setUp(self):
+        self.temp_storage = booru_testutils.TempStorage()
+        self.temp_storage.setUp()
+
+        self.temp_scan_dir = scanner_testutils.TempScanFolder([booru_testutils.FELIX_PATH, booru_testutils.GATO_PATH])
+        self.temp_scan_dir.setUp()
+
+        self.booru = Booru(name='index', url='http://127.0.0.1', source_type=Booru.SOURCE_INDEX)
+        self.booru.save()
+
+        # Only felix is in the index
+        self.felix_md5 = boorutils.get_file_checksum(booru_testutils.FELIX_PATH)
+        BooruIndexEntry(booru=self.booru, md5=self.felix_md5, tags='cat felix', rating='safe').save()
+
+        self.scanner = Scanner(path=str(self.temp_scan_dir.folder), name='Test Scanner')
+        self.scanner.save()
+        self.scanner.boorus.add(self.booru)
+
+    def tearDown(self):
+        self.temp_scan_dir.tearDown()
+        self.temp_storage.tearDown()
+
+    def test_scan(self):
+        """Creates posts from the index"""
+
+        posts = self.scanner.scan()
+
+        self.assertEqual([post.md5 for post in posts], [self.felix_md5])
+        self.assertIn('felix', [tag.tag for tag in posts[0].tags.all()])
+
+        self.assertEqual(SearchResult.objects.filter(booru=self.booru).count(), 2)
+
+    def test_scan_hardlink(self):
+        """Links the found files into the storage instead of copying them"""
+
+        self.scanner.import_strategy = boorutils.IMPORT_HARDLINK
+        self.scanner.save()
+
+        posts = self.scanner.scan()
+        scanned = self.temp_scan_dir.folder / (self.felix_md5 + '.jpg')
+
+        self.assertEqual(os.stat(posts[0].get_media_path()).st_ino, os.stat(scanned).st_ino)
+
+    def test_scan_move(self):
+        """Moves the found files into the storage"""
+
+        self.scanner.import_strategy = boorutils.IMPORT_MOVE
+        self.scanner.save()
+
+        scanned = self.temp_scan_dir.folder / (self.felix_md5 + '.jpg')
+
+        # The original is only removed once the post is committed
+        with self.captureOnCommitCallbacks() as callbacks:
+            posts = self.scanner.scan()
+
+        self.assertTrue(posts[0].get_media_path().exists())
+        self.assertTrue(scanned.exists())
+
+        for callback in callbacks:
+            callback()
+
+        self.assertTrue(posts[0].get_media_path().exists())
+        self.assertFalse(scanned.exists())
@@ -0,0 +1,162 @@
+from django.test import TestCase
+
+from scanner.models import FileHash
+
+import booru.boorutils as boorutils
+import booru.tests.testutils as booru_testutils
+
+import os
+import shutil
+import tempfile
+
+class FileHashTest(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        # Copy an image somewhere that we can change it
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'felix.jpg')
+
+        shutil.copy(booru_testutils.FELIX_PATH, self.path)
+
+        self.md5 = boorutils.get_file_checksum(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+        super().tearDown()
+
+    def test_get_checksum(self):
+        """Gets the checksum of the file and remembers it"""
+
+        self.assertEqual(FileHash.get_checksum(self.path), self.md5)
+
+        file_hash = FileHash.objects.get(path=self.path)
+
+        self.assertEqual(file_hash.md5, self.md5)
+        self.assertEqual(file_hash.size, os.path.getsize(self.path))
+
+    def test_unchanged_file_is_not_read(self):
+        """Does not read the file again if it has not changed"""
+
+        FileHash.get_checksum(self.path)
+
+        # Change the stored checksum, it would be fixed if the file was read again
+        FileHash.objects.filter(path=self.path).update(md5='0' * 32)
+
+        self.assertEqual(FileHash.get_checksum(self.path), '0' * 32)
+
+    def test_changed_file_is_read(self):
+        """Reads the file again if it has changed"""
+
+        FileHash.get_checksum(self.path)
+
+        # Change the file
+        with open(self.path, 'ab') as f:
+            f.write(b'changed')
+
+        new_md5 = boorutils.get_file_checksum(self.path)
+
+        self.assertNotEqual(new_md5, self.md5)
+        self.assertEqual(FileHash.get_checksum(self.path), new_md5)
+
+        # There should still only be one record for the file
+        self.assertEqual(FileHash.objects.filter(path=self.path).count(), 1)
+
+    def test_missing_file(self):
+        """Raises if the file does not exist"""
+
+        with self.assertRaises(FileNotFoundError):
+            FileHash.get_checksum(os.path.join(self.temp_dir, 'missing.jpg'))
+
+    def test_prune(self):
+        """Removes the checksums of files that are gone"""
+
+        FileHash.get_checksum(self.path)
+
+        # Keep a record of a file outside of the directory
+        FileHash(path='/not/a/real/file.jpg', size=0, mtime=0, inode=0, md5=self.md5).save()
+
+        os.remove(self.path)
+
+        FileHash.prune(self.temp_dir)
+
+        self.assertFalse(FileHash.objects.filter(path=self.path).exists())
+        self.assertTrue(FileHash.objects.filter(path='/not/a/real/file.jpg').exists())
+
+        FileHash.prune()
+
+        self.assertEqual(FileHash.objects.count(), 0)
+
+class FileHashGetManyTest(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        # Copy a few images somewhere that we can change them
+        self.temp_dir = tempfile.mkdtemp()
+        self.paths = []
+
+        for name in [booru_testutils.FELIX_PATH, booru_testutils.GATO_PATH, booru_testutils.VIDEO_PATH]:
+            path = os.path.join(self.temp_dir, os.path.basename(name))
+            shutil.copy(name, path)
+
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+        super().tearDown()
+
+    def test_get_many(self):
+        """Gets the checksums and mimetypes of all of the files"""
+
+        for workers in [1, 4]:
+            FileHash.objects.all().delete()
+
+            file_hashes = FileHash.get_many(self.paths, workers=workers)
+
+            self.assertEqual(set(file_hashes.keys()), set(self.paths))
+
+            for path in self.paths:
+                self.assertEqual(file_hashes[path].md5, boorutils.get_file_checksum(path))
+                self.assertEqual(file_hashes[path].mimetype, boorutils.get_mimetype(path))
+
+            self.assertEqual(FileHash.objects.count(), len(self.paths))
+
+    def test_probe(self):
+        """Probes all of the files on the pool, including the ones that have not changed"""
+
+        # Only the first file has been hashed before
+        FileHash.get_many(self.paths[:1])
+
+        def probe(path):
+            if path == self.paths[-1]: raise Exception('Could not probe')
+
+            return os.path.basename(path)
+
+        file_hashes = FileHash.get_many(self.paths, workers=4, probe=probe)
+
+        for path in self.paths[:-1]:
+            self.assertEqual(file_hashes[path].content, os.path.basename(path))
+
+        # The files that could not be probed are still hashed
+        self.assertIsNone(file_hashes[self.paths[-1]].content)
+        self.assertEqual(FileHash.objects.count(), len(self.paths))
+
+    def test_skips_missing(self):
+        """Skips files that do not exist"""
+
+        missing = os.path.join(self.temp_dir, 'missing.jpg')
+
+        file_hashes = FileHash.get_many(self.paths + [missing])
+
+        self.assertNotIn(missing, file_hashes)
+        self.assertEqual(len(file_hashes), len(self.paths))
+
+    def test_known_files_are_one_query(self):
+        """Only needs one query once the files are known"""
+
+        FileHash.get_many(self.paths)
+
+        with self.assertNumQueries(1):
+            FileHash.get_many(self.paths)
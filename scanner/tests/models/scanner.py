@@ -1316,4 +1316,70 @@ class PostDeleteHookTest(TestCase):
         self.assertEqual(ignore.md5, self.md5)
 
         # Make sure that the reason is still 'Test'
-        self.assertEqual(ignore.reason, 'Test')
\ No newline at end of file
+        self.assertEqual(ignore.reason, 'Test')
+
+class ScannerStubScanTest(TestCase):
+    fixtures = ['ratings.json']
+
+    def setUp(self):
+        self.og_SCANNER_BOORU_RATE_LIMIT = homebooru.settings.SCANNER_BOORU_RATE_LIMIT
+        homebooru.settings.SCANNER_BOORU_RATE_LIMIT = 0
+
+        Booru.reset_sessions()
+
+        # Temporary storage for the posts
+        self.temp_storage = booru_testutils.TempStorage()
+        self.temp_storage.setUp()
+
+        self.temp_scan_dir = scanner_testutils.TempScanFolder([booru_testutils.FELIX_PATH, booru_testutils.GATO_PATH])
+        self.temp_scan_dir.setUp()
+
+        # Only felix can be found
+        self.felix_md5 = boorutils.get_file_checksum(booru_testutils.FELIX_PATH)
+        self.gato_md5 = boorutils.get_file_checksum(booru_testutils.GATO_PATH)
+
+        self.stub = scanner_testutils.StubBooru({self.felix_md5: {'tags': 'cat felix', 'rating': 'safe'}})
+        self.stub.setUp()
+
+        self.booru = Booru(url=self.stub.url, name='stub')
+        self.booru.save()
+
+        self.scanner = Scanner(path=str(self.temp_scan_dir.folder), name='Test Scanner')
+        self.scanner.save()
+        self.scanner.boorus.add(self.booru)
+
+    def tearDown(self):
+        self.stub.tearDown()
+        self.temp_scan_dir.tearDown()
+        self.temp_storage.tearDown()
+
+        Booru.reset_sessions()
+
+        homebooru.settings.SCANNER_BOORU_RATE_LIMIT = self.og_SCANNER_BOORU_RATE_LIMIT
+
+    def test_scan(self):
+        """Looks the files up on the booru and creates posts for the ones that were found"""
+
+        posts = self.scanner.scan()
+
+        self.assertEqual([post.md5 for post in posts], [self.felix_md5])
+
+        # Each file was looked up once
+        self.assertEqual(len([path for path in self.stub.requests if 'md5' in path]), 2)
+
+        # Both results were saved
+        self.assertTrue(SearchResult.objects.get(md5=self.felix_md5, booru=self.booru).found)
+        self.assertFalse(SearchResult.objects.get(md5=self.gato_md5, booru=self.booru).found)
+
+    def test_batch_scan(self):
+        """Looks all of the files up in a single request"""
+
+        self.booru.batch_lookups = True
+        self.booru.save()
+
+        posts = self.scanner.scan()
+
+        self.assertEqual([post.md5 for post in posts], [self.felix_md5])
+        self.assertEqual(len([path for path in self.stub.requests if 'md5' in path]), 1)
+
+        self.assertFalse(SearchResult.objects.get(md5=self.gato_md5, booru=self.booru).found)
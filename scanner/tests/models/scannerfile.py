@@ -0,0 +1,274 @@
+from django.test import TestCase
+from django.utils import timezone
+
+from scanner.models import Scanner, ScannerFile, FileHash, Booru, SearchResult
+from booru.models import Post, Tag
+
+import booru.boorutils as boorutils
+import booru.tests.testutils as booru_testutils
+import scanner.tests.testutils as scanner_testutils
+
+import homebooru.settings
+
+import datetime
+import os
+import shutil
+
+class ScannerManifestTest(TestCase):
+    temp_storage = booru_testutils.TempStorage()
+
+    fixtures = ['ratings.json']
+
+    def setUp(self):
+        super().setUp()
+
+        self.temp_storage.setUp()
+
+        self.temp_scan_dir = scanner_testutils.TempScanFolder([booru_testutils.FELIX_PATH, booru_testutils.GATO_PATH])
+        self.temp_scan_dir.setUp()
+
+        self.scanner = Scanner(path=str(self.temp_scan_dir.folder), name='Test Scanner')
+        self.scanner.save()
+
+        # Create a booru that can't be reached without testing it
+        self.booru = Booru.objects.bulk_create([Booru(name='Unreachable', url='http://127.0.0.1:1')])[0]
+        self.scanner.boorus.add(self.booru)
+
+        # Give the files results, so that they don't need to be searched for
+        for path in [booru_testutils.FELIX_PATH, booru_testutils.GATO_PATH]:
+            SearchResult(booru=self.booru, md5=boorutils.get_file_checksum(path), found=True, tags='found', raw_rating='safe').save()
+
+        # Make sure that it creates posts for files that weren't found
+        self.scanner.auto_failure_tags.add(Tag.create_or_get('tagme'))
+
+    def tearDown(self):
+        self.temp_scan_dir.tearDown()
+        self.temp_storage.tearDown()
+
+        super().tearDown()
+
+    def get_path(self, original):
+        """Gets the path of a file in the scan folder"""
+
+        # The files are renamed to their checksum
+        return os.path.join(self.temp_scan_dir.folder, boorutils.get_file_checksum(original) + original.suffix)
+
+    def test_records_files(self):
+        """Records what happened to each of the files"""
+
+        posts = self.scanner.scan()
+
+        self.assertEqual(len(posts), 2)
+
+        self.assertEqual(self.scanner.manifest.count(), 2)
+        self.assertEqual(self.scanner.manifest.filter(state=ScannerFile.STATE_POSTED).count(), 2)
+
+    def test_records_rejected_files(self):
+        """Records the files that aren't allowed, so that they are not hashed again"""
+
+        path = os.path.join(self.temp_scan_dir.folder, 'notes.txt')
+
+        with open(path, 'w') as f:
+            f.write('not a post')
+
+        self.scanner.scan()
+
+        self.assertEqual(self.scanner.manifest.get(path=path).state, ScannerFile.STATE_REJECTED)
+
+        # It is skipped while it hasn't changed
+        FileHash.objects.filter(path=path).delete()
+
+        self.scanner.scan()
+
+        self.assertFalse(FileHash.objects.filter(path=path).exists())
+
+    def test_records_duplicates(self):
+        """Records copies of a file with the same state as the first copy, so that they are not hashed again"""
+
+        path = os.path.join(self.temp_scan_dir.folder, 'copy.jpg')
+        shutil.copy(booru_testutils.FELIX_PATH, path)
+
+        posts = self.scanner.scan()
+
+        self.assertEqual(len(posts), 2)
+        self.assertEqual(self.scanner.manifest.get(path=path).state, ScannerFile.STATE_POSTED)
+
+        # It is skipped while it hasn't changed
+        FileHash.objects.filter(path=path).delete()
+
+        self.scanner.scan()
+
+        self.assertFalse(FileHash.objects.filter(path=path).exists())
+
+    def test_retries_errors(self):
+        """Tries to create the posts for files that failed again once they are stale"""
+
+        self.scanner.scan()
+
+        # Pretend that one of the files failed a while ago
+        path = self.get_path(booru_testutils.FELIX_PATH)
+        Post.objects.get(md5=self.scanner.manifest.get(path=path).md5).delete()
+
+        self.scanner.manifest.filter(path=path).update(state=ScannerFile.STATE_ERROR)
+
+        # It isn't tried again until it is stale
+        self.assertEqual(len(self.scanner.scan()), 0)
+
+        self.scanner.manifest.filter(path=path).update(checked_at=timezone.now() - datetime.timedelta(seconds=homebooru.settings.SCANNER_STALENESS_THRESHOLD + 1))
+
+        posts = self.scanner.scan()
+
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(self.scanner.manifest.get(path=path).state, ScannerFile.STATE_POSTED)
+
+    def test_create_workers(self):
+        """Makes the thumbnails and samples of the posts on the pool, without leaving any behind"""
+
+        og_create_workers = homebooru.settings.SCANNER_CREATE_WORKERS
+        homebooru.settings.SCANNER_CREATE_WORKERS = 4
+
+        try:
+            posts = self.scanner.scan()
+        finally:
+            homebooru.settings.SCANNER_CREATE_WORKERS = og_create_workers
+
+        self.assertEqual(len(posts), 2)
+
+        for post in posts:
+            self.assertTrue(post.get_thumbnail_path().exists())
+            self.assertEqual(post.get_sample_path().exists(), post.sample)
+
+        # Only the folders of the posts are left
+        self.assertTrue(set(os.listdir(homebooru.settings.BOORU_STORAGE_PATH)) <= {'media', 'samples', 'thumbnails'})
+
+    def test_known_checksums(self):
+        """Checks a whole batch of files with one query each"""
+
+        paths = [self.get_path(booru_testutils.FELIX_PATH), self.get_path(booru_testutils.GATO_PATH)]
+        md5s = [boorutils.get_file_checksum(path) for path in paths]
+
+        with self.assertNumQueries(4):
+            known = self.scanner.get_known_checksums(md5s)
+
+        with self.assertNumQueries(0):
+            for (path, md5) in zip(paths, md5s):
+                # They already have results, so they only need posts
+                self.assertFalse(self.scanner.should_search_file(path, md5=md5, known=known, validate=False))
+                self.assertTrue(self.scanner.should_create_post(path, md5=md5, known=known))
+
+    def test_skips_unchanged_files(self):
+        """Does not process files that have not changed"""
+
+        self.scanner.scan()
+
+        # Change the checksums, they would be fixed if the files were hashed again
+        FileHash.objects.update(md5='0' * 32)
+
+        posts = self.scanner.scan()
+
+        self.assertEqual(len(posts), 0)
+        self.assertTrue(self.scanner.status.endswith('0 new files were detected, 0 files were scanned, 0 errors occurred'), self.scanner.status)
+        self.assertFalse(FileHash.objects.exclude(md5='0' * 32).exists())
+
+    def test_processes_changed_files(self):
+        """Processes files that have changed"""
+
+        self.scanner.scan()
+
+        # Change one of the files
+        path = self.get_path(booru_testutils.FELIX_PATH)
+
+        with open(path, 'ab') as f:
+            f.write(b'changed')
+
+        posts = self.scanner.scan()
+
+        # The file is now different, so it should be a new post
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(self.scanner.manifest.get(path=path).md5, posts[0].md5)
+
+    def test_forgets_removed_files(self):
+        """Removes files that are gone from the manifest"""
+
+        self.scanner.scan()
+
+        path = self.get_path(booru_testutils.FELIX_PATH)
+        os.remove(path)
+
+        self.scanner.scan()
+
+        self.assertFalse(self.scanner.manifest.filter(path=path).exists())
+        self.assertFalse(FileHash.objects.filter(path=path).exists())
+        self.assertEqual(self.scanner.manifest.count(), 1)
+
+    def test_scan_paths(self):
+        """Only scans the given paths"""
+
+        path = self.get_path(booru_testutils.FELIX_PATH)
+
+        posts = self.scanner.scan(paths=[path])
+
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(list(self.scanner.manifest.values_list('path', flat=True)), [path])
+
+        # Removed paths are forgotten
+        os.remove(path)
+
+        self.scanner.scan(paths=[path])
+
+        self.assertEqual(self.scanner.manifest.count(), 0)
+
+    def test_scan_paths_outside_of_scanner(self):
+        """Ignores paths outside of the scanner"""
+
+        posts = self.scanner.scan(paths=[str(booru_testutils.FELIX_PATH)])
+
+        self.assertEqual(len(posts), 0)
+        self.assertEqual(self.scanner.manifest.count(), 0)
+
+    def test_config_change_forgets_not_found(self):
+        """Changing what the scanner does with missing files means they are checked again"""
+
+        # Don't create posts for the files, and make them need searching for
+        self.scanner.auto_failure_tags.clear()
+        SearchResult.objects.all().delete()
+
+        self.scanner.scan()
+
+        self.assertEqual(self.scanner.manifest.filter(state=ScannerFile.STATE_NOT_FOUND).count(), 2)
+
+        # Create posts for them again
+        self.scanner.auto_failure_tags.add(Tag.create_or_get('tagme'))
+
+        self.assertEqual(self.scanner.manifest.count(), 0)
+
+        posts = self.scanner.scan()
+
+        self.assertEqual(len(posts), 2)
+
+class ScannerFileNeedsCheckTest(TestCase):
+    def test_needs_check(self):
+        """Files that weren't posted are checked again, once they are stale"""
+
+        file = ScannerFile(path='/a.jpg', size=0, mtime=0, md5='0' * 32, state=ScannerFile.STATE_NOT_FOUND)
+
+        self.assertFalse(file.needs_check)
+
+        # Make it stale
+        file.checked_at = timezone.now() - datetime.timedelta(seconds=homebooru.settings.SCANNER_STALENESS_THRESHOLD + 1)
+
+        self.assertTrue(file.needs_check)
+
+        # Files that failed or were rejected are tried again too
+        file.state = ScannerFile.STATE_ERROR
+
+        self.assertTrue(file.needs_check)
+
+        file.state = ScannerFile.STATE_REJECTED
+
+        self.assertTrue(file.needs_check)
+
+        # Posted files are never checked again
+        file.state = ScannerFile.STATE_POSTED
+
+        self.assertFalse(file.needs_check)
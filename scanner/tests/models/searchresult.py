@@ -220,4 +220,41 @@ class ResultSaveDupePostTest(TestCase):
         self.post.delete()
 
         # Make sure it saves
-        result.save()
\ No newline at end of file
+        result.save()
+
+class ResultSaveManyTest(TestCase):
+    def setUp(self):
+        # Don't test the booru, it isn't used
+        self.booru = Booru.objects.bulk_create([Booru(url='http://127.0.0.1', name='imagebooru')])[0]
+
+    def test_saves(self):
+        """Saves all of the results"""
+
+        SearchResult.save_many([
+            SearchResult(booru=self.booru, md5=boorutils.hash_str(str(i)), found=False) for i in range(10)
+        ])
+
+        self.assertEqual(SearchResult.objects.count(), 10)
+
+    def test_replaces_existing(self):
+        """Replaces the results that already exist"""
+
+        md5 = boorutils.hash_str('s')
+
+        SearchResult(booru=self.booru, md5=md5, found=False).save()
+        SearchResult.save_many([SearchResult(booru=self.booru, md5=md5, found=True, tags='tag1 tag2')])
+
+        result = SearchResult.objects.get(md5=md5)
+
+        self.assertTrue(result.found)
+        self.assertEqual(result.tags, 'tag1 tag2')
+
+    def test_skips_posts(self):
+        """Doesn't save the results for files that have posts"""
+
+        post = Post(md5=boorutils.hash_str('s'), folder=1, width=1, height=1)
+        post.save()
+
+        SearchResult.save_many([SearchResult(booru=self.booru, md5=post.md5, found=True)])
+
+        self.assertEqual(SearchResult.objects.count(), 0)
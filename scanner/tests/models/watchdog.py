@@ -0,0 +1,157 @@
+from django.test import TestCase
+
+from watchdog.events import FileCreatedEvent, FileModifiedEvent, FileMovedEvent, FileDeletedEvent, DirModifiedEvent, DirMovedEvent
+
+from scanner.models import Scanner, ScannerEventAggregator, ScannerWatcherHandler
+from scanner.tasks import scan
+
+import os
+import shutil
+import tempfile
+import threading
+
+class ScannerEventAggregatorTest(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+
+        self.path = os.path.join(self.temp_dir, 'file.txt')
+        self.write(self.path, b'hello')
+
+        # Collect the batches that are handed over
+        self.batches = []
+        self.aggregator = ScannerEventAggregator(self.batches.append, debounce=2, max_delay=60, start=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+        super().tearDown()
+
+    def write(self, path, data):
+        with open(path, 'ab') as f:
+            f.write(data)
+
+    def test_waits_for_window(self):
+        """Doesn't hand over paths until they have been left alone"""
+
+        self.aggregator.add([self.path], now=0)
+
+        self.assertEqual(self.aggregator.flush(now=1), [])
+        self.assertEqual(self.aggregator.flush(now=2), [self.path])
+
+        self.assertEqual(self.batches, [[self.path]])
+
+    def test_coalesces_events(self):
+        """Merges bursts of events into a single batch without duplicates"""
+
+        paths = [os.path.join(self.temp_dir, f'{i}.txt') for i in range(100)]
+
+        for i, path in enumerate(paths):
+            self.write(path, b'data')
+
+            # Each file gets several events
+            self.aggregator.add([path], now=i / 100)
+            self.aggregator.add([path], now=i / 100)
+
+        self.assertEqual(self.aggregator.flush(now=1), [])
+        self.assertEqual(sorted(self.aggregator.flush(now=3)), sorted(paths))
+
+        self.assertEqual(len(self.batches), 1)
+
+    def test_events_extend_window(self):
+        """Later events for a path delay it again"""
+
+        self.aggregator.add([self.path], now=0)
+        self.aggregator.add([self.path], now=1.5)
+
+        self.assertEqual(self.aggregator.flush(now=2), [])
+        self.assertEqual(self.aggregator.flush(now=3.5), [self.path])
+
+    def test_waits_for_writes(self):
+        """Holds back files that are still being written to"""
+
+        self.aggregator.add([self.path], now=0)
+
+        # The file changed without an event being seen
+        self.write(self.path, b' world')
+
+        self.assertEqual(self.aggregator.flush(now=2), [])
+        self.assertEqual(self.aggregator.flush(now=4), [self.path])
+
+    def test_max_delay(self):
+        """Hands over paths that keep changing once they have been held back for too long"""
+
+        self.aggregator.add([self.path], now=0)
+
+        for i in range(60):
+            self.aggregator.add([self.path], now=i + 1)
+
+        self.assertEqual(self.aggregator.flush(now=61), [self.path])
+
+    def test_deleted_files(self):
+        """Hands over paths that no longer exist"""
+
+        path = os.path.join(self.temp_dir, 'missing.txt')
+
+        self.aggregator.add([path], now=0)
+
+        self.assertEqual(self.aggregator.flush(now=2), [path])
+
+    def test_thread(self):
+        """Hands over the batches from its own thread"""
+
+        handed_over = threading.Event()
+
+        aggregator = ScannerEventAggregator(lambda paths: handed_over.set(), debounce=0.01)
+
+        try:
+            aggregator.add([self.path])
+
+            self.assertTrue(handed_over.wait(5))
+        finally:
+            aggregator.stop()
+
+        self.assertEqual(aggregator.pending, {})
+
+class ScannerWatcherHandlerTest(TestCase):
+    def test_file_events(self):
+        """Gets the paths of file events"""
+
+        self.assertEqual(ScannerWatcherHandler.get_paths(FileCreatedEvent('/a')), ['/a'])
+        self.assertEqual(ScannerWatcherHandler.get_paths(FileModifiedEvent('/a')), ['/a'])
+        self.assertEqual(ScannerWatcherHandler.get_paths(FileDeletedEvent('/a')), ['/a'])
+        self.assertEqual(ScannerWatcherHandler.get_paths(FileMovedEvent('/a', '/b')), ['/a', '/b'])
+
+    def test_directory_events(self):
+        """Ignores directories being modified, but not moved"""
+
+        self.assertEqual(ScannerWatcherHandler.get_paths(DirModifiedEvent('/a')), [])
+        self.assertEqual(ScannerWatcherHandler.get_paths(DirMovedEvent('/a', '/b')), ['/a', '/b'])
+
+    def test_collects_paths(self):
+        """Adds the paths to the aggregator instead of scanning"""
+
+        aggregator = ScannerEventAggregator(lambda paths: None, start=False)
+        handler = ScannerWatcherHandler(aggregator)
+
+        handler.on_any_event(FileCreatedEvent('/a'))
+        handler.on_any_event(FileModifiedEvent('/a'))
+
+        self.assertEqual(list(aggregator.pending.keys()), ['/a'])
+
+class ScannerWatchedScanTest(TestCase):
+    def test_gives_up_when_busy(self):
+        """Stops retrying the watched paths once the retries run out, leaving them for the next full scan"""
+
+        scanner = Scanner(path=tempfile.gettempdir(), name='Busy Scanner', is_active=True)
+        scanner.save()
+
+        # The retries are run straight away when the task is applied locally
+        result = scan.apply(args=[scanner.id, [os.path.join(scanner.path, 'file.jpg')]])
+
+        self.assertEqual(result.get(), [])
+
+        # The scanner was left alone
+        scanner.refresh_from_db()
+        self.assertTrue(scanner.is_active)
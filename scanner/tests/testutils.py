@@ -3,6 +3,12 @@ import pathlib
 import datetime
 import os
 import shutil
+import re
+import json
+import threading
+import urllib
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 import booru.boorutils as boorutils
 import booru.tests.testutils as booru_testutils
@@ -75,4 +81,86 @@ class TempScanFolder:
         self.__files.remove(file)
     
     def remove_all_files(self):
-        self.__files.clear()
\ No newline at end of file
+        self.__files.clear()
+
+class StubBooru:
+    """A local booru API which serves the given posts, keyed by their md5"""
+
+    def __init__(self, posts : dict = {}):
+        self.posts = dict(posts)
+
+        # Number of requests to fail with the given status before answering
+        self.failures = 0
+        self.failure_status = 503
+
+        # Whether the posts say what their md5 is
+        self.include_md5 = True
+
+        # Every request path that was received
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def respond(self, handler):
+        """Answers a request to the stub"""
+
+        url = urllib.parse.urlsplit(handler.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        with self.lock:
+            self.requests.append(handler.path)
+
+            failing = self.failures > 0
+            if failing: self.failures -= 1
+
+        if failing:
+            handler.send_response(self.failure_status)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+
+        # Answer the searches for md5s (OR'd together or not), and any other request with a post so that the booru is valid
+        if 'tags' in query:
+            md5s = re.findall('md5:([0-9a-f]+)', query['tags'][0])
+            posts = [dict(self.posts[md5], md5=md5) if self.include_md5 else self.posts[md5] for md5 in md5s if md5 in self.posts]
+        else:
+            posts = list(self.posts.values()) or [{'tags': 'stub'}]
+
+        # Only give as many posts as were asked for
+        if 'limit' in query:
+            posts = posts[:int(query['limit'][0])]
+
+        body = json.dumps(posts).encode()
+
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def setUp(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep the connections open, like a real booru
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub.respond(self)
+
+            def log_message(self, *args):
+                pass
+
+        # Serve on any free port
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -58,6 +58,9 @@ if [ "$DB_MIGRATE" = "True" ]; then
     # Migrate the rest of the site
     python manage.py makemigrations
     python manage.py migrate --run-syncdb
+
+    # Rebuild the tag post counts (they are only kept up to date from here on)
+    python manage.py recounttags
 fi
 
 # Check for the unit test enviroment variable